@@ -33,6 +33,78 @@ config["template_folder"] = "HGG/Brats18_2013_2_1"
 config["image_shape"] = (144,144,144)
 # config["is_create_patch_index_list_original"] = False
 
+# if True, the training .h5 is converted once to uncompressed memory-mapped .npy files and read from there
+config["is_memmap"] = False
+
+# memory budget (mb) of the per-generator LRU cache of decompressed subjects; 0 disables it
+config["subject_cache_mb"] = 0
+# if set, training patches are shuffled within windows of this many subjects to keep the cache hot
+config["locality_window"] = None
+# if True, 2.5d training reads each slice of a subject once per epoch (slabs of a sliding buffer) instead of once per
+# patch containing it; the slabs of slab_n_subjects subjects are mixed in a shuffle buffer of slab_shuffle_buffer patches
+config["is_slab_reader"] = False
+config["slab_n_subjects"] = 4
+config["slab_shuffle_buffer"] = 32
+# memory budget (mb) of the validation batches built in the first epoch and replayed by the following ones; batches
+# beyond it are stored as .npy memory maps in validation_cache_dir (None: not cached). 0 and None disable the cache
+config["validation_cache_mb"] = 0
+config["validation_cache_dir"] = None
+# if True, training patches tile the foreground bounding box stored with the data instead of the whole image
+config["is_foreground_sampling"] = False
+# if True, the 3d predictions only cover the foreground bounding box stored with the data
+config["is_foreground_roi"] = False
+# gzip level of the written predictions, 0 writes uncompressed .nii files
+config["prediction_compress_level"] = 1
+# dtype of the probability maps: None keeps the model output, "float32", or "int16"/"uint8" quantized with a scale
+# factor in the header. Label maps (the predictions and truth.nii.gz) are always written as uint8
+config["prediction_probability_dtype"] = None
+# threads writing the predicted images while the next case is predicted, 0 writes them in the prediction loop
+config["n_writer_threads"] = 0
+
+# number of processes used to evaluate the predicted cases
+config["n_workers_evaluate"] = 4
+# scores written per case; hd95/asd are in mm, surface_dice counts borders closer than the tolerance (mm)
+config["evaluation_metrics"] = ("dice", "sensitivity", "specificity", "hd95", "asd", "surface_dice")
+config["surface_dice_tolerance"] = 1.
+
+# local scheduler of the loop scripts: slots of the machine (None: all cpus / all memory / all visible gpus) and
+# reservation per job. Each job runs on its own scheduler_job_n_gpu gpus, so the jobs run one per gpu by default
+# (set scheduler_job_n_gpu to the number of gpus for multi-gpu models); without gpu, the cpu slots bound the jobs
+config["scheduler_n_cpu"] = None
+config["scheduler_mem_gb"] = None
+config["scheduler_max_jobs"] = None  # None: no limit other than the slots
+config["scheduler_job_n_cpu"] = 4
+config["scheduler_job_mem_gb"] = 16
+config["scheduler_job_n_gpu"] = 1
+
+# if True, checkpoints are written by a background thread, without the optimizer state
+config["is_async_checkpoint"] = False
+# with is_async_checkpoint: write only the weights (the architecture goes to <model>.json) and keep the last n epochs
+config["is_checkpoint_weights_only"] = False
+config["n_last_checkpoints"] = 0
+# data wait / train step times and generator stage times of every step, written to <model>_timing.jsonl
+config["is_log_timing"] = True
+# predict with <model>_inference.h5: batch normalizations folded into the convolutions and dropout removed
+config["is_inference_model"] = False
+# "channels_last" runs the layers channels-last (faster convolutions on cpu), inputs and outputs stay channels-first
+config["data_format"] = "channels_first"
+# memory of each device (GB) used by -ba 0 to select the batch size, None is the memory of the gpu (or of the machine)
+config["memory_budget_gb"] = None
+# storage of the normalized intensities in the data file: "float32", "float16" or "int16" (scaled), read as float32
+config["data_dtype"] = "float32"
+# if True, each subject is stored cropped to its foreground bounding box at its native resolution instead of being
+# resized to image_shape (use a new data file). Patches are sampled within each subject's own shape.
+config["is_crop_foreground"] = False
+config["crop_margin"] = 4
+config["crop_threshold"] = None
+# if True, crop=1 crops the resized subjects to their foreground above crop_threshold (non-zero if None), read
+# once, instead of the background mask of nilearn (opening and connected components): different data files
+config["is_fast_crop"] = False
+# if set, the decoded (and resliced) images are cached in this directory as uncompressed arrays, so that the data
+# file variants built from the same images decode each file once. Entries are evicted beyond image_cache_gb.
+config["image_cache_dir"] = None
+config["image_cache_gb"] = 50
+
 
 config["labels"] = (1, 2, 4)  # the label numbers on the input image
 # config["labels"] = (0, 1, 2, 4)  # the label numbers on the input image
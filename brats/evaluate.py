@@ -6,6 +6,7 @@ from unet3d.utils.path_utils import get_training_h5_paths
 from unet3d.utils.path_utils import get_project_dir
 import unet3d.utils.args_utils as get_args
 from unet3d.prediction import run_validation_cases
+from unet3d.evaluation import evaluate_prediction_folder, get_project_regions, get_scores_from_df
 import matplotlib.pyplot as plt
 import numpy as np
 import nibabel as nib
@@ -71,11 +72,6 @@ def get_model_info_header(challenge, year, image_shape, is_bias_correction,
 
 def evaluate(args):
 
-    header = ("dice_WholeTumor", "dice_TumorCore", "dice_EnhancingTumor")
-    masking_functions = (get_whole_tumor_mask,
-                         get_tumor_core_mask,
-                         get_enhancing_tumor_mask)
-
     data_path, trainids_path, validids_path, testids_path, model_path = get_training_h5_paths(
         brats_dir=BRATS_DIR, args=args)
 
@@ -111,28 +107,7 @@ def evaluate(args):
             get_filename_without_extension(config["model_file"]) + ".csv"
 
         if os.path.exists(config["prediction_df_csv"]):
-            df = pd.read_csv(config["prediction_df_csv"])
-            df1 = df.dice_WholeTumor.T._values
-            df2 = df.dice_TumorCore.T._values
-            df3 = df.dice_EnhancingTumor.T._values
-            rows = np.zeros((df1.size, 3))
-            rows[:, 0] = df1
-            rows[:, 1] = df2
-            rows[:, 2] = df3
-
-            subject_ids = list()
-            for case_folder in glob.glob(os.path.join(config["prediction_folder"], "*")):
-                if not os.path.isdir(case_folder):
-                    continue
-                subject_ids.append(os.path.basename(case_folder))
-
-            df = pd.DataFrame.from_records(
-                rows, columns=header, index=subject_ids)
-
-            scores = dict()
-            for index, score in enumerate(df.columns):
-                values = df.values.T[index]
-                scores[score] = values[np.isnan(values) == False]
+            df = pd.read_csv(config["prediction_df_csv"], index_col=0)
 
         else:
 
@@ -144,31 +119,13 @@ def evaluate(args):
             print("csv file:", config["prediction_df_csv"])
             print("-"*60)
 
-            rows = list()
-            subject_ids = list()
-            for case_folder in glob.glob(os.path.join(config["prediction_folder"], "*")):
-                if not os.path.isdir(case_folder):
-                    continue
-                subject_ids.append(os.path.basename(case_folder))
-                truth_file = os.path.join(case_folder, "truth.nii.gz")
-                truth_image = nib.load(truth_file)
-                truth = truth_image.get_data()
-                prediction_file = os.path.join(
-                    case_folder, "prediction.nii.gz")
-                prediction_image = nib.load(prediction_file)
-                prediction = prediction_image.get_data()
-                score_case = get_score(truth, prediction, masking_functions)
-                rows.append(score_case)
-
-            df = pd.DataFrame.from_records(
-                rows, columns=header, index=subject_ids)
-            df.to_csv(config["prediction_df_csv"])
-
-            scores = dict()
-            for index, score in enumerate(df.columns):
-                values = df.values.T[index]
-                scores[score] = values[np.isnan(values) == False]
+            df = evaluate_prediction_folder(config["prediction_folder"], config["prediction_df_csv"],
+                                            regions=get_project_regions("brats"),
+                                            metrics=config["evaluation_metrics"],
+                                            n_workers=config["n_workers_evaluate"],
+                                            tolerance=config["surface_dice_tolerance"])
 
+        scores = get_scores_from_df(df)
         return scores, model_path
 
 
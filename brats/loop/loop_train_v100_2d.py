@@ -1,4 +1,4 @@
-from brats.loop.loop_utils import run
+from brats.loop.loop_utils import run, get_scheduler
 import unet3d.utils.args_utils as get_args
 from unet3d.utils.path_utils import get_model_h5_filename
 import random
@@ -67,8 +67,10 @@ random.shuffle(combined)
 
 model_list[:], cmd_list = zip(*combined)
 
+scheduler = get_scheduler(config)
 for i in range(len(model_list)):
     model_filename = model_list[i]
     cmd = cmd_list[i]
     run(model_filename=model_filename, cmd=cmd, config=config,
-        model_path="database/model", mode_run=2)
+        model_path="database/model", mode_run=2, scheduler=scheduler)
+scheduler.run()
@@ -0,0 +1,163 @@
+from brats.loop.loop_utils import get_scheduler, get_brats_dir
+from unet3d.utils.scheduler import Job
+import unet3d.utils.args_utils as get_args
+from unet3d.utils.path_utils import get_training_h5_paths
+from unet3d.utils.path_utils import get_training_h5_filename
+from unet3d.utils.path_utils import get_model_h5_filename
+from unet3d.utils.path_utils import get_filename_without_extension
+from brats.config import config, config_unet
+import argparse
+import json
+import shlex
+import os
+
+config.update(config_unet)
+
+list_25d_model = ["160-192-3", "160-192-5",
+                  "160-192-7", "160-192-9", "160-192-11"]
+list_2d_model = ["160-192-1"]
+list_3d_model = ["160-192-128"]
+
+
+def get_data_type_generator(model_name):
+    if "casnet" in model_name:
+        return "cascaded"
+    elif "sepnet" in model_name:
+        return "separated"
+    return "combined"
+
+
+def get_sweep_args():
+    """
+    Argument matrix of the sweep: one args per trained model, as in loop_train_v100.py
+    """
+    args_list = list()
+    for patch_shape in list_25d_model + list_2d_model + list_3d_model:
+        for is_augment in ["1"]:
+            for model_name in ["segnet"]:
+                for is_denoise in ["0"]:
+                    for is_normalize in ["z"]:
+                        for is_hist_match in ["0"]:
+                            for loss in ["weighted"]:
+                                if is_normalize == "z" and is_hist_match == "1":
+                                    continue
+                                if patch_shape in list_2d_model:
+                                    args = get_args.train2d()
+                                    args.model_dim = 2
+                                    args.batch_size = 64
+                                elif patch_shape in list_25d_model:
+                                    args = get_args.train25d()
+                                    args.model_dim = 25
+                                    args.batch_size = 64
+                                else:
+                                    args = get_args.train()
+                                    args.model_dim = 3
+                                    args.batch_size = 1
+                                args.patch_shape = patch_shape
+                                args.is_test = "0"
+                                args.is_augment = is_augment
+                                args.model = model_name
+                                args.is_denoise = is_denoise
+                                args.is_normalize = is_normalize
+                                args.is_hist_match = is_hist_match
+                                args.loss = loss
+                                args.overwrite = False
+                                args.data_type_generator = get_data_type_generator(model_name)
+                                args_list.append(args)
+    return args_list
+
+
+def get_stage_cmd(stage, args):
+    return "python -m brats.loop.sweep -s {} -a {}".format(stage, shlex.quote(json.dumps(vars(args))))
+
+
+def get_train_cmd(args):
+    if args.model_dim == 2:
+        task = "brats/train2d"
+    elif args.model_dim == 25:
+        task = "brats/train25d"
+    else:
+        task = "brats/train"
+    return "python {}.py -t \"{}\" -o \"0\" -n \"{}\" -de \"{}\" -hi \"{}\" -ps \"{}\" -l \"{}\" -m \"{}\" -ba {} -au {} -du {}".format(
+        task,
+        args.is_test,
+        args.is_normalize,
+        args.is_denoise,
+        args.is_hist_match,
+        args.patch_shape,
+        args.loss,
+        args.model,
+        args.batch_size,
+        args.is_augment,
+        args.depth_unet
+    )
+
+
+def add_sweep_jobs(scheduler, args_list):
+    """
+    Adds the prepare -> train -> predict -> evaluate jobs of every args to the scheduler. Jobs are named after the
+    artifact they write (get_training_h5_filename, get_model_h5_filename), so models sharing the same preprocessed
+    data file depend on a single prepare job.
+    """
+    brats_dir = get_brats_dir(config)
+    n_cpu = config["scheduler_job_n_cpu"]
+    mem_gb = config["scheduler_job_mem_gb"]
+    prepare_names = set()
+    for args in args_list:
+        data_path, _, _, _, model_path = get_training_h5_paths(brats_dir=brats_dir, args=args)
+        model_name = get_filename_without_extension(get_model_h5_filename("model", args))
+        prepare_name = "prepare_{}".format(get_filename_without_extension(get_training_h5_filename("data", args)))
+        train_name = "train_{}".format(model_name)
+        predict_name = "predict_{}".format(model_name)
+        evaluate_name = "evaluate_{}".format(model_name)
+        csv_path = os.path.join(brats_dir, "database/prediction/csv", model_name + ".csv")
+
+        if prepare_name not in prepare_names:
+            prepare_names.add(prepare_name)
+            scheduler.add(Job(prepare_name, get_stage_cmd("prepare", args), output_path=data_path,
+                              n_cpu=n_cpu, mem_gb=mem_gb))
+        scheduler.add(Job(train_name, get_train_cmd(args), output_path=model_path,
+                          n_cpu=n_cpu, mem_gb=mem_gb, dependencies=[prepare_name]))
+        scheduler.add(Job(predict_name, get_stage_cmd("predict", args),
+                          n_cpu=n_cpu, mem_gb=mem_gb, dependencies=[train_name]))
+        scheduler.add(Job(evaluate_name, get_stage_cmd("evaluate", args), output_path=csv_path,
+                          n_cpu=config["n_workers_evaluate"], dependencies=[predict_name]))
+
+
+def run_stage(stage, args):
+    if stage == "prepare":
+        from brats.prepare_data import prepare_data
+        prepare_data(args)
+    elif stage == "predict":
+        from brats.predict import predict
+        predict(args)
+    elif stage == "evaluate":
+        from brats.evaluate import evaluate
+        scores, _ = evaluate(args)
+        if scores is None:
+            raise ValueError("no prediction to evaluate for {}".format(get_model_h5_filename("model", args)))
+    else:
+        raise ValueError("stage {} NotImplemented error. Please check".format(stage))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--stage', type=str, default=None,
+                        choices=["prepare", "predict", "evaluate"],
+                        help="run a single stage with the json arguments given by -a (used by the sweep jobs)")
+    parser.add_argument('-a', '--args', type=str, default=None)
+    stage_args = parser.parse_args()
+
+    if stage_args.stage is not None:
+        run_stage(stage_args.stage, argparse.Namespace(**json.loads(stage_args.args)))
+        return
+
+    scheduler = get_scheduler(config)
+    add_sweep_jobs(scheduler, get_sweep_args())
+    status = scheduler.run()
+    for name in sorted(status):
+        print("{}: {}".format(name, status[name]))
+
+
+if __name__ == "__main__":
+    main()
@@ -80,8 +80,12 @@ def predict(args, prediction_dir="desktop"):
                 raise ValueError(
                     "can not find model {}. Please check".format(config["model_file"]))
 
+            kwargs = dict(compress_level=config["prediction_compress_level"],
+                          probability_dtype=config["prediction_probability_dtype"],
+                          n_writer_threads=config["n_writer_threads"])
             if args.model_dim == 3:
                 from unet3d.prediction import run_validation_cases
+                kwargs["is_foreground_roi"] = config["is_foreground_roi"]
             elif args.model_dim == 25:
                 from unet25d.prediction import run_validation_cases
             elif args.model_dim == 2:
@@ -90,14 +94,28 @@ def predict(args, prediction_dir="desktop"):
                 raise ValueError(
                     "dim {} NotImplemented error. Please check".format(args.model_dim))
 
+            model_file = config["model_file"]
+            if config["is_inference_model"]:
+                from unet3d.export import export_inference_model, get_inference_model_file
+                model_file = get_inference_model_file(config["model_file"])
+                if not os.path.exists(model_file):
+                    export_inference_model(config["model_file"], model_file)
+            if config["data_format"] == "channels_last":
+                from unet3d.data_format import convert_model_file, get_channels_last_file
+                channels_first_file = model_file
+                model_file = get_channels_last_file(channels_first_file)
+                if not os.path.exists(model_file):
+                    convert_model_file(channels_first_file, model_file)
+
             run_validation_cases(validation_keys_file=config["testing_file"],
-                                 model_file=config["model_file"],
+                                 model_file=model_file,
                                  training_modalities=config["training_modalities"],
                                  labels=config["labels"],
                                  hdf5_file=config["data_file"],
                                  output_label_map=True,
                                  output_dir=config["prediction_folder"],
-                                 data_type_generator=args.data_type_generator)
+                                 data_type_generator=args.data_type_generator,
+                                 **kwargs)
 
 
 def main():
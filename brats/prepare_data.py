@@ -9,6 +9,7 @@ from brats.config import config
 from unet3d.utils.path_utils import get_project_dir, get_h5_training_dir
 from unet3d.utils.path_utils import get_training_h5_filename, get_shape_string, get_shape_from_string
 from unet3d.utils.utils import str2bool
+from unet3d.utils.image_cache import get_image_cache
 
 import unet3d.utils.args_utils as get_args
 
@@ -70,6 +71,7 @@ def prepare_data(args):
 
     if args.overwrite or not os.path.exists(data_file_path):
         training_files = fetch_training_data_files(dataset)
+        image_cache = get_image_cache(config["image_cache_dir"], config["image_cache_gb"])
         write_data_to_file(training_files, data_file_path,
                            config=config,
                            image_shape=get_shape_from_string(args.image_shape),
@@ -78,7 +80,15 @@ def prepare_data(args):
                            is_normalize=args.is_normalize,
                            is_hist_match=args.is_hist_match,
                            dataset=dataset,
-                           is_denoise=args.is_denoise)
+                           is_denoise=args.is_denoise,
+                           data_dtype=config["data_dtype"],
+                           is_crop_foreground=config["is_crop_foreground"],
+                           crop_margin=config["crop_margin"],
+                           crop_threshold=config["crop_threshold"],
+                           is_fast_crop=config["is_fast_crop"],
+                           image_cache=image_cache)
+        if image_cache is not None:
+            image_cache.report()
 
 
 def main():
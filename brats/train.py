@@ -8,10 +8,14 @@ from unet3d.utils.path_utils import get_training_h5_paths
 from unet3d.utils.path_utils import get_shape_from_string
 from unet3d.utils.path_utils import get_project_dir
 from unet3d.training import train_model
+from unet3d.utils.timing import get_timing_file
+from unet3d.data_format import set_model_data_format
+from unet3d.memory import get_batch_size, get_memory_budget
 from unet3d.model import *
 # from unet3d.generator import get_training_and_validation_and_testing_generators
 from brats.generator import get_training_and_validation_and_testing_generators
 from unet3d.data import open_data_file
+from unet3d.data_memmap import convert_h5_to_memmap
 
 from brats.proposed3d import casnet_v6, casnet_v10, casnet_v11
 
@@ -58,35 +62,12 @@ def train(args):
     if args.overwrite or not os.path.exists(data_path):
         prepare_data(args)
 
+    if config["is_memmap"]:
+        config["data_file"] = convert_h5_to_memmap(config["data_file"])
+
     print_section("Open file")
     data_file_opened = open_data_file(config["data_file"])
 
-    print_section("get training and testing generators")
-    train_generator, validation_generator, n_train_steps, n_validation_steps = get_training_and_validation_and_testing_generators(
-        data_file_opened,
-        batch_size=args.batch_size,
-        data_split=config["validation_split"],
-        overwrite=args.overwrite,
-        validation_keys_file=config["validation_file"],
-        training_keys_file=config["training_file"],
-        testing_keys_file=config["testing_file"],
-        n_labels=config["n_labels"],
-        labels=config["labels"],
-        patch_shape=config["patch_shape"],
-        validation_batch_size=args.batch_size,
-        validation_patch_overlap=config["validation_patch_overlap"],
-        training_patch_start_offset=config["training_patch_start_offset"],
-        augment_flipud=config["augment_flipud"],
-        augment_fliplr=config["augment_fliplr"],
-        augment_elastic=config["augment_elastic"],
-        augment_rotation=config["augment_rotation"],
-        augment_shift=config["augment_shift"],
-        augment_shear=config["augment_shear"],
-        augment_zoom=config["augment_zoom"],
-        n_augment=config["n_augment"],
-        skip_blank=config["skip_blank"],
-        data_type_generator=config["data_type_generator"])
-
     print("-"*60)
     print("# Load or init model")
     print("-"*60)
@@ -164,8 +145,43 @@ def train(args):
         else:
             raise ValueError("Model is NotImplemented. Please check")
 
+    model = set_model_data_format(model, config["data_format"])
+    if args.batch_size == 0:
+        args.batch_size = get_batch_size(model, memory_budget=get_memory_budget(config["memory_budget_gb"]))
+        print(">> batch size {} selected for the memory budget".format(args.batch_size))
     model.summary()
 
+    print_section("get training and testing generators")
+    train_generator, validation_generator, n_train_steps, n_validation_steps = get_training_and_validation_and_testing_generators(
+        data_file_opened,
+        batch_size=args.batch_size,
+        data_split=config["validation_split"],
+        overwrite=args.overwrite,
+        validation_keys_file=config["validation_file"],
+        training_keys_file=config["training_file"],
+        testing_keys_file=config["testing_file"],
+        n_labels=config["n_labels"],
+        labels=config["labels"],
+        patch_shape=config["patch_shape"],
+        validation_batch_size=args.batch_size,
+        validation_patch_overlap=config["validation_patch_overlap"],
+        training_patch_start_offset=config["training_patch_start_offset"],
+        augment_flipud=config["augment_flipud"],
+        augment_fliplr=config["augment_fliplr"],
+        augment_elastic=config["augment_elastic"],
+        augment_rotation=config["augment_rotation"],
+        augment_shift=config["augment_shift"],
+        augment_shear=config["augment_shear"],
+        augment_zoom=config["augment_zoom"],
+        n_augment=config["n_augment"],
+        skip_blank=config["skip_blank"],
+        data_type_generator=config["data_type_generator"],
+        subject_cache_mb=config["subject_cache_mb"],
+        locality_window=config["locality_window"],
+        is_foreground_sampling=config["is_foreground_sampling"],
+        validation_cache_mb=config["validation_cache_mb"],
+        validation_cache_dir=config["validation_cache_dir"])
+
     print("-"*60)
     print("# start training")
     print("-"*60)
@@ -199,7 +215,11 @@ def train(args):
                 learning_rate_drop=config["learning_rate_drop"],
                 learning_rate_patience=config["patience"],
                 early_stopping_patience=config["early_stop"],
-                n_epochs=config["n_epochs"]
+                n_epochs=config["n_epochs"],
+                is_async_checkpoint=config["is_async_checkpoint"],
+                is_checkpoint_weights_only=config["is_checkpoint_weights_only"],
+                n_last_checkpoints=config["n_last_checkpoints"],
+                timing_file=get_timing_file(config["model_file"]) if config["is_log_timing"] else None
                 )
 
     if args.is_test == "0":
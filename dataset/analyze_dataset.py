@@ -130,17 +130,19 @@ def analyze_one_folder(challenge, data_folder, dataset, config, overwrite=False)
             df["shape"][i] = get_shape(volume)
             df["shape_x"][i], df["shape_y"][i], df["shape_z"][i] = get_shape(
                 volume)[0], get_shape(volume)[1], get_shape(volume)[2]
-            df["bounding_box"][i] = get_bounding_box(volume)
-            df["bounding_box_x1"][i] = get_bounding_box(volume)[0]
-            df["bounding_box_x2"][i] = get_bounding_box(volume)[1]
-            df["bounding_box_y1"][i] = get_bounding_box(volume)[2]
-            df["bounding_box_y2"][i] = get_bounding_box(volume)[3]
-            df["bounding_box_z1"][i] = get_bounding_box(volume)[4]
-            df["bounding_box_z2"][i] = get_bounding_box(volume)[5]
-            df["size_bounding_box"][i] = get_size_bounding_box(volume)
-            df["size_bounding_box_x"][i] = get_size_bounding_box(volume)[0]
-            df["size_bounding_box_y"][i] = get_size_bounding_box(volume)[1]
-            df["size_bounding_box_z"][i] = get_size_bounding_box(volume)[2]
+            bounding_box = get_bounding_box(volume)
+            size_bounding_box = get_size_bounding_box(volume, bounding_box)
+            df["bounding_box"][i] = bounding_box
+            df["bounding_box_x1"][i] = bounding_box[0]
+            df["bounding_box_x2"][i] = bounding_box[1]
+            df["bounding_box_y1"][i] = bounding_box[2]
+            df["bounding_box_y2"][i] = bounding_box[3]
+            df["bounding_box_z1"][i] = bounding_box[4]
+            df["bounding_box_z2"][i] = bounding_box[5]
+            df["size_bounding_box"][i] = size_bounding_box
+            df["size_bounding_box_x"][i] = size_bounding_box[0]
+            df["size_bounding_box_y"][i] = size_bounding_box[1]
+            df["size_bounding_box_z"][i] = size_bounding_box[2]
             df["n_non_zeros_pixel"][i] = get_non_zeros_pixel(volume)
             df["n_zeros_pixel"][i] = get_zeros_pixel(volume)
             df["mean_non_zeros_pixel"][i] = compute_mean_non_zeros_pixel(
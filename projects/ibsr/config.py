@@ -27,6 +27,16 @@ config["dataset_folder"] = "projects/ibsr/database"
 config["template_data_folder"] = "database/data_train"
 config["template_folder"] = "IBSR_01"
 
+# local scheduler of the loop scripts: slots of the machine (None: all cpus / all memory / all visible gpus) and
+# reservation per job. Each job runs on its own scheduler_job_n_gpu gpus, so the jobs run one per gpu by default
+# (set scheduler_job_n_gpu to the number of gpus for multi-gpu models); without gpu, the cpu slots bound the jobs
+config["scheduler_n_cpu"] = None
+config["scheduler_mem_gb"] = None
+config["scheduler_max_jobs"] = None  # None: no limit other than the slots
+config["scheduler_job_n_cpu"] = 4
+config["scheduler_job_mem_gb"] = 16
+config["scheduler_job_n_gpu"] = 1
+
 # config_unet["image_shape"] = (240, 240, 155)  # This determines what shape the images will be cropped/resampled to.
 # This determines what shape the images will be cropped/resampled to.
 # config["image_shape"] = (160, 192, 128)
@@ -7,6 +7,8 @@ import glob
 import os
 import warnings
 import shutil
+import argparse
+from multiprocessing import Pool, cpu_count
 import SimpleITK as sitk
 import numpy as np
 from nipype.interfaces.ants import N4BiasFieldCorrection
@@ -55,16 +57,23 @@ def window_intensities(in_file, out_file, min_percent=1, max_percent=99):
     return os.path.abspath(out_file)
 
 
-def correct_bias(in_file, out_file, image_type=sitk.sitkFloat64):
+def correct_bias(in_file, out_file, image_type=sitk.sitkFloat64, n_threads=None, shrink_factor=1):
     """
     Corrects the bias using ANTs N4BiasFieldCorrection. If this fails, will then attempt to correct bias using SimpleITK
     :param in_file: input file path
     :param out_file: output file path
+    :param n_threads: number of threads of the correction. None lets ANTs / SimpleITK use every core.
+    :param shrink_factor: the bias field is fitted on the image shrunk by this factor, which is faster and approximate,
+    then applied at full resolution. 1 fits it at full resolution.
     :return: file path to the bias corrected image
     """
     correct = N4BiasFieldCorrection()
     correct.inputs.input_image = in_file
     correct.inputs.output_image = out_file
+    if n_threads:
+        correct.inputs.num_threads = n_threads
+    if shrink_factor > 1:
+        correct.inputs.shrink_factor = shrink_factor
     try:
         done = correct.run()
         return done.outputs.output_image
@@ -73,10 +82,28 @@ def correct_bias(in_file, out_file, image_type=sitk.sitkFloat64):
                                      "Will try using SimpleITK for bias field correction"
                                      " which will take much longer. To fix this problem, add N4BiasFieldCorrection"
                                      " to your PATH system variable. (example: EXPORT PATH=${PATH}:/path/to/ants/bin)"))
-        input_image = sitk.ReadImage(in_file, image_type)
-        output_image = sitk.N4BiasFieldCorrection(input_image, input_image > 0)
-        sitk.WriteImage(output_image, out_file)
-        return os.path.abspath(out_file)
+        return sitk_correct_bias(in_file, out_file, image_type=image_type, n_threads=n_threads,
+                                 shrink_factor=shrink_factor)
+
+
+def sitk_correct_bias(in_file, out_file, image_type=sitk.sitkFloat64, n_threads=None, shrink_factor=1):
+    """
+    Corrects the bias using SimpleITK, see correct_bias.
+    """
+    input_image = sitk.ReadImage(in_file, image_type)
+    mask = input_image > 0
+    corrector = sitk.N4BiasFieldCorrectionImageFilter()
+    if n_threads:
+        corrector.SetNumberOfThreads(n_threads)
+    if shrink_factor > 1:
+        shrink = [int(shrink_factor)] * input_image.GetDimension()
+        corrector.Execute(sitk.Shrink(input_image, shrink), sitk.Shrink(mask, shrink))
+        log_bias_field = corrector.GetLogBiasFieldAsImage(input_image)
+        output_image = input_image / sitk.Cast(sitk.Exp(log_bias_field), input_image.GetPixelID())
+    else:
+        output_image = corrector.Execute(input_image, mask)
+    sitk.WriteImage(output_image, out_file)
+    return os.path.abspath(out_file)
 
 
 def rescale(in_file, out_file, minimum=0, maximum=20000):
@@ -107,15 +134,20 @@ def check_origin(in_file, in_file2):
         sitk.WriteImage(image, in_file)
 
 
-def normalize_image(in_file, out_file, bias_correction=True):
+def normalize_image(in_file, out_file, bias_correction=True, n_threads=None, shrink_factor=1):
     if bias_correction:
-        correct_bias(in_file, out_file)
+        correct_bias(in_file, out_file, n_threads=n_threads, shrink_factor=shrink_factor)
     else:
         shutil.copy(in_file, out_file)
     return out_file
 
 
-def convert_brats_folder(in_folder, out_folder, truth_name='seg', no_bias_correction_modalities=None):
+def get_subject_tasks(in_folder, out_folder, truth_name='seg', no_bias_correction_modalities=None):
+    """
+    Preprocessing of a subject folder, one task per output image: ("normalize", image file, out file, bias
+    correction) for each modality, then ("truth", truth file, out file, reference image) for the truth.
+    """
+    tasks = list()
     for name in config["all_modalities"]:
         try:
             image_file = get_image(in_folder, name)
@@ -128,7 +160,7 @@ def convert_brats_folder(in_folder, out_folder, truth_name='seg', no_bias_correc
 
         out_file = os.path.abspath(os.path.join(out_folder, name + ".nii.gz"))
         perform_bias_correction = no_bias_correction_modalities and name not in no_bias_correction_modalities
-        normalize_image(image_file, out_file, bias_correction=perform_bias_correction)
+        tasks.append(("normalize", image_file, out_file, perform_bias_correction))
     # copy the truth file
     try:
         truth_file = get_image(in_folder, truth_name)
@@ -136,35 +168,137 @@ def convert_brats_folder(in_folder, out_folder, truth_name='seg', no_bias_correc
         truth_file = get_image(in_folder, truth_name.split("_")[0])
 
     out_file = os.path.abspath(os.path.join(out_folder, "truth.nii.gz"))
-    shutil.copy(truth_file, out_file)
-    check_origin(out_file, get_image(in_folder, config["all_modalities"][0]))
+    tasks.append(("truth", truth_file, out_file, get_image(in_folder, config["all_modalities"][0])))
+    return tasks
+
+
+def run_task(task, n_threads=None, shrink_factor=1):
+    """
+    Runs a task of get_subject_tasks. The output is written under a temporary name and renamed once complete, so an
+    interrupted task never leaves a partial output behind.
+    :return: output file
+    """
+    kind, in_file, out_file, argument = task
+    part_file = append_basename(out_file, ".part")
+    if kind == "truth":
+        shutil.copy(in_file, part_file)
+        check_origin(part_file, argument)
+    else:
+        normalize_image(in_file, part_file, bias_correction=argument, n_threads=n_threads,
+                        shrink_factor=shrink_factor)
+    os.rename(part_file, out_file)
+    return out_file
+
+
+def _run_task_star(args):
+    return run_task(*args)
+
+
+def read_image_size(in_file):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(in_file)
+    reader.ReadImageInformation()
+    return reader.GetSize()
 
 
-def convert_brats_data(brats_folder, out_folder, overwrite=False, no_bias_correction_modalities=("flair",)):
+def is_complete_output(out_file, in_file):
+    """
+    :return: True if out_file exists, its header can be read and its size is the size of in_file
+    """
+    if not os.path.exists(out_file):
+        return False
+    try:
+        return read_image_size(out_file) == read_image_size(in_file)
+    except RuntimeError:
+        return False
+
+
+def set_number_of_threads(n_threads):
+    """
+    Caps the threads of the ITK filters (SimpleITK and ANTs) started by this process.
+    """
+    if n_threads:
+        os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(n_threads)
+        os.environ["OMP_NUM_THREADS"] = str(n_threads)
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(n_threads)
+
+
+def convert_brats_folder(in_folder, out_folder, truth_name='seg', no_bias_correction_modalities=None,
+                         n_threads=None, shrink_factor=1):
+    for task in get_subject_tasks(in_folder, out_folder, truth_name=truth_name,
+                                  no_bias_correction_modalities=no_bias_correction_modalities):
+        run_task(task, n_threads=n_threads, shrink_factor=shrink_factor)
+
+
+def convert_brats_data(brats_folder, out_folder, overwrite=False, no_bias_correction_modalities=("flair",),
+                       n_workers=1, n_threads=None, shrink_factor=1):
     """
     Preprocesses the BRATS data and writes it to a given output folder. Assumes the original folder structure.
     :param brats_folder: folder containing the original brats data
     :param out_folder: output folder to which the preprocessed data will be written
-    :param overwrite: set to True in order to redo all the preprocessing
+    :param overwrite: set to True in order to redo all the preprocessing. Otherwise the outputs that are complete
+    (see is_complete_output) are skipped, so an interrupted run resumes where it stopped.
     :param no_bias_correction_modalities: performing bias correction could reduce the signal of certain modalities. If
     concerned about a reduction in signal for a specific modality, specify by including the given modality in a list
     or tuple.
+    :param n_workers: number of processes the images of all the subjects are distributed over.
+    :param n_threads: threads of each bias correction. None shares the cores between the workers.
+    :param shrink_factor: shrink factor of the bias correction, see correct_bias.
     :return:
     """
     print(glob.glob(os.path.join(brats_folder, "*", "*")))
     print(os.path.join(brats_folder, "*", "*"))
+    tasks = list()
+    n_skipped = 0
     for subject_folder in glob.glob(os.path.join(brats_folder, "*", "*")):
         print ("processing ", subject_folder)
         if os.path.isdir(subject_folder):
             subject = os.path.basename(subject_folder)
             new_subject_folder = os.path.join(out_folder, os.path.basename(os.path.dirname(subject_folder)),
                                               subject)
-            if not os.path.exists(new_subject_folder) or overwrite:
-                if not os.path.exists(new_subject_folder):
-                    os.makedirs(new_subject_folder)
-                convert_brats_folder(subject_folder, new_subject_folder,
-                                     no_bias_correction_modalities=no_bias_correction_modalities)
+            if not os.path.exists(new_subject_folder):
+                os.makedirs(new_subject_folder)
+            for task in get_subject_tasks(subject_folder, new_subject_folder,
+                                          no_bias_correction_modalities=no_bias_correction_modalities):
+                if not overwrite and is_complete_output(task[2], task[1]):
+                    n_skipped += 1
+                else:
+                    tasks.append(task)
+    print(">> {} images to preprocess, {} complete images skipped".format(len(tasks), n_skipped))
+
+    if n_threads is None and n_workers > 1:
+        n_threads = max(1, cpu_count() // n_workers)
+    tasks = [(task, n_threads, shrink_factor) for task in tasks]
+    if n_workers > 1 and len(tasks) > 1:
+        pool = Pool(processes=min(n_workers, len(tasks)), initializer=set_number_of_threads, initargs=(n_threads,))
+        results = pool.imap_unordered(_run_task_star, tasks)
+    else:
+        set_number_of_threads(n_threads)
+        pool = None
+        results = map(_run_task_star, tasks)
+    try:
+        for i, out_file in enumerate(results):
+            print(">> preprocessed {} ({}/{})".format(out_file, i + 1, len(tasks)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bias correction and conversion of the brats data")
+    parser.add_argument('-i', '--brats_folder', type=str, default=os.path.join("data", "original"))
+    parser.add_argument('-o', '--out_folder', type=str, default=os.path.join("data", "preprocessed"))
+    parser.add_argument('-w', '--n_workers', type=int, default=1, help="number of processes")
+    parser.add_argument('-t', '--n_threads', type=int, default=None,
+                        help="threads of each bias correction, default shares the cores between the processes")
+    parser.add_argument('-s', '--shrink_factor', type=int, default=1,
+                        help="shrink factor of the bias correction, > 1 is faster and approximate")
+    parser.add_argument('-ow', '--overwrite', type=int, default=0, choices=[0, 1])
+    args = parser.parse_args()
+    convert_brats_data(args.brats_folder, args.out_folder, overwrite=bool(args.overwrite),
+                       n_workers=args.n_workers, n_threads=args.n_threads, shrink_factor=args.shrink_factor)
 
 
 if __name__ == "__main__":
-    convert_brats_data("data\\original", "data\\preprocessed")
\ No newline at end of file
+    main()
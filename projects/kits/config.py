@@ -27,7 +27,31 @@ config["dataset_folder"] = "projects/kits/database"
 config["template_data_folder"] = "database/data_train"
 config["template_folder"] = "case_00000"
 
+# local scheduler of the loop scripts: slots of the machine (None: all cpus / all memory / all visible gpus) and
+# reservation per job. Each job runs on its own scheduler_job_n_gpu gpus, so the jobs run one per gpu by default
+# (set scheduler_job_n_gpu to the number of gpus for multi-gpu models); without gpu, the cpu slots bound the jobs
+config["scheduler_n_cpu"] = None
+config["scheduler_mem_gb"] = None
+config["scheduler_max_jobs"] = None  # None: no limit other than the slots
+config["scheduler_job_n_cpu"] = 4
+config["scheduler_job_mem_gb"] = 16
+config["scheduler_job_n_gpu"] = 1
+
 config["image_shape"] = (144,144,144)
+# if True, each subject is stored cropped to its foreground bounding box at its native resolution instead of being
+# resized to image_shape (use a new data file). Patches are sampled within each subject's own shape.
+config["is_crop_foreground"] = False
+config["crop_margin"] = 8
+# ct background is not 0: the body is the voxels above this value
+config["crop_threshold"] = -500
+# if True, crop=1 crops the resized subjects to the body (above crop_threshold) instead of nilearn's background mask
+config["is_fast_crop"] = False
+# if set, the decoded (and resliced) images are cached in this directory as uncompressed arrays, so that the data
+# file variants built from the same images decode each file once. Entries are evicted beyond image_cache_gb.
+config["image_cache_dir"] = None
+config["image_cache_gb"] = 50
+# number of processes resampling the subjects in projects/kits/preprocess.py
+config["n_workers_preprocess"] = 4
 
 config["labels"] = (1, 2)  # the label numbers on the input image
 config["n_labels"] = len(config["labels"])
@@ -1,56 +1,47 @@
 from unet3d.utils.path_utils import get_project_dir
+from unet3d.utils.scheduler import Job, Scheduler
 import os
 
 
-def run(model_filename, cmd, config, model_path="database/model/finetune", mode_run=2):
+def get_brats_dir(config):
+    CURRENT_WORKING_DIR = os.path.realpath(__file__)
+    PROJECT_DIR = get_project_dir(CURRENT_WORKING_DIR, config["project_name"])
+    return os.path.join(PROJECT_DIR, config["brats_folder"])
+
+
+def get_scheduler(config):
+    """
+    Scheduler shared by the loop scripts of the project. Its state, lock files and job logs are in loop/scheduler.
+    """
+    return Scheduler(os.path.join(get_brats_dir(config), "loop/scheduler"),
+                     n_cpu=config["scheduler_n_cpu"],
+                     mem_gb=config["scheduler_mem_gb"],
+                     max_jobs=config["scheduler_max_jobs"])
+
+
+def run(model_filename, cmd, config, model_path="database/model/finetune", mode_run=2, scheduler=None):
 
     # mode_run: 0 - just run
     # mode_run: 1 - run if file not exists
     # mode_run: 2 - run if file not exists and no gpu is running
+    # scheduler: if given, the job is only queued and runs with scheduler.run(); otherwise it runs now
 
-    CURRENT_WORKING_DIR = os.path.realpath(__file__)
-    PROJECT_DIR = get_project_dir(CURRENT_WORKING_DIR, config["project_name"])
-    BRATS_DIR = os.path.join(PROJECT_DIR, config["brats_folder"])
-    DATASET_DIR = os.path.join(PROJECT_DIR, config["dataset_folder"])
-
-    def check_is_running(model_filename):
-        path = os.path.join(BRATS_DIR, "loop/running.txt")
-        is_running = False
-        if not os.path.exists(path):
-            f = open(path, "w")
-            f.write("{}\n".format(model_filename))
-            f.close()
-        else:
-            f = open(path, "r")
-            lines = f.readlines()
-            f.close()
-            for line in lines:
-                if model_filename in line:
-                    is_running = True
-            if not is_running:
-                f = open(path, "a+")
-                f.write("{}\n".format(model_filename))
-                f.close()
-        return is_running
+    BRATS_DIR = get_brats_dir(config)
 
     print("="*120)
     model_path = os.path.join(BRATS_DIR, model_path, model_filename)
 
-    is_run = False
-    if mode_run == 0:
-        is_run = True
-    if mode_run == 1 and not os.path.exists(model_path):
-        is_run = True
-    if mode_run == 2 and not os.path.exists(model_path) and not check_is_running(model_filename):
-        is_run = True
-
-    if is_run:
-        try:
-            print(">> RUNNING:", cmd)
-            from keras import backend as K
-            os.system(cmd)
-            K.clear_session()
-        except:
-            print("something wrong")
+    job = Job(model_filename, cmd,
+              output_path=model_path if mode_run > 0 else None,
+              n_cpu=config["scheduler_job_n_cpu"],
+              mem_gb=config["scheduler_job_mem_gb"],
+              n_gpu=config["scheduler_job_n_gpu"],
+              is_lock=mode_run == 2,
+              is_rerun=mode_run == 0)
+
+    if scheduler is None:
+        scheduler = get_scheduler(config)
+        scheduler.add(job)
+        scheduler.run()
     else:
-        print("{} exists or in training. Will skip!!".format(model_path))
+        scheduler.add(job)
@@ -15,12 +15,13 @@ import argparse
 import nibabel as nib
 import pandas as pd
 import numpy as np
+from multiprocessing import Pool
 
 import unet3d.utils.print_utils as print_utils
 import unet3d.utils.path_utils as path_utils
 import unet3d.utils.args_utils as get_args
 from unet3d.utils.volume import get_spacing, get_shape
-from unet3d.utils.utils import resize, pad, read_image_files
+from unet3d.utils.utils import resize, pad, read_image_files, resize_and_pad
 
 from nilearn.image import reorder_img, new_img_like
 
@@ -41,27 +42,29 @@ def find_scaling_dim(dim_in, spacing, thickness=(2.5, 1, 1)):
     # return (dim_out_x, dim_out_y, dim_out_z)
 
 
-def rescale_and_pad(out_dir, volume, affine, dim_scaling, dim_out=(576, 576, 300), interpolation="linear"):
-    # volume = nib.Nifti1Image(volume, affine)
-    volume = resize(volume, new_shape=dim_scaling, interpolation=interpolation)
+def preprocess_subject(folder, out_dir, dim_out=(576, 576, 300)):
+    """
+    Resamples the imaging (linear) and the segmentation (nearest) of a subject to the spacing of find_scaling_dim,
+    padded to dim_out, each in a single resampling (see unet3d.utils.utils.resize_and_pad).
+    """
+    print_utils.print_processing(folder)
+    volume = nib.load(os.path.join(folder, "imaging.nii.gz"))
+    truth = nib.load(os.path.join(folder, "segmentation.nii.gz"))
 
-    # if interpolation == "linear":
-    #     volume.to_filename(os.path.join(out_dir, "rescale_volume.nii.gz"))
-    # else:
-    #     volume.to_filename(os.path.join(out_dir, "rescale_truth.nii.gz"))
+    dim_scaling = find_scaling_dim(get_shape(volume), spacing=get_spacing(volume))
 
-    volume = pad(volume, new_shape=dim_out, mode="constant",
-                 interpolation=interpolation)
+    resize_and_pad(volume, new_shape=dim_scaling, pad_shape=dim_out,
+                   interpolation="linear").to_filename(os.path.join(out_dir, "imaging.nii.gz"))
+    resize_and_pad(truth, new_shape=dim_scaling, pad_shape=dim_out,
+                   interpolation="nearest").to_filename(os.path.join(out_dir, "segmentation.nii.gz"))
+    return out_dir
 
-    # if interpolation == "linear":
-    #     volume.to_filename(os.path.join(out_dir, "pad_rescale_volume.nii.gz"))
-    # else:
-    #     volume.to_filename(os.path.join(out_dir, "pad_rescale_truth.nii.gz"))
 
-    return volume
+def _preprocess_subject_star(args):
+    return preprocess_subject(*args)
 
 
-def prerocess(data_folder, dataset, config, overwrite=False):
+def prerocess(data_folder, dataset, config, overwrite=False, n_workers=1):
 
     data_dir = path_utils.get_analysis_dir(DATASET_DIR, data_folder)
     print("save to dir", data_dir)
@@ -79,6 +82,7 @@ def prerocess(data_folder, dataset, config, overwrite=False):
     subject_dirs = glob.glob(os.path.join(
         data_dir, "*"))
 
+    tasks = list()
     for i in range(len(subject_dirs)):
         folder = subject_dirs[i]
         # if "case_00073" not in folder:
@@ -90,35 +94,21 @@ def prerocess(data_folder, dataset, config, overwrite=False):
         truth_path_out = os.path.join(out_dir, "segmentation.nii.gz")
         if os.path.exists(volume_path_out) and os.path.exists(truth_path_out):
             continue
-
-        print_utils.print_processing(folder)
-        volume_path = os.path.join(folder, "imaging.nii.gz")
-        truth_path = os.path.join(folder, "segmentation.nii.gz")
-
-        volume = nib.load(volume_path)
-        truth = nib.load(truth_path)
-
-        # volume = reorder_img(volume, resample="linear")
-        # volume.to_filename(os.path.join(out_dir, "reorder_volume.nii.gz"))
-
-        # truth = reorder_img(truth, resample="nearest")
-        # truth.to_filename(os.path.join(out_dir, "reorder_truth.nii.gz"))
-
-        shape = get_shape(volume)
-        spacing = get_spacing(volume)
-        affine = volume.affine
-        # volume = volume.get_fdata()
-        # truth = truth.get_fdata()
-
-        dim_scaling = find_scaling_dim(shape, spacing=spacing)
-
-        volume = rescale_and_pad(
-            out_dir, volume, affine, dim_scaling=dim_scaling, interpolation="linear")
-        truth = rescale_and_pad(
-            out_dir, truth, affine, dim_scaling=dim_scaling, interpolation="nearest")
-
-        volume.to_filename(volume_path_out)
-        truth.to_filename(truth_path_out)
+        tasks.append((folder, out_dir))
+
+    if n_workers > 1 and len(tasks) > 1:
+        pool = Pool(processes=min(n_workers, len(tasks)))
+        results = pool.imap_unordered(_preprocess_subject_star, tasks)
+    else:
+        pool = None
+        results = map(_preprocess_subject_star, tasks)
+    try:
+        for i, out_dir in enumerate(results):
+            print(">> preprocessed {} ({}/{})".format(out_dir, i + 1, len(tasks)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 def main():
@@ -142,7 +132,7 @@ def main():
     print(args)
 
     prerocess(data_folder, dataset,
-              config=config, overwrite=overwrite)
+              config=config, overwrite=overwrite, n_workers=config["n_workers_preprocess"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,343 @@
+"""
+Benchmarks of the data and inference hot paths on synthetic BraTS-like data files, e.g.
+
+    python tests/benchmark.py -o benchmark.json
+    python tests/benchmark.py -o benchmark_new.json -b benchmark.json
+
+The second command compares with a previous run and exits with 1 if a benchmark is slower than the baseline by more
+than the tolerance. Benchmarks whose dependencies are missing (e.g. keras for the predictions) are reported as
+skipped; benchmarks that fail are reported with their error.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import traceback
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from unet3d.data import create_data_file, add_data_to_storage, open_data_file
+from unet3d.utils.path_utils import get_shape_from_string
+from unet3d.utils.timing import get_n_bytes
+
+LABELS = (1, 2, 4)
+
+
+def get_synthetic_subject(image_shape, n_channels, labels=LABELS, seed=0):
+    """
+    Brain-like ellipsoid with noisy intensities and nested tumor regions labelled (from outside to inside) with labels.
+    :return: data of shape (n_channels,) + image_shape, truth of shape image_shape
+    """
+    random = np.random.RandomState(seed)
+    grid = np.indices(image_shape, dtype=np.float32)
+    center = np.asarray(image_shape, dtype=np.float32) / 2.
+    radius = np.asarray(image_shape, dtype=np.float32) * 0.4
+    distance = np.sqrt(np.sum(((grid - center.reshape(3, 1, 1, 1)) / radius.reshape(3, 1, 1, 1)) ** 2, axis=0))
+    brain = distance < 1
+
+    tumor_center = center + random.uniform(-0.2, 0.2, size=3) * np.asarray(image_shape)
+    tumor_distance = np.sqrt(np.sum((grid - tumor_center.reshape(3, 1, 1, 1)) ** 2, axis=0))
+    tumor_radius = min(image_shape) * 0.2
+    truth = np.zeros(image_shape, dtype=np.uint8)
+    for i, label in enumerate(labels):
+        truth[(tumor_distance < tumor_radius * (1. - i / float(len(labels)))) & brain] = label
+
+    data = np.zeros((n_channels,) + tuple(image_shape), dtype=np.float32)
+    for channel in range(n_channels):
+        intensity = random.normal(500 + 100 * channel, 50, size=image_shape).astype(np.float32)
+        intensity += 200 * (truth > 0)
+        data[channel] = intensity * brain
+    return data, truth
+
+
+def create_synthetic_data_file(out_file, n_subjects, n_channels, image_shape, labels=LABELS):
+    """
+    Writes n_subjects synthetic subjects with create_data_file, in the layout written by prepare_data.
+    """
+    hdf5_file, data_storage, truth_storage, affine_storage = create_data_file(out_file, n_channels, n_subjects,
+                                                                             image_shape)
+    for index in range(n_subjects):
+        data, truth = get_synthetic_subject(image_shape, n_channels, labels=labels, seed=index)
+        add_data_to_storage(data_storage, truth_storage, affine_storage, list(data) + [truth], np.eye(4),
+                            n_channels=n_channels, truth_dtype=np.uint8)
+    hdf5_file.close()
+    return out_file
+
+
+def get_stats(times, n_items=1):
+    times = np.asarray(times)
+    return {"median": float(np.median(times)), "min": float(np.min(times)), "mean": float(np.mean(times)),
+            "n": len(times), "items_per_second": float(n_items / np.median(times))}
+
+
+def time_function(function, n_repeat=3, n_warmup=1, n_items=1):
+    """
+    :return: statistics of the wall time of function() in seconds, after n_warmup calls
+    """
+    for _ in range(n_warmup):
+        function()
+    times = list()
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return get_stats(times, n_items=n_items)
+
+
+def time_generator(generator, n_batches=10, n_warmup=1):
+    """
+    :return: statistics of the time to get one batch, with the samples per second and megabytes per second
+    """
+    for _ in range(n_warmup):
+        next(generator)
+    times = list()
+    n_samples = 0
+    n_bytes = 0
+    for _ in range(n_batches):
+        start = time.perf_counter()
+        x, y = next(generator)
+        times.append(time.perf_counter() - start)
+        n_samples += len(x)
+        n_bytes += get_n_bytes((x, y))
+    stats = get_stats(times)
+    stats["samples_per_second"] = n_samples / float(np.sum(times))
+    stats["mb_per_second"] = n_bytes / 1024. ** 2 / float(np.sum(times))
+    return stats
+
+
+def get_tiny_model(input_shape, n_labels, model_dim=3):
+    """
+    Single 1x1 convolution with the input and output layouts of the unet3d, unet2d and unet25d models.
+    """
+    from keras.layers import Input, Conv2D, Conv3D, Reshape
+    from keras.models import Model
+    inputs = Input(input_shape)
+    if model_dim == 2:
+        outputs = Conv2D(n_labels, (1, 1), activation="sigmoid", data_format="channels_first")(inputs)
+    elif model_dim == 25:
+        outputs = Conv3D(n_labels, (1, 1, input_shape[-1]), activation="sigmoid",
+                         data_format="channels_first")(inputs)
+        outputs = Reshape((n_labels,) + tuple(input_shape[1:3]))(outputs)
+    else:
+        outputs = Conv3D(n_labels, (1, 1, 1), activation="sigmoid", data_format="channels_first")(inputs)
+    return Model(inputs=inputs, outputs=outputs)
+
+
+def get_benchmarks(data_file, args):
+    """
+    :return: list of (name, function returning the statistics of the benchmark)
+    """
+    image_shape = args.image_shape
+    patch_shape = args.patch_shape
+    n_channels = args.n_channels
+    n_labels = len(LABELS)
+    index_list = list(range(args.n_subjects))
+    data, truth = get_synthetic_subject(image_shape, n_channels)
+    benchmarks = list()
+
+    def generator3d():
+        from unet3d.generator import data_generator
+        return time_generator(data_generator(data_file, index_list, batch_size=args.batch_size, n_labels=n_labels,
+                                             labels=LABELS, patch_shape=patch_shape), n_batches=args.n_batches)
+    benchmarks.append(("data_generator", generator3d))
+
+    def generator2d():
+        from unet2d.generator import data_generator2d
+        return time_generator(data_generator2d(data_file, index_list, batch_size=args.batch_size_2d,
+                                               n_labels=n_labels, labels=LABELS,
+                                               patch_shape=tuple(image_shape[:2]) + (1,)), n_batches=args.n_batches)
+    benchmarks.append(("data_generator2d", generator2d))
+
+    def generator25d():
+        from unet25d.generator import data_generator25d
+        return time_generator(data_generator25d(data_file, index_list, batch_size=args.batch_size_2d,
+                                                n_labels=n_labels, labels=LABELS,
+                                                patch_shape=tuple(image_shape[:2]) + (args.slab_depth,)),
+                              n_batches=args.n_batches)
+    benchmarks.append(("data_generator25d", generator25d))
+
+    def generator_augment():
+        from unet3d.generator import data_generator
+        return time_generator(data_generator(data_file, index_list, batch_size=args.batch_size, n_labels=n_labels,
+                                             labels=LABELS, patch_shape=patch_shape, augment_flipud=True,
+                                             augment_fliplr=True, augment_rotation=True), n_batches=args.n_batches)
+    benchmarks.append(("data_generator_augment", generator_augment))
+
+    def augment():
+        from unet3d.generator import augment_data
+        return time_function(lambda: augment_data(list(data) + [truth], augment_flipud=True, augment_fliplr=True,
+                                                  augment_rotation=True, augment_shift=True, augment_zoom=True),
+                             n_repeat=args.n_repeat)
+    benchmarks.append(("augment_data", augment))
+
+    def multi_class_labels():
+        from unet3d.generator import get_multi_class_labels
+        batch = np.repeat(truth[np.newaxis, np.newaxis], args.batch_size, axis=0)
+        return time_function(lambda: get_multi_class_labels(batch, n_labels=n_labels, labels=LABELS),
+                             n_repeat=args.n_repeat, n_items=args.batch_size)
+    benchmarks.append(("get_multi_class_labels", multi_class_labels))
+
+    def normalize():
+        from unet3d.normalize import normalize_volume
+        return time_function(lambda: normalize_volume(data[0].copy(), data[1 % n_channels].copy(),
+                                                      is_normalize="z", is_hist_match="0"),
+                             n_repeat=args.n_repeat)
+    benchmarks.append(("normalize_volume", normalize))
+
+    def normalize_hist_match():
+        from unet3d.normalize import normalize_volume
+        return time_function(lambda: normalize_volume(data[0].copy(), data[1 % n_channels].copy(),
+                                                      is_normalize="z", is_hist_match="1"),
+                             n_repeat=args.n_repeat)
+    benchmarks.append(("normalize_volume_hist_match", normalize_hist_match))
+
+    def hist_match():
+        from unet3d.normalize import hist_match
+        return time_function(lambda: hist_match(data[0], data[1 % n_channels]), n_repeat=args.n_repeat)
+    benchmarks.append(("hist_match", hist_match))
+
+    def reconstruct3d():
+        from unet3d.utils.patches import compute_patch_indices, reconstruct_from_patches
+        indices = compute_patch_indices(image_shape, np.asarray(patch_shape), overlap=args.overlap, is_predict=True)
+        patches = [np.random.rand(n_labels, *patch_shape) for _ in indices]
+        return time_function(lambda: reconstruct_from_patches(patches, np.copy(indices),
+                                                               data_shape=(n_labels,) + tuple(image_shape)),
+                             n_repeat=args.n_repeat, n_items=len(indices))
+    benchmarks.append(("reconstruct_from_patches", reconstruct3d))
+
+    def reconstruct2d():
+        from unet3d.utils.patches import compute_patch_indices, reconstruct_from_patches2d
+        slice_shape = tuple(image_shape[:2]) + (1,)
+        indices = compute_patch_indices(image_shape, np.asarray(slice_shape), overlap=0, is_predict=True)
+        patches = [np.random.rand(n_labels, *slice_shape[:2]) for _ in indices]
+        return time_function(lambda: reconstruct_from_patches2d(patches, np.copy(indices),
+                                                                 data_shape=(n_labels,) + tuple(image_shape)),
+                             n_repeat=args.n_repeat, n_items=len(indices))
+    benchmarks.append(("reconstruct_from_patches2d", reconstruct2d))
+
+    def predict3d():
+        from unet3d.prediction import patch_wise_prediction
+        model = get_tiny_model((n_channels,) + tuple(patch_shape), n_labels)
+        return time_function(lambda: patch_wise_prediction(model, data[np.newaxis], overlap=args.overlap),
+                             n_repeat=args.n_repeat)
+    benchmarks.append(("patch_wise_prediction", predict3d))
+
+    def predict2d():
+        from unet2d.prediction import patch_wise_prediction
+        model = get_tiny_model((n_channels,) + tuple(image_shape[:2]), n_labels, model_dim=2)
+        return time_function(lambda: patch_wise_prediction(model, data[np.newaxis], batch_size=image_shape[-1]),
+                             n_repeat=args.n_repeat)
+    benchmarks.append(("patch_wise_prediction2d", predict2d))
+
+    def predict25d():
+        from unet25d.prediction import patch_wise_prediction
+        model = get_tiny_model((n_channels,) + tuple(image_shape[:2]) + (args.slab_depth,), n_labels, model_dim=25)
+        return time_function(lambda: patch_wise_prediction(model, data[np.newaxis], batch_size=1),
+                             n_repeat=args.n_repeat)
+    benchmarks.append(("patch_wise_prediction25d", predict25d))
+
+    return benchmarks
+
+
+def run_benchmarks(args):
+    tmp_dir = tempfile.mkdtemp(prefix="unet_benchmark_", dir=args.tmp_dir)
+    try:
+        data_path = create_synthetic_data_file(os.path.join(tmp_dir, "data.h5"), args.n_subjects, args.n_channels,
+                                               args.image_shape)
+        data_file = open_data_file(data_path)
+        results = dict()
+        try:
+            for name, benchmark in get_benchmarks(data_file, args):
+                if args.benchmarks and name not in args.benchmarks:
+                    continue
+                print(">> benchmark {}".format(name))
+                try:
+                    results[name] = benchmark()
+                    print("   median {:.4f}s".format(results[name]["median"]))
+                except ImportError as error:
+                    results[name] = {"skipped": str(error)}
+                    print("   skipped: {}".format(error))
+                except Exception as error:
+                    results[name] = {"error": "".join(traceback.format_exception_only(type(error), error)).strip()}
+                    print("   error: {}".format(results[name]["error"]))
+        finally:
+            data_file.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def compare(results, baseline, tolerance=1.25):
+    """
+    Compares the median times with a previous run.
+    :return: names of the benchmarks slower than tolerance times the baseline
+    """
+    regressions = list()
+    for name in sorted(results):
+        if "median" not in results[name] or "median" not in baseline.get(name, dict()):
+            continue
+        ratio = results[name]["median"] / baseline[name]["median"]
+        is_regression = ratio > tolerance
+        print("{:32s} {:9.4f}s -> {:9.4f}s  x{:.2f}{}".format(name, baseline[name]["median"],
+                                                              results[name]["median"], ratio,
+                                                              "  REGRESSION" if is_regression else ""))
+        if is_regression:
+            regressions.append(name)
+    return regressions
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json", help="json file of the results")
+    parser.add_argument("-b", "--baseline", type=str, default=None, help="json file of a previous run to compare to")
+    parser.add_argument("-t", "--tolerance", type=float, default=1.25,
+                        help="slowdown ratio of the median time reported as a regression")
+    parser.add_argument("-s", "--shape", type=str, default="64-64-48", help="image shape of the subjects")
+    parser.add_argument("-ps", "--patch_shape", type=str, default="32-32-24", help="patch shape of the 3d benchmarks")
+    parser.add_argument("-c", "--n_channels", type=int, default=4)
+    parser.add_argument("-n", "--n_subjects", type=int, default=4)
+    parser.add_argument("-ba", "--batch_size", type=int, default=2, help="batch size of the 3d generator")
+    parser.add_argument("-ba2", "--batch_size_2d", type=int, default=16, help="batch size of the 2d/2.5d generators")
+    parser.add_argument("-sd", "--slab_depth", type=int, default=5, help="number of slices of the 2.5d patches")
+    parser.add_argument("-ov", "--overlap", type=int, default=0, help="patch overlap of the 3d prediction")
+    parser.add_argument("-nb", "--n_batches", type=int, default=10, help="number of timed batches per generator")
+    parser.add_argument("-r", "--n_repeat", type=int, default=3, help="number of timed calls per function")
+    parser.add_argument("-k", "--benchmarks", type=str, default=None, help="comma separated names to run")
+    parser.add_argument("--tmp_dir", type=str, default=None, help="directory of the synthetic data file")
+    args = parser.parse_args()
+    args.image_shape = get_shape_from_string(args.shape)
+    args.patch_shape = get_shape_from_string(args.patch_shape)
+    args.benchmarks = args.benchmarks.split(",") if args.benchmarks else None
+    return args
+
+
+def main():
+    args = get_args()
+    results = run_benchmarks(args)
+    output = {"config": {"shape": args.shape, "patch_shape": args.patch_shape, "n_channels": args.n_channels,
+                         "n_subjects": args.n_subjects, "batch_size": args.batch_size,
+                         "batch_size_2d": args.batch_size_2d, "slab_depth": args.slab_depth,
+                         "n_batches": args.n_batches, "n_repeat": args.n_repeat},
+              "machine": {"python": platform.python_version(), "numpy": np.__version__,
+                          "platform": platform.platform(), "n_cpu": os.cpu_count()},
+              "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=4)
+    print(">> results written to {}".format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, tolerance=args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from unet3d.utils.batch_cache import get_cached_generator, get_outputs
+
+
+class TestBatchCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.n_steps = 3
+        self.batches = [(np.random.rand(2, 1, 4, 4, 4).astype(np.float32),
+                         np.random.randint(0, 2, (2, 3, 4, 4, 4)).astype(np.int8)) for _ in range(self.n_steps)]
+        self.n_read = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def generator(self):
+        while True:
+            for x, y in self.batches:
+                self.n_read += 1
+                yield x, y
+
+    def check_epochs(self, generator, n_epochs=3):
+        for _ in range(n_epochs):
+            for x, y in self.batches:
+                x_cached, y_cached = next(generator)
+                self.assertTrue(np.all(x_cached == x))
+                self.assertEqual(isinstance(y_cached, list), isinstance(y, list))
+                for output_cached, output in zip(get_outputs(y_cached), get_outputs(y)):
+                    self.assertTrue(np.all(output_cached == output))
+                    self.assertEqual(output_cached.dtype, output.dtype)
+
+    def test_replay(self):
+        batch_bytes = self.batches[0][0].nbytes + self.batches[0][1].nbytes
+        # in memory, then in memory and on disk
+        for cache_size_mb, cache_dir in ((1, None), (1.5 * batch_bytes / 1024. ** 2, self.tmp_dir)):
+            self.n_read = 0
+            generator = get_cached_generator(self.generator(), self.n_steps, cache_size_mb=cache_size_mb,
+                                             cache_dir=cache_dir)
+            self.check_epochs(generator)
+            self.assertEqual(self.n_read, self.n_steps)
+
+    def test_multi_output(self):
+        # cascaded / separated models have one target per output
+        self.batches = [(x, [y[:, :1], y[:, 1:2], y[:, 2:]]) for x, y in self.batches]
+        batch_bytes = self.batches[0][0].nbytes + sum([output.nbytes for output in self.batches[0][1]])
+        for cache_size_mb, cache_dir in ((1, None), (1.5 * batch_bytes / 1024. ** 2, self.tmp_dir)):
+            self.n_read = 0
+            generator = get_cached_generator(self.generator(), self.n_steps, cache_size_mb=cache_size_mb,
+                                             cache_dir=cache_dir)
+            self.check_epochs(generator)
+            self.assertEqual(self.n_read, self.n_steps)
+
+    def test_overflow(self):
+        generator = get_cached_generator(self.generator(), self.n_steps, cache_size_mb=1e-3)
+        self.check_epochs(generator, n_epochs=2)
+        self.assertEqual(self.n_read, 2 * self.n_steps)
@@ -0,0 +1,71 @@
+import os
+import glob
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+from keras.layers import Input, Conv3D
+from keras.models import Model, model_from_json, load_model
+
+from unet3d.callbacks import AsyncModelCheckpoint, get_architecture_file
+
+
+class TestAsyncModelCheckpoint(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.model_file = os.path.join(self.tmp_dir, "model.h5")
+        inputs = Input((1, 4, 4, 4))
+        self.model = Model(inputs=inputs, outputs=Conv3D(2, (3, 3, 3), padding="same", activation="sigmoid",
+                                                         data_format="channels_first")(inputs))
+        self.model.compile(optimizer="adam", loss="binary_crossentropy")
+        self.x = np.random.rand(4, 1, 4, 4, 4).astype(np.float32)
+        self.y = (np.random.rand(4, 2, 4, 4, 4) > 0.5).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assert_weights_equal(self, model):
+        for weights, model_weights in zip(model.get_weights(), self.model.get_weights()):
+            self.assertTrue(np.all(weights == model_weights))
+
+    def test_weights_only(self):
+        checkpoint = AsyncModelCheckpoint(self.model_file, save_best_only=False, save_weights_only=True, verbose=0)
+        self.model.fit(self.x, self.y, batch_size=2, epochs=2, callbacks=[checkpoint], verbose=0)
+        self.assertTrue(os.path.exists(self.model_file))
+        with open(get_architecture_file(self.model_file), "r") as f:
+            model = model_from_json(f.read())
+        model.load_weights(self.model_file)
+        self.assert_weights_equal(model)
+
+    def test_full_model(self):
+        checkpoint = AsyncModelCheckpoint(self.model_file, save_best_only=False, verbose=0)
+        self.model.fit(self.x, self.y, batch_size=2, epochs=2, callbacks=[checkpoint], verbose=0)
+        self.assertFalse(os.path.exists(get_architecture_file(self.model_file)))
+        self.assert_weights_equal(load_model(self.model_file, compile=False))
+
+    def test_rolling(self):
+        n_last_checkpoints = 2
+        checkpoint = AsyncModelCheckpoint(self.model_file, save_best_only=False, save_weights_only=True,
+                                          n_last_checkpoints=n_last_checkpoints, verbose=0)
+        self.model.fit(self.x, self.y, batch_size=2, epochs=5, callbacks=[checkpoint], verbose=0)
+        epoch_files = sorted(glob.glob(os.path.join(self.tmp_dir, "model_epoch-*.h5")))
+        self.assertEqual([os.path.basename(filepath) for filepath in epoch_files],
+                         ["model_epoch-004.h5", "model_epoch-005.h5"])
+        self.assertEqual(len(checkpoint.last_checkpoints), n_last_checkpoints)
+
+    def test_flush(self):
+        checkpoint = AsyncModelCheckpoint(self.model_file, save_best_only=False, save_weights_only=True,
+                                          n_last_checkpoints=3, verbose=0)
+        checkpoint.set_model(self.model)
+        checkpoint.on_train_begin()
+        for epoch in range(3):
+            checkpoint.on_epoch_end(epoch, logs={"val_loss": 1.})
+        queue = checkpoint.queue
+        checkpoint.on_train_end()
+        # every queued snapshot is written when on_train_end returns
+        self.assertIsNone(checkpoint.thread)
+        self.assertEqual(queue.unfinished_tasks, 0)
+        for epoch in range(3):
+            self.assertTrue(os.path.exists(checkpoint.get_epoch_filepath(epoch)))
+        self.assertFalse(glob.glob(os.path.join(self.tmp_dir, "*.tmp")))
@@ -0,0 +1,82 @@
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from unet3d.data import open_data_file
+from unet3d.data_cropped import create_cropped_data_file, add_cropped_subject, is_cropped_data_file
+from unet3d.data_cropped import get_image_shapes, uncrop_volume, get_full_affine
+from unet3d.generator import create_patch_index_list, get_data_from_file
+from unet3d.utils.foreground import compute_foreground, get_foreground_bboxes
+
+
+class TestCroppedDataFile(TestCase):
+    def setUp(self):
+        self.data_file_path = "./temporary_cropped_test_file.h5"
+        self.image_shape = (12, 10, 8)
+        self.boxes = [((2, 3, 1), (7, 9, 5)), ((0, 0, 0), (12, 4, 8))]
+        self.data = list()
+        self.truth = list()
+        self.affine = np.diag([2., 2., 3., 1.])
+        hdf5_file = create_cropped_data_file(self.data_file_path, n_channels=2, n_samples=len(self.boxes))
+        for start, stop in self.boxes:
+            data = np.zeros((2,) + self.image_shape, dtype=np.float32)
+            crop = tuple([slice(a, b) for a, b in zip(start, stop)])
+            data[(slice(None),) + crop] = np.random.rand(*((2,) + tuple(np.subtract(stop, start)))) + 1
+            truth = (data[0] > 1.5).astype(np.uint8)
+            add_cropped_subject(hdf5_file, data, truth, self.affine)
+            self.data.append(data)
+            self.truth.append(truth)
+        hdf5_file.close()
+
+    def tearDown(self):
+        if os.path.exists(self.data_file_path):
+            os.remove(self.data_file_path)
+
+    def test_read(self):
+        data_file = open_data_file(self.data_file_path)
+        self.assertTrue(is_cropped_data_file(data_file))
+        self.assertEqual(len(data_file.root.data), 2)
+        for index, (start, stop) in enumerate(self.boxes):
+            crop = tuple([slice(a, b) for a, b in zip(start, stop)])
+            self.assertEqual(tuple(data_file.root.shapes[index]), tuple(np.subtract(stop, start)))
+            self.assertTrue(np.all(data_file.root.data[index] == self.data[index][(slice(None),) + crop]))
+            self.assertTrue(np.all(data_file.root.truth[index, 0] == self.truth[index][crop]))
+            # the cropped affine keeps the voxels at their position in world space
+            self.assertTrue(np.allclose(np.dot(data_file.root.affine[index], [0, 0, 0, 1])[:3],
+                                        np.dot(self.affine, list(start) + [1])[:3]))
+            self.assertTrue(np.allclose(get_full_affine(data_file, index), self.affine))
+            full = uncrop_volume(data_file.root.truth[index], data_file.root.bbox[index], self.image_shape)
+            self.assertTrue(np.all(full[0] == self.truth[index]))
+        data_file.close()
+
+    def test_patches(self):
+        data_file = open_data_file(self.data_file_path)
+        patch_shape = (4, 4, 4)
+        index_list = create_patch_index_list([0, 1], get_image_shapes(data_file), patch_shape, 0)
+        for index in index_list:
+            x, y = get_data_from_file(data_file, index, patch_shape=patch_shape)
+            self.assertEqual(x.shape, (2,) + patch_shape)
+            self.assertEqual(y.shape, patch_shape)
+        # subject 1 spans 12x4x8, more patches than subject 0 (5x6x4)
+        self.assertGreater(len([index for index in index_list if index[0] == 1]),
+                           len([index for index in index_list if index[0] == 0]))
+        data_file.close()
+
+    def test_foreground(self):
+        data_file = open_data_file(self.data_file_path)
+        bboxes = get_foreground_bboxes(data_file)
+        for index, (start, stop) in enumerate(self.boxes):
+            # the crop has no margin, the foreground fills the cropped volume
+            self.assertTrue(np.all(bboxes[index][0] == 0))
+            self.assertTrue(np.all(bboxes[index][1] == np.subtract(stop, start)))
+            self.assertTrue(np.all(data_file.root.foreground[index]))
+        index_list = create_patch_index_list([0], get_image_shapes(data_file), (4, 4, 4), 0,
+                                             foreground_bboxes=np.asarray([[(1, 2, 1), (5, 6, 3)]]))
+        self.assertTrue(np.all([np.all(patch_index >= (1, 2, 0)) for _, patch_index in index_list]))
+        data_file.close()
+
+        foreground = compute_foreground(np.pad(np.ones((2, 3, 4)), ((1, 2), (3, 0), (0, 5))), margin=1)
+        self.assertEqual(foreground["n_voxels"], 24)
+        self.assertEqual(tuple(foreground["start"]), (0, 2, 0))
+        self.assertEqual(tuple(foreground["stop"]), (4, 6, 5))
@@ -0,0 +1,101 @@
+import os
+import shutil
+from unittest import TestCase
+
+import numpy as np
+
+from unet3d.data import add_data_to_storage, create_data_file, open_data_file
+from unet3d.data_memmap import convert_h5_to_memmap, is_memmap_data_file
+from unet3d.generator import get_data_from_file
+
+
+class TestMemmapDataFile(TestCase):
+    def setUp(self):
+        self.data_file_path = "./temporary_memmap_test_file.h5"
+        self.memmap_dir = "./temporary_memmap_test_file_memmap"
+        self.n_samples = 3
+        self.n_channels = 2
+        image_shape = (6, 7, 8)
+        hdf5_file, data_storage, truth_storage, affine_storage = create_data_file(self.data_file_path,
+                                                                                  self.n_channels, self.n_samples,
+                                                                                  image_shape)
+        data_size = self.n_samples * self.n_channels * int(np.prod(image_shape))
+        self.data = np.arange(data_size, dtype=np.float32).reshape([self.n_samples, self.n_channels] +
+                                                                   list(image_shape))
+        self.truth = (self.data[:, :1] % 3 == 0).astype(np.uint8)
+        for index in range(self.n_samples):
+            add_data_to_storage(data_storage, truth_storage, affine_storage,
+                                np.concatenate([self.data[index], self.truth[index]], axis=0),
+                                affine=np.diag(np.ones(4)), n_channels=self.n_channels, truth_dtype=np.uint8)
+        hdf5_file.create_array(hdf5_file.root, 'subject_ids', obj=[b"a", b"b", b"c"])
+        hdf5_file.close()
+
+    def tearDown(self):
+        if os.path.exists(self.data_file_path):
+            os.remove(self.data_file_path)
+        if os.path.exists(self.memmap_dir):
+            shutil.rmtree(self.memmap_dir)
+
+    def test_convert_and_read(self):
+        out_dir = convert_h5_to_memmap(self.data_file_path)
+        self.assertEqual(os.path.abspath(out_dir), os.path.abspath(self.memmap_dir))
+
+        data_file = open_data_file(out_dir)
+        self.assertTrue(is_memmap_data_file(data_file))
+        self.assertEqual(data_file.root.data.shape, self.data.shape)
+        self.assertTrue(np.all(data_file.root.data[1] == self.data[1]))
+        self.assertTrue(np.all(data_file.root.truth[2, 0] == self.truth[2, 0]))
+        self.assertTrue(np.all(data_file.root.affine[0] == np.diag(np.ones(4))))
+        self.assertIn('subject_ids', data_file.root)
+        self.assertEqual(data_file.root.subject_ids[1].decode('utf-8'), "b")
+
+        # returned arrays must be writable copies, as with pytables
+        x = data_file.root.data[0]
+        x[:] = 0
+        self.assertTrue(np.all(data_file.root.data[0] == self.data[0]))
+        data_file.close()
+
+    def test_patch_read(self):
+        data_file = open_data_file(convert_h5_to_memmap(self.data_file_path))
+        patch_shape = (4, 4, 4)
+        for patch_index in ((1, 2, 3), (-1, 0, 6)):
+            x, y = get_data_from_file(data_file, (1, np.asarray(patch_index)), patch_shape=patch_shape)
+            self.assertEqual(x.shape, (self.n_channels,) + patch_shape)
+            self.assertEqual(y.shape, patch_shape)
+            if patch_index == (1, 2, 3):
+                self.assertTrue(np.all(x == self.data[1, :, 1:5, 2:6, 3:7]))
+            x[:] = -1
+        self.assertTrue(np.all(data_file.root.data[1] == self.data[1]))
+        data_file.close()
+
+    def test_compact_data_file(self):
+        from unet3d.data_compact import write_compact_data_file, get_quantization_report_file
+
+        compact_file = "./temporary_compact_test_file.h5"
+        try:
+            for data_dtype, tolerance in (("float16", 0.5), ("int16", 0.1)):
+                report = write_compact_data_file(self.data_file_path, compact_file, data_dtype)
+                self.assertEqual(len(report["channels"]), self.n_channels)
+                data_file = open_data_file(compact_file)
+                self.assertEqual(data_file.root.data.dtype, np.float32)
+                self.assertEqual(data_file.root.data.shape, self.data.shape)
+                self.assertLess(np.max(np.abs(data_file.root.data[2] - self.data[2])), tolerance)
+                self.assertLessEqual(np.max(np.abs(data_file.root.data[2] - self.data[2])),
+                                     max([channel["max_error"] for channel in report["channels"]]))
+                self.assertTrue(np.all(data_file.root.truth[:] == self.truth))
+                self.assertEqual(data_file.root.subject_ids[1].decode('utf-8'), "b")
+                data_file.close()
+
+                data_file = open_data_file(convert_h5_to_memmap(compact_file, out_dir=self.memmap_dir,
+                                                                overwrite=True))
+                self.assertLess(np.max(np.abs(data_file.root.data[1] - self.data[1])), tolerance)
+                # patches are cut from the memory map and decoded
+                x, y = get_data_from_file(data_file, (1, np.asarray((1, 2, 3))), patch_shape=(4, 4, 4))
+                self.assertEqual(x.dtype, np.float32)
+                self.assertLess(np.max(np.abs(x - self.data[1, :, 1:5, 2:6, 3:7])), tolerance)
+                self.assertTrue(np.all(y == self.truth[1, 0, 1:5, 2:6, 3:7]))
+                data_file.close()
+        finally:
+            for path in (compact_file, get_quantization_report_file(compact_file)):
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,81 @@
+import os
+import shutil
+from unittest import TestCase
+
+import nibabel as nib
+import numpy as np
+from scipy.ndimage import binary_erosion, distance_transform_edt
+
+from unet3d.evaluation import evaluate_prediction_folder, get_header, get_project_regions, get_scores
+from unet3d.evaluation import evaluate_case, get_surface_scores, CACHE_FILE, METRICS, SURFACE_METRICS
+
+
+class TestEvaluation(TestCase):
+    def setUp(self):
+        self.prediction_folder = "./temporary_evaluation_test_folder"
+        self.csv_file = "./temporary_evaluation_test_file.csv"
+        self.regions = get_project_regions("brats")
+        self.cases = dict()
+        for i in range(3):
+            truth = np.random.choice([0, 1, 2, 4], size=(10, 12, 8)).astype(np.uint8)
+            prediction = np.random.choice([0, 1, 2, 4], size=(10, 12, 8)).astype(np.uint8)
+            case_folder = os.path.join(self.prediction_folder, "case_{}".format(i))
+            os.makedirs(case_folder)
+            nib.Nifti1Image(truth, np.eye(4)).to_filename(os.path.join(case_folder, "truth.nii.gz"))
+            nib.Nifti1Image(prediction, np.eye(4)).to_filename(os.path.join(case_folder, "prediction.nii.gz"))
+            self.cases["case_{}".format(i)] = (truth, prediction)
+
+    def tearDown(self):
+        shutil.rmtree(self.prediction_folder)
+        if os.path.exists(self.csv_file):
+            os.remove(self.csv_file)
+
+    def test_scores_match_masks(self):
+        truth, prediction = self.cases["case_0"]
+        scores = dict(zip(get_header(self.regions), get_scores(truth, prediction, self.regions)))
+        for name, labels in self.regions:
+            t = np.isin(truth, labels)
+            p = np.isin(prediction, labels)
+            self.assertAlmostEqual(scores["dice_" + name], 2. * np.sum(t & p) / (np.sum(t) + np.sum(p)))
+            self.assertAlmostEqual(scores["sensitivity_" + name], np.sum(t & p) / float(np.sum(t)))
+            self.assertAlmostEqual(scores["specificity_" + name], np.sum(~t & ~p) / float(np.sum(~t)))
+
+    def test_empty_region(self):
+        truth = np.zeros((4, 4, 4), dtype=np.uint8)
+        self.assertEqual(get_scores(truth, truth, (("label1", (1,)),), metrics=("dice",)), [0.])
+
+    def test_evaluate_prediction_folder(self):
+        df = evaluate_prediction_folder(self.prediction_folder, self.csv_file, self.regions, n_workers=2)
+        self.assertTrue(os.path.exists(self.csv_file))
+        self.assertFalse(os.path.exists(self.csv_file + ".part"))
+        self.assertEqual(list(df.index), sorted(self.cases))
+        for subject_id, (truth, prediction) in self.cases.items():
+            expected = get_scores(truth, prediction, self.regions)
+            self.assertTrue(np.allclose(df.loc[subject_id].values, expected))
+
+    def test_surface_scores_match_full_volume(self):
+        shape = (30, 25, 20)
+        spacing = (1., 1.5, 2.)
+        grid = np.indices(shape)
+        truth = np.sum((grid - np.reshape([12, 10, 8], (3, 1, 1, 1))) ** 2, axis=0) < 30
+        prediction = np.sum((grid - np.reshape([14, 11, 8], (3, 1, 1, 1))) ** 2, axis=0) < 25
+
+        truth_border = truth ^ binary_erosion(truth)
+        prediction_border = prediction ^ binary_erosion(prediction)
+        prediction_to_truth = distance_transform_edt(~truth_border, sampling=spacing)[prediction_border]
+        truth_to_prediction = distance_transform_edt(~prediction_border, sampling=spacing)[truth_border]
+        distances = np.concatenate([prediction_to_truth, truth_to_prediction])
+
+        scores = get_surface_scores(truth, prediction, spacing=spacing, tolerance=2.)
+        self.assertAlmostEqual(scores["hd95"], np.percentile(distances, 95))
+        self.assertAlmostEqual(scores["asd"], (prediction_to_truth.mean() + truth_to_prediction.mean()) / 2.)
+        self.assertAlmostEqual(scores["surface_dice"], np.mean(distances <= 2.))
+
+    def test_case_cache(self):
+        metrics = METRICS + SURFACE_METRICS
+        case_folder = os.path.join(self.prediction_folder, "case_1")
+        scores = evaluate_case(case_folder, self.regions, metrics=metrics)
+        self.assertTrue(os.path.exists(os.path.join(case_folder, CACHE_FILE)))
+        self.assertEqual(len(scores), len(get_header(self.regions, metrics)))
+        self.assertTrue(np.allclose(evaluate_case(case_folder, self.regions, metrics=metrics), scores,
+                                    equal_nan=True))
@@ -0,0 +1,51 @@
+import os
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import nibabel as nib
+
+from unet3d.utils.image_cache import ImageCache
+
+
+class TestImageCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+        self.image_file = os.path.join(self.tmp_dir, "image.nii.gz")
+        self.affine = np.diag([1., 2., 3., 1.])
+        self.data = np.random.rand(6, 5, 4).astype(np.float32)
+        nib.Nifti1Image(self.data, self.affine).to_filename(self.image_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_put(self):
+        cache = ImageCache(self.cache_dir, max_bytes=10 ** 6)
+        self.assertIsNone(cache.get(self.image_file))
+        cache.put(self.image_file, nib.load(self.image_file))
+        image = cache.get(self.image_file)
+        self.assertIsInstance(image.dataobj, np.memmap)
+        self.assertTrue(np.all(np.asarray(image.dataobj) == self.data))
+        self.assertTrue(np.allclose(image.affine, self.affine))
+        self.assertEqual(image.header.get_zooms(), (1., 2., 3.))
+        # resized images are separate entries
+        self.assertIsNone(cache.get(self.image_file, image_shape=(3, 3, 3)))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        # an edited source file is a new entry
+        time.sleep(0.01)
+        nib.Nifti1Image(self.data + 1, self.affine).to_filename(self.image_file)
+        self.assertIsNone(cache.get(self.image_file))
+
+    def test_evict(self):
+        cache = ImageCache(self.cache_dir, max_bytes=int(self.data.nbytes * 2.5))
+        for shape in ((1, 1, 1), (2, 2, 2), (3, 3, 3)):
+            cache.put(self.image_file, nib.load(self.image_file), image_shape=shape)
+            time.sleep(0.01)
+        self.assertEqual(len(cache.get_entries()), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get(self.image_file, image_shape=(1, 1, 1)))
+        self.assertIsNotNone(cache.get(self.image_file, image_shape=(3, 3, 3)))
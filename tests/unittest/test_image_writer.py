@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import nibabel as nib
+
+from unet3d.utils.image_writer import ImageWriter, LABEL_IMAGE, PROBABILITY_IMAGE, find_image_file
+
+
+class TestImageWriter(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.affine = np.diag([1., 2., 3., 1.])
+        self.probabilities = np.random.rand(8, 7, 6)
+        self.labels = (self.probabilities > 0.5).astype(np.int8) * 4
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write(self):
+        for compress_level, n_threads in ((0, 0), (1, 2), (9, 1)):
+            with ImageWriter(compress_level=compress_level, probability_dtype=np.uint8, n_threads=n_threads) as writer:
+                probability_file = writer.write(nib.Nifti1Image(self.probabilities, self.affine),
+                                                writer.get_filename(self.tmp_dir, "probability"),
+                                                kind=PROBABILITY_IMAGE)
+                label_file = writer.write(nib.Nifti1Image(self.labels, self.affine),
+                                          writer.get_filename(self.tmp_dir, "label"), kind=LABEL_IMAGE)
+            self.assertEqual(probability_file.endswith(".nii.gz"), compress_level > 0)
+            probability_image = nib.load(probability_file)
+            self.assertEqual(probability_image.get_data_dtype(), np.uint8)
+            self.assertTrue(np.allclose(probability_image.get_fdata(), self.probabilities, atol=1. / 255))
+            self.assertTrue(np.allclose(probability_image.affine, self.affine))
+            label_image = nib.load(label_file)
+            self.assertEqual(label_image.get_data_dtype(), np.uint8)
+            self.assertTrue(np.all(np.asanyarray(label_image.dataobj) == self.labels))
+            self.assertEqual(find_image_file(os.path.join(self.tmp_dir, "label.nii.gz")), label_file)
+            os.remove(probability_file)
+            os.remove(label_file)
@@ -13,3 +13,111 @@ class TestModel(TestCase):
         for name in layer_names[:-3]:  # exclude the last convolution layer
             if 'conv3d' in name and 'transpose' not in name:
                 self.assertIn(name.replace('conv3d', 'batch_normalization'), layer_names)
+
+    def test_inference_model(self):
+        import numpy as np
+        from keras.layers import Input, Conv3D, BatchNormalization, Activation, SpatialDropout3D, concatenate
+        from keras.models import Model
+        from unet3d.export import get_inference_model, check_equivalence
+
+        inputs = Input((2, 8, 8, 8))
+        layer = Conv3D(4, (3, 3, 3), padding="same", data_format="channels_first")(inputs)
+        layer = BatchNormalization(axis=1)(layer)
+        layer = Activation("relu")(layer)
+        layer = SpatialDropout3D(0.3, data_format="channels_first")(layer)
+        layer = Conv3D(3, (1, 1, 1), use_bias=False, data_format="channels_first")(layer)
+        layer = BatchNormalization(axis=1)(layer)
+        model = Model(inputs=inputs, outputs=Activation("sigmoid")(layer))
+        for bn_layer in model.layers:
+            if isinstance(bn_layer, BatchNormalization):
+                gamma, beta, mean, variance = bn_layer.get_weights()
+                bn_layer.set_weights([np.random.rand(*gamma.shape) + 0.5, np.random.rand(*beta.shape),
+                                      np.random.rand(*mean.shape), np.random.rand(*variance.shape) + 0.5])
+
+        inference_model, n_folded, n_removed = get_inference_model(model)
+        self.assertEqual((n_folded, n_removed), (2, 3))
+        self.assertEqual(len(inference_model.layers), len(model.layers) - 3)
+        self.assertLess(check_equivalence(model, inference_model), 1e-4)
+
+        # multi_gpu_model wraps the template model and calls it once per gpu
+        wrapper_inputs = Input((2, 8, 8, 8))
+        wrapper = Model(inputs=wrapper_inputs,
+                        outputs=concatenate([model(wrapper_inputs), model(wrapper_inputs)], axis=0))
+        inference_model, n_folded, n_removed = get_inference_model(wrapper)
+        self.assertEqual((n_folded, n_removed), (2, 3))
+        self.assertEqual(len(inference_model.layers), len(model.layers) - 3)
+        self.assertLess(check_equivalence(model, inference_model), 1e-4)
+
+    def test_channels_last_model(self):
+        from keras.layers import Input, Conv3D, MaxPooling3D, UpSampling3D, Activation, concatenate
+        from keras.models import Model
+        from unet3d.model.blocks import GroupNormalization
+        from unet3d.data_format import convert_to_channels_last, is_channels_last
+        from unet3d.export import check_equivalence
+
+        inputs = Input((2, 8, 8, 8))
+        layer1 = Conv3D(4, (3, 3, 3), padding="same", data_format="channels_first")(inputs)
+        layer1 = GroupNormalization(groups=2, axis=1)(layer1)
+        layer2 = MaxPooling3D(data_format="channels_first")(Activation("relu")(layer1))
+        layer2 = UpSampling3D(data_format="channels_first")(layer2)
+        layer = concatenate([layer1, layer2], axis=1)
+        layer = Conv3D(3, (1, 1, 1), data_format="channels_first", name="out")(layer)
+        model = Model(inputs=inputs, outputs=Activation("sigmoid")(layer))
+
+        channels_last_model, n_transposes = convert_to_channels_last(model)
+        self.assertTrue(is_channels_last(channels_last_model))
+        self.assertEqual(n_transposes, 2)
+        self.assertEqual(channels_last_model.output_shape, model.output_shape)
+        self.assertLess(check_equivalence(model, channels_last_model), 1e-4)
+
+    def test_channels_last_model_file(self):
+        import os
+        import shutil
+        import tempfile
+        from keras.layers import Input, Conv3D, BatchNormalization, Activation
+        from keras.models import Model
+        from unet3d.data_format import convert_model_file, get_channels_last_file, is_channels_last
+        from unet3d.training import load_old_model
+        from unet3d.export import check_equivalence
+
+        inputs = Input((2, 8, 8, 8))
+        layer = Conv3D(4, (3, 3, 3), padding="same", data_format="channels_first")(inputs)
+        layer = BatchNormalization(axis=1)(layer)
+        layer = Conv3D(3, (1, 1, 1), data_format="channels_first")(Activation("relu")(layer))
+        model = Model(inputs=inputs, outputs=Activation("sigmoid")(layer))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            model_file = os.path.join(tmp_dir, "model.h5")
+            model.save(model_file)
+            channels_last_model = load_old_model(convert_model_file(model_file))
+            self.assertTrue(is_channels_last(channels_last_model))
+            # converting an already channels-last model is a no-op
+            twice_model = load_old_model(convert_model_file(get_channels_last_file(model_file)))
+            self.assertEqual([layer.get_config() for layer in twice_model.layers],
+                             [layer.get_config() for layer in channels_last_model.layers])
+            self.assertLess(check_equivalence(model, twice_model), 1e-4)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_memory_estimate(self):
+        from keras.layers import Input, Conv3D, Activation, concatenate
+        from keras.models import Model
+        from unet3d.memory import estimate_memory, get_batch_size
+
+        inputs = Input((1, 8, 8, 8))
+        layer1 = Conv3D(2, (3, 3, 3), padding="same", data_format="channels_first")(inputs)
+        layer2 = Conv3D(2, (3, 3, 3), padding="same", data_format="channels_first")(layer1)
+        layer = Conv3D(1, (1, 1, 1), data_format="channels_first")(concatenate([layer1, layer2], axis=1))
+        model = Model(inputs=inputs, outputs=Activation("sigmoid")(layer))
+
+        # outputs of input, conv, conv, concatenate, conv, sigmoid in voxels of 8x8x8 float32
+        inference = estimate_memory(model, batch_size=2, is_training=False)
+        self.assertEqual(inference["activations_per_sample"], (2 + 2 + 4) * 512 * 4)
+        training = estimate_memory(model, batch_size=2, patch_shape=(16, 16, 16))
+        self.assertEqual(training["activations_per_sample"], (1 + 2 + 2 + 4 + 1 + 1 + 4 + 2) * 4096 * 4)
+        self.assertEqual(training["parameters"], model.count_params() * 4 * 4)
+        self.assertEqual(training["total"], training["parameters"] + 2 * training["activations_per_sample"])
+
+        budget = training["parameters"] / 0.8 + 5.5 * training["activations_per_sample"] / 0.8
+        self.assertEqual(get_batch_size(model, memory_budget=budget, patch_shape=(16, 16, 16)), 5)
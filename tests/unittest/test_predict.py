@@ -4,6 +4,7 @@ import numpy as np
 from unittest import TestCase
 
 from unet3d.utils.patches import compute_patch_indices, get_patch_from_3d_data, reconstruct_from_patches
+from unet3d.utils.patches import fix_out_of_bound_patch_attempt, get_slab_view
 
 
 class TestPrediction(TestCase):
@@ -66,3 +67,29 @@ class TestPrediction(TestCase):
         # noinspection PyTypeChecker
         self.assertTrue(np.all(data == reconstruced_data))
 
+
+    def test_out_of_bound_patches_match_padding(self):
+        n_channels = 2
+        image_shape = (12, 10, 8)
+        data = np.random.rand(n_channels, *image_shape)
+        for patch_shape, overlap in (((8, 8, 8), 0), ((8, 8, 1), 0), ((8, 8, 5), [0, 0, 4])):
+            patch_indices = compute_patch_indices(image_shape, np.asarray(patch_shape), overlap,
+                                                  is_extract_patch_agressive=True)
+            for index in patch_indices:
+                padded_data, padded_index = fix_out_of_bound_patch_attempt(data, np.asarray(patch_shape),
+                                                                           np.copy(index))
+                expected = padded_data[..., padded_index[0]:padded_index[0] + patch_shape[0],
+                                       padded_index[1]:padded_index[1] + patch_shape[1],
+                                       padded_index[2]:padded_index[2] + patch_shape[2]]
+                patch = get_patch_from_3d_data(data, patch_shape, index)
+                self.assertEqual(patch.shape, (n_channels,) + patch_shape)
+                self.assertTrue(np.all(patch == expected))
+
+    def test_slab_view(self):
+        data = np.random.rand(2, 6, 5, 9)
+        for depth in (1, 4, 7, 15):
+            slabs = get_slab_view(data, depth)
+            self.assertEqual(slabs.shape, (9, 2, 6, 5, depth))
+            for index in range(data.shape[-1]):
+                expected = get_patch_from_3d_data(data, (6, 5, depth), (0, 0, index - (depth - 1) // 2))
+                self.assertTrue(np.all(slabs[index] == expected))
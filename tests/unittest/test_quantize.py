@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+
+import numpy as np
+from keras import backend as K
+from keras.layers import Input, Dense
+from keras.models import Model
+
+from unet3d.quantize import (TFLiteModel, compare_models, convert_to_tflite, get_patch_shape,
+                             get_representative_dataset)
+
+
+class TruthModel(object):
+    """
+    Predicts the labels 1 and 4 written in the first channel of the data, or nothing if is_empty.
+    """
+
+    def __init__(self, image_shape, is_empty=False):
+        self.input_shape = (None, 1) + tuple(image_shape)
+        self.output_shape = (None, 3) + tuple(image_shape)
+        self.is_empty = is_empty
+
+    def predict(self, data):
+        prediction = np.zeros((len(data),) + self.output_shape[1:], dtype=np.float32)
+        if not self.is_empty:
+            prediction[:, 0] = data[:, 0] == 1
+            prediction[:, 2] = data[:, 0] == 4
+        return prediction
+
+
+class TestQuantize(TestCase):
+    def setUp(self):
+        K.clear_session()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_tflite_model(self, model, representative_dataset=None):
+        model_file = os.path.join(self.tmp_dir, "model_int8.tflite")
+        with open(model_file, "wb") as f:
+            f.write(convert_to_tflite(model, representative_dataset))
+        return TFLiteModel(model_file)
+
+    def test_representative_dataset(self):
+        batches = [np.random.rand(3, 2, 4, 4, 4) for _ in range(3)]
+        samples = list(get_representative_dataset(((x, None) for x in batches), n_batches=2)())
+        self.assertEqual(len(samples), 6)
+        for i, sample in enumerate(samples):
+            self.assertEqual(len(sample), 1)
+            self.assertEqual(sample[0].shape, (1, 2, 4, 4, 4))
+            self.assertEqual(sample[0].dtype, np.float32)
+            self.assertTrue(np.allclose(sample[0][0], batches[i // 3][i % 3]))
+
+    def test_patch_shape(self):
+        self.assertEqual(get_patch_shape(SimpleNamespace(input_shape=(None, 4, 160, 192)), 2), (160, 192, 1))
+        self.assertEqual(get_patch_shape(SimpleNamespace(input_shape=(None, 4, 128, 128, 3)), 25), (128, 128, 3))
+        self.assertEqual(get_patch_shape(SimpleNamespace(input_shape=(None, 4, 32, 32, 32)), 3), (32, 32, 32))
+
+    def test_tflite_model(self):
+        inputs = Input((6,))
+        model = Model(inputs=inputs, outputs=Dense(3, activation="sigmoid")(inputs))
+        x = np.random.rand(5, 6).astype(np.float32)
+        representative_dataset = get_representative_dataset(iter([(x, None)]), n_batches=1)
+        tflite_model = self.get_tflite_model(model, representative_dataset)
+        self.assertEqual(tflite_model.input_shape, (None, 6))
+        self.assertEqual(tflite_model.output_shape, (None, 3))
+        # the interpreter is resized to each new batch size
+        for batch_size in (5, 2, 2):
+            prediction = tflite_model.predict(x[:batch_size])
+            self.assertEqual(tflite_model.batch_size, batch_size)
+            self.assertEqual(prediction.shape, (batch_size, 3))
+            self.assertLess(np.max(np.abs(prediction - model.predict(x[:batch_size]))), 0.05)
+
+    def test_tflite_multi_output(self):
+        inputs = Input((6,))
+        model = Model(inputs=inputs, outputs=[Dense(3, activation="sigmoid")(inputs),
+                                              Dense(2, activation="sigmoid")(inputs)])
+        tflite_model = self.get_tflite_model(model)
+        self.assertEqual(sorted(tflite_model.output_shape), [(None, 2), (None, 3)])
+        x = np.random.rand(4, 6).astype(np.float32)
+        prediction = tflite_model.predict(x)
+        self.assertIsInstance(prediction, list)
+        self.assertEqual(sorted([output.shape for output in prediction]), [(4, 2), (4, 3)])
+
+    def test_compare_models(self):
+        image_shape = (4, 4, 4)
+        truth = np.zeros((2, 1) + image_shape, dtype=np.uint8)
+        truth[:, 0, :2] = 1
+        truth[:, 0, 2:3] = 4
+        data_file = SimpleNamespace(root=SimpleNamespace(data=truth.astype(np.float32), truth=truth))
+        report = compare_models(TruthModel(image_shape), TruthModel(image_shape, is_empty=True), data_file, [0, 1],
+                                model_dim=3)
+        self.assertEqual(report["n_cases"], 2)
+        for column in ("dice_WholeTumor", "dice_TumorCore", "dice_EnhancingTumor"):
+            self.assertAlmostEqual(report[column]["float"], 1.)
+            self.assertAlmostEqual(report[column]["int8"], 0.)
+            self.assertAlmostEqual(report[column]["delta"], report[column]["int8"] - report[column]["float"])
+        self.assertGreaterEqual(report["time_float"], 0.)
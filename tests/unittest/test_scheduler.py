@@ -0,0 +1,110 @@
+import os
+import json
+import shutil
+import socket
+from unittest import TestCase
+
+from unet3d.utils.scheduler import Job, LockFile, Scheduler, get_visible_gpus, DONE, FAILED
+
+
+class TestScheduler(TestCase):
+    def setUp(self):
+        self.state_dir = "./temporary_scheduler_test_folder"
+        if os.path.exists(self.state_dir):
+            shutil.rmtree(self.state_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def test_run_and_resume(self):
+        output_path = os.path.join(self.state_dir, "b.out")
+        scheduler = Scheduler(self.state_dir, n_cpu=2, max_jobs=2, poll_interval=0.05)
+        scheduler.add(Job("a", "exit 0"))
+        scheduler.add(Job("b", "touch {}".format(output_path), output_path=output_path))
+        scheduler.add(Job("c", "exit 3"))
+        scheduler.add(Job("a", "exit 1"))
+        status = scheduler.run()
+        self.assertEqual(status, {"a": DONE, "b": DONE, "c": FAILED})
+        self.assertTrue(os.path.exists(output_path))
+        self.assertEqual([name for name in os.listdir(self.state_dir) if name.endswith(".lock")], list())
+
+        # a restarted sweep only runs the failed job again
+        scheduler = Scheduler(self.state_dir, poll_interval=0.05)
+        for name in ("a", "b", "c"):
+            scheduler.add(Job(name, "exit 0", output_path=output_path if name == "b" else None))
+        scheduler.run()
+        with open(os.path.join(self.state_dir, "jobs.json")) as f:
+            state = json.load(f)
+        self.assertEqual(state["a"]["attempts"], 1)
+        self.assertEqual(state["c"]["attempts"], 2)
+        self.assertEqual(state["c"]["status"], DONE)
+
+    def test_stale_lock(self):
+        os.makedirs(self.state_dir)
+        path = os.path.join(self.state_dir, "a.lock")
+        lock = LockFile(path)
+        self.assertTrue(lock.acquire())
+        self.assertFalse(LockFile(path).acquire())
+        lock.release()
+
+        # owner died: the lock is taken over
+        with open(path, "w") as f:
+            json.dump({"pid": 2 ** 22 + 1, "host": socket.gethostname(), "time": 0}, f)
+        self.assertTrue(LockFile(path).acquire())
+
+    def test_dependencies(self):
+        os.makedirs(self.state_dir)
+        data_path = os.path.join(self.state_dir, "data.out")
+        log_path = os.path.join(self.state_dir, "order.txt")
+        scheduler = Scheduler(self.state_dir, n_cpu=4, poll_interval=0.05)
+        scheduler.add(Job("train_b", "echo train_b >> {}".format(log_path), dependencies=["prepare"]))
+        scheduler.add(Job("train_a", "echo train_a >> {}".format(log_path), dependencies=["prepare"]))
+        scheduler.add(Job("prepare", "sleep 0.2 && echo prepare >> {0} && touch {1}".format(log_path, data_path),
+                          output_path=data_path))
+        scheduler.add(Job("broken", "exit 1"))
+        scheduler.add(Job("after_broken", "exit 0", dependencies=["broken"]))
+        status = scheduler.run()
+        with open(log_path) as f:
+            order = f.read().split()
+        self.assertEqual(order[0], "prepare")
+        self.assertEqual(sorted(order[1:]), ["train_a", "train_b"])
+        self.assertEqual(status["after_broken"], "skipped")
+
+        # prepare is not needed anymore once everything depending on it is finished
+        os.remove(data_path)
+        scheduler = Scheduler(self.state_dir, poll_interval=0.05)
+        scheduler.add(Job("prepare", "exit 1", output_path=data_path))
+        scheduler.add(Job("train_a", "exit 1", dependencies=["prepare"]))
+        self.assertEqual(scheduler.get_finished(), {"prepare", "train_a"})
+
+    def test_gpu_slots(self):
+        os.makedirs(self.state_dir)
+        scheduler = Scheduler(self.state_dir, n_cpu=8, gpus=["0", "1"], poll_interval=0.05)
+        for name in ("a", "b", "c"):
+            scheduler.add(Job(name, "echo $CUDA_VISIBLE_DEVICES > {}; sleep 0.2".format(
+                os.path.join(self.state_dir, name + ".gpu")), n_gpu=1))
+        scheduler.add(Job("all", "echo $CUDA_VISIBLE_DEVICES > {}".format(os.path.join(self.state_dir, "all.gpu")),
+                          n_gpu=2, dependencies=["a", "b", "c"]))
+        self.assertEqual(set(scheduler.run().values()), {DONE})
+        gpus = dict()
+        for name in ("a", "b", "c", "all"):
+            with open(os.path.join(self.state_dir, name + ".gpu")) as f:
+                gpus[name] = f.read().strip()
+        # one job per gpu: the first two jobs run on different gpus
+        self.assertEqual(sorted([gpus["a"], gpus["b"]]), ["0", "1"])
+        self.assertIn(gpus["c"], ("0", "1"))
+        self.assertEqual(sorted(gpus["all"].split(",")), ["0", "1"])
+        self.assertEqual(sorted(scheduler.free_gpus), ["0", "1"])
+
+    def test_visible_gpus(self):
+        os.makedirs(self.state_dir)
+        devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+        try:
+            for value, gpus in (("2,3", ["2", "3"]), ("", []), ("-1", [])):
+                os.environ["CUDA_VISIBLE_DEVICES"] = value
+                self.assertEqual(get_visible_gpus(), gpus)
+        finally:
+            if devices is None:
+                del os.environ["CUDA_VISIBLE_DEVICES"]
+            else:
+                os.environ["CUDA_VISIBLE_DEVICES"] = devices
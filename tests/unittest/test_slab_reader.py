@@ -0,0 +1,56 @@
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from unet3d.data import add_data_to_storage, create_data_file, open_data_file
+from unet3d.generator import get_data_from_file
+from unet3d.utils.subject_cache import SubjectCache
+from unet25d.generator import create_patch_index_list, iterate_slabs25d, slab_generator25d
+
+
+class TestSlabReader(TestCase):
+    def setUp(self):
+        self.data_file_path = "./temporary_slab_reader_test_file.h5"
+        self.n_samples = 3
+        self.image_shape = (6, 5, 9)
+        hdf5_file, data_storage, truth_storage, affine_storage = create_data_file(self.data_file_path, 2,
+                                                                                  self.n_samples, self.image_shape)
+        data = np.random.rand(self.n_samples, 2, *self.image_shape).astype(np.float32)
+        truth = (data[:, :1] > 0.5).astype(np.uint8)
+        for index in range(self.n_samples):
+            add_data_to_storage(data_storage, truth_storage, affine_storage,
+                                np.concatenate([data[index], truth[index]], axis=0),
+                                affine=np.diag(np.ones(4)), n_channels=2, truth_dtype=np.uint8)
+        hdf5_file.close()
+        self.data_file = open_data_file(self.data_file_path)
+
+    def tearDown(self):
+        self.data_file.close()
+        if os.path.exists(self.data_file_path):
+            os.remove(self.data_file_path)
+
+    def test_slabs_match_patches(self):
+        for patch_shape, subject_cache in (((6, 5, 3), None), ((4, 4, 5), None),
+                                           ((4, 4, 5), SubjectCache(max_bytes=1024 ** 2))):
+            overlap = np.asarray((0, 0, patch_shape[-1] - 1))
+            patch_indices = [patch_index for _, patch_index in
+                             create_patch_index_list([1], self.image_shape, patch_shape, overlap)]
+            slabs = list()
+            for patch_index, x, y in iterate_slabs25d(self.data_file, 1, patch_indices, patch_shape, block_size=2,
+                                                      subject_cache=subject_cache):
+                x_patch, y_patch = get_data_from_file(self.data_file, (1, np.asarray(patch_index)),
+                                                      patch_shape=patch_shape)
+                self.assertTrue(np.all(x == x_patch))
+                self.assertTrue(np.all(y == y_patch))
+                slabs.append(patch_index)
+            self.assertEqual(sorted(slabs), sorted([tuple(patch_index) for patch_index in patch_indices]))
+
+    def test_epoch(self):
+        patch_shape = (6, 5, 3)
+        overlap = np.asarray((0, 0, 2))
+        index_list = create_patch_index_list(range(self.n_samples), self.image_shape, patch_shape, overlap)
+        epoch = [(index, patch_index) for (index, patch_index), _, _ in
+                 slab_generator25d(self.data_file, range(self.n_samples), patch_shape, overlap, n_subjects=2,
+                                   shuffle_buffer_size=4)]
+        self.assertEqual(sorted(epoch), sorted([(index, tuple(patch_index)) for index, patch_index in index_list]))
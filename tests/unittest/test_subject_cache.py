@@ -0,0 +1,62 @@
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from unet3d.data import add_data_to_storage, create_data_file, open_data_file
+from unet3d.generator import get_data_from_file
+from unet3d.utils.subject_cache import SubjectCache, locality_shuffle
+
+
+class TestSubjectCache(TestCase):
+    def setUp(self):
+        self.data_file_path = "./temporary_subject_cache_test_file.h5"
+        self.n_samples = 4
+        image_shape = (6, 6, 6)
+        hdf5_file, data_storage, truth_storage, affine_storage = create_data_file(self.data_file_path, 1,
+                                                                                  self.n_samples, image_shape)
+        self.data = np.random.rand(self.n_samples, 1, *image_shape).astype(np.float32)
+        self.truth = (self.data > 0.5).astype(np.uint8)
+        for index in range(self.n_samples):
+            add_data_to_storage(data_storage, truth_storage, affine_storage,
+                                np.concatenate([self.data[index], self.truth[index]], axis=0),
+                                affine=np.diag(np.ones(4)), n_channels=1, truth_dtype=np.uint8)
+        hdf5_file.close()
+        self.data_file = open_data_file(self.data_file_path)
+
+    def tearDown(self):
+        self.data_file.close()
+        if os.path.exists(self.data_file_path):
+            os.remove(self.data_file_path)
+
+    def test_patches_match_uncached(self):
+        cache = SubjectCache(max_bytes=10 * 1024 ** 2)
+        patch_shape = (4, 4, 4)
+        for patch_index in ((0, 0, 0), (2, 1, 2), (-1, 3, 0)):
+            index = (1, np.asarray(patch_index))
+            x, y = get_data_from_file(self.data_file, index, patch_shape=patch_shape)
+            x_cached, y_cached = get_data_from_file(self.data_file, index, patch_shape=patch_shape,
+                                                    subject_cache=cache)
+            self.assertTrue(np.all(x == x_cached))
+            self.assertTrue(np.all(y == y_cached))
+            # modifying a patch must not corrupt the cached subject
+            x_cached[:] = -1
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 2)
+
+    def test_eviction(self):
+        subject_bytes = self.data[0].nbytes + self.truth[0, 0].nbytes
+        cache = SubjectCache(max_bytes=2 * subject_bytes)
+        for index in (0, 1, 2, 0):
+            cache.get(self.data_file, index)
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual(len(cache.subjects), 2)
+        self.assertLessEqual(cache.n_bytes, cache.max_bytes)
+
+    def test_locality_shuffle(self):
+        index_list = [(subject, patch) for subject in range(10) for patch in range(5)]
+        shuffled = locality_shuffle(index_list, n_subjects_window=3)
+        self.assertEqual(sorted(shuffled), sorted(index_list))
+        # every window of 3 subjects is consumed before the next one starts
+        for start in range(0, len(shuffled), 15):
+            self.assertLessEqual(len(set(index[0] for index in shuffled[start:start + 15])), 3)
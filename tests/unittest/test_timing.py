@@ -0,0 +1,38 @@
+from unittest import TestCase
+
+import numpy as np
+
+from unet3d.utils.timing import StageTimer, TimedGenerator, NULL_STAGE
+
+
+class TestTiming(TestCase):
+    def test_disabled_timer_records_nothing(self):
+        timer = StageTimer()
+        self.assertIs(timer.stage("read"), NULL_STAGE)
+        with timer.stage("read"):
+            pass
+        timer.add_batch(10)
+        self.assertEqual(timer.pop_stages(), dict())
+        self.assertIsNone(timer.pop_batch_bytes())
+
+    def test_timed_generator(self):
+        timer = StageTimer()
+        timer.enable()
+
+        def generator():
+            while True:
+                with timer.stage("read"):
+                    x = np.zeros((2, 4, 8), np.float32)
+                with timer.stage("labels"):
+                    y = [np.zeros((2, 1), np.int8), np.zeros((2, 3), np.int8)]
+                yield x, y
+
+        timed_generator = TimedGenerator(generator(), timer=timer)
+        for _ in range(3):
+            next(timed_generator)
+        stages = timer.pop_stages()
+        self.assertEqual(sorted(stages), ["generate", "labels", "read"])
+        self.assertEqual(stages["read"][1], 3)
+        self.assertGreaterEqual(stages["generate"][0], stages["read"][0])
+        self.assertEqual([timer.pop_batch_bytes() for _ in range(4)], [264, 264, 264, None])
+        self.assertEqual(timer.pop_stages(), dict())
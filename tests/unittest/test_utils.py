@@ -3,7 +3,7 @@ from unittest import TestCase
 import nibabel as nib
 import numpy as np
 
-from unet3d.utils.utils import resize
+from unet3d.utils.utils import resize, resize_and_pad
 from unet3d.utils.sitk_utils import resample_to_spacing
 
 
@@ -67,3 +67,17 @@ class TestUtils(TestCase):
                                                                    [0., 1., 0., -0.5],
                                                                    [0., 0., 1., -0.5],
                                                                    [0., 0., 0., 1.]])))
+
+    def test_resize_and_pad(self):
+        data = np.asarray(np.random.rand(3, 4, 5), dtype=np.float32)
+        # permuted and flipped axes, as in the kits images
+        affine = np.asarray([[0., 0., -1., 4.], [0., 2., 0., 0.], [3., 0., 0., 0.], [0., 0., 0., 1.]])
+        image = nib.Nifti1Image(np.asfortranarray(data), affine)
+        new_image = resize_and_pad(image, new_shape=(10, 8, 6), pad_shape=(12, 8, 4), interpolation="nearest")
+        new_data = np.asarray(new_image.dataobj)
+        self.assertEqual(new_data.shape, (12, 8, 6))
+        self.assertTrue(np.all(new_data[[0, -1]] == data.min()))
+        reordered = np.flip(data.transpose(2, 1, 0), 0)
+        self.assertTrue(np.all(new_data[1:-1] == reordered.repeat(2, 0).repeat(2, 1).repeat(2, 2)))
+        self.assertTrue(np.allclose(new_image.affine, [[0.5, 0., 0., -0.75], [0., 1., 0., -0.5],
+                                                       [0., 0., 1.5, -0.75], [0., 0., 0., 1.]]))
@@ -1,7 +1,9 @@
 import os
 import copy
+import random
 from random import shuffle
 import itertools
+from collections import OrderedDict
 
 import numpy as np
 import time
@@ -9,15 +11,19 @@ import time
 from unet3d.utils import pickle_dump, pickle_load
 from unet3d.generator import get_train_valid_test_split, get_number_of_steps
 from unet3d.generator import get_multi_class_labels, get_data_from_file
+from unet3d.data_cropped import get_image_shapes, get_subject_shape
+from unet3d.utils.timing import time_stage
 from unet3d.generator import get_train_valid_test_split_isbr
-from unet3d.generator import add_data
-from unet3d.utils.patches import compute_patch_indices, get_random_nd_index
+from unet3d.generator import add_data, add_patch
+from unet3d.utils.patches import compute_patch_indices, get_random_nd_index, get_patch_from_3d_data
 
 import tensorlayer as tl
 from scipy.ndimage.filters import gaussian_filter
 from scipy.ndimage.interpolation import map_coordinates
 
 from unet3d.utils.threadsafe import threadsafe_generator
+from unet3d.utils.subject_cache import get_subject_cache, locality_shuffle
+from unet3d.utils.batch_cache import get_cached_generator
 
 # from unet3d.generator import get_training_and_validation_and_testing_generators
 
@@ -31,7 +37,11 @@ def get_training_and_validation_and_testing_generators25d(data_file, batch_size,
                                                           project="brats",
                                                           augment_flipud=False, augment_fliplr=False, augment_elastic=False,
                                                           augment_rotation=False, augment_shift=False, augment_shear=False,
-                                                          augment_zoom=False, n_augment=0, skip_blank=False, is_test="1"):
+                                                          augment_zoom=False, n_augment=0, skip_blank=False, is_test="1",
+                                                          subject_cache_mb=0, locality_window=None,
+                                                          is_slab_reader=False, slab_n_subjects=4,
+                                                          slab_shuffle_buffer=32,
+                                                          validation_cache_mb=0, validation_cache_dir=None):
     """
     Creates the training and validation generators that can be used when training the model.
     :param skip_blank: If True, any blank (all-zero) label images/patches will be skipped by the data generator.
@@ -62,6 +72,19 @@ def get_training_and_validation_and_testing_generators25d(data_file, batch_size,
     :param overwrite: If set to True, previous files will be overwritten. The default mode is false, so that the
     training and validation splits won't be overwritten when rerunning model training.
     :param permute: will randomly permute the data (data must be 3D cube)
+    :param subject_cache_mb: Memory budget (in megabytes) of the LRU cache of decompressed subjects kept by each
+    generator. 0 disables the cache.
+    :param locality_window: If set, training patches are shuffled within windows of this many subjects so that
+    consecutive patches hit the subject cache.
+    :param validation_cache_mb: Memory budget (in megabytes) of the validation batches kept after the first epoch and
+    replayed by the following ones (see unet3d.utils.batch_cache). 0 disables the cache unless validation_cache_dir
+    is set.
+    :param validation_cache_dir: Directory of the validation batches beyond validation_cache_mb, stored as .npy files
+    read as memory maps.
+    :param is_slab_reader: If True, the patches are read by slab_generator25d, which reads each slice of a subject once
+    per epoch instead of once per patch containing it.
+    :param slab_n_subjects: number of subjects whose slabs are interleaved by slab_generator25d.
+    :param slab_shuffle_buffer: number of patches of the shuffle buffer of slab_generator25d.
     :return: Training data generator, validation data generator, number of training steps, number of validation steps
     """
 
@@ -103,7 +126,12 @@ def get_training_and_validation_and_testing_generators25d(data_file, batch_size,
                                            augment_shear=augment_shear,
                                            augment_zoom=augment_zoom,
                                            n_augment=n_augment,
-                                           skip_blank=skip_blank)
+                                           skip_blank=skip_blank,
+                                           subject_cache=get_subject_cache(subject_cache_mb, "training cache"),
+                                           locality_window=locality_window,
+                                           is_slab_reader=is_slab_reader,
+                                           slab_n_subjects=slab_n_subjects,
+                                           slab_shuffle_buffer=slab_shuffle_buffer)
     print(">> valid data generator")
     validation_generator = data_generator25d(data_file, validation_list,
                                              batch_size=validation_batch_size,
@@ -111,8 +139,11 @@ def get_training_and_validation_and_testing_generators25d(data_file, batch_size,
                                              labels=labels,
                                              patch_shape=patch_shape,
                                              patch_overlap=valid_patch_overlap,
-                                             skip_blank=skip_blank
-                                             )
+                                             skip_blank=skip_blank,
+                                             subject_cache=get_subject_cache(subject_cache_mb, "validation cache"),
+                                             is_slab_reader=is_slab_reader,
+                                             slab_n_subjects=slab_n_subjects,
+                                             slab_shuffle_buffer=slab_shuffle_buffer)
 
     print(">> compute number of training and validation steps")
 
@@ -136,6 +167,9 @@ def get_training_and_validation_and_testing_generators25d(data_file, batch_size,
                                                                      patch_overlap=valid_patch_overlap),
                                                validation_batch_size)
 
+    validation_generator = get_cached_generator(validation_generator, num_validation_steps,
+                                                cache_size_mb=validation_cache_mb, cache_dir=validation_cache_dir)
+
     print("Number of training steps: ", num_training_steps)
     print("Number of validation steps: ", num_validation_steps)
 
@@ -148,11 +182,11 @@ def create_patch_index_list(index_list, image_shape, patch_shape, patch_overlap,
         if patch_start_offset is not None:
             random_start_offset = np.negative(
                 get_random_nd_index(patch_start_offset))
-            patches = compute_patch_indices(image_shape, patch_shape,
+            patches = compute_patch_indices(get_subject_shape(image_shape, index), patch_shape,
                                             overlap=patch_overlap, start=random_start_offset,
                                             is_extract_patch_agressive=True)
         else:
-            patches = compute_patch_indices(image_shape, patch_shape,
+            patches = compute_patch_indices(get_subject_shape(image_shape, index), patch_shape,
                                             overlap=patch_overlap,
                                             is_extract_patch_agressive=True)
         patch_index.extend(itertools.product([index], patches))
@@ -165,37 +199,195 @@ def data_generator25d(data_file, index_list, batch_size=1, n_labels=1, labels=No
                       skip_blank=True,
                       augment_flipud=False, augment_fliplr=False, augment_elastic=False,
                       augment_rotation=False, augment_shift=False, augment_shear=False,
-                      augment_zoom=False, n_augment=False):
+                      augment_zoom=False, n_augment=False, subject_cache=None, locality_window=None,
+                      is_slab_reader=False, slab_n_subjects=4, slab_shuffle_buffer=32):
+    if is_slab_reader and patch_shape:
+        for batch in slab_data_generator25d(data_file, index_list, batch_size=batch_size, n_labels=n_labels,
+                                            labels=labels, patch_shape=patch_shape, patch_overlap=patch_overlap,
+                                            patch_start_offset=patch_start_offset,
+                                            shuffle_index_list=shuffle_index_list,
+                                            augment_flipud=augment_flipud, augment_fliplr=augment_fliplr,
+                                            augment_rotation=augment_rotation, augment_shift=augment_shift,
+                                            augment_shear=augment_shear, augment_zoom=augment_zoom,
+                                            subject_cache=subject_cache, n_subjects=slab_n_subjects,
+                                            shuffle_buffer_size=slab_shuffle_buffer):
+            yield batch
     orig_index_list = index_list
     while True:
         x_list = list()
         y_list = list()
         if patch_shape:
-            index_list = create_patch_index_list(orig_index_list, data_file.root.data.shape[-3:], patch_shape,
+            index_list = create_patch_index_list(orig_index_list, get_image_shapes(data_file), patch_shape,
                                                  patch_overlap, patch_start_offset)
         else:
             index_list = copy.copy(orig_index_list)
 
         if shuffle_index_list:
-            shuffle(index_list)
+            if locality_window and patch_shape:
+                index_list = locality_shuffle(index_list, n_subjects_window=locality_window)
+            else:
+                shuffle(index_list)
         while len(index_list) > 0:
             index = index_list.pop()
             add_data(x_list, y_list, data_file, index, patch_shape=patch_shape,
                      augment_flipud=augment_flipud, augment_fliplr=augment_fliplr,
                      augment_elastic=False, augment_rotation=augment_rotation,
                      augment_shift=augment_shift, augment_shear=augment_shear,
-                     augment_zoom=augment_zoom, model_dim=25)
+                     augment_zoom=augment_zoom, model_dim=25, subject_cache=subject_cache)
 
             if len(x_list) == batch_size or (len(index_list) == 0 and len(x_list) > 0):
                 yield convert_data25d(x_list, y_list, n_labels=n_labels, labels=labels)
                 x_list = list()
                 y_list = list()
+        if subject_cache is not None:
+            subject_cache.report()
+            subject_cache.reset_stats()
+
+
+def read_slices(data_file, index, start, stop, subject_cache=None):
+    """
+    Reads the slices [start, stop) of a subject. Slices out of the volume take the value of the nearest slice, as the
+    edge padding of get_patch_from_3d_data.
+    :return: data (n_channels, x, y, stop - start), truth (x, y, stop - start)
+    """
+    n_slices = get_subject_shape(get_image_shapes(data_file), index)[-1]
+    read_start, read_stop = min(max(start, 0), n_slices - 1), max(min(stop, n_slices), 1)
+    if subject_cache is not None:
+        data, truth = subject_cache.get(data_file, index)
+        data, truth = data[..., read_start:read_stop], truth[..., read_start:read_stop]
+    else:
+        data = data_file.root.data[index, :, :, :, read_start:read_stop]
+        truth = data_file.root.truth[index, 0, :, :, read_start:read_stop]
+    if start < read_start or stop > read_stop:
+        slices = np.clip(np.arange(start, stop), 0, n_slices - 1) - read_start
+        data, truth = np.take(data, slices, axis=-1), np.take(truth, slices, axis=-1)
+    return data, truth
+
+
+def iterate_slabs25d(data_file, index, patch_indices, patch_shape, block_size=16, subject_cache=None):
+    """
+    Walks the 2.5D patches of a subject slice by slice, reading each slice once: the last k - 1 slices (k slices per
+    patch) are kept in a ring buffer of k - 1 + block_size slices, refilled block_size slices at a time, and the
+    patches are views of the buffer.
+    :param patch_indices: corner indices of the patches of the subject.
+    :return: generator of (patch index, data, truth). data and truth are only valid until the next patch.
+    """
+    depth = int(patch_shape[-1])
+    buffer_size = depth - 1 + block_size
+    patches_per_position = OrderedDict()
+    for patch_index in sorted([tuple(int(i) for i in patch_index) for patch_index in patch_indices],
+                              key=lambda patch_index: (patch_index[0], patch_index[1], patch_index[2])):
+        patches_per_position.setdefault(patch_index[:2], list()).append(patch_index[2])
+
+    data_buffer, truth_buffer = None, None
+    buffer_start = buffer_stop = None
+    for position, starts in patches_per_position.items():
+        buffer_start = buffer_stop = None
+        for start in starts:
+            if buffer_start is None or start < buffer_start or start + depth > buffer_stop:
+                n_kept = 0
+                if buffer_start is not None and buffer_start <= start < buffer_stop:
+                    # slide: the slices of the buffer still needed move to its front
+                    n_kept = buffer_stop - start
+                    data_buffer[..., :n_kept] = data_buffer[..., buffer_stop - buffer_start - n_kept:
+                                                            buffer_stop - buffer_start]
+                    truth_buffer[..., :n_kept] = truth_buffer[..., buffer_stop - buffer_start - n_kept:
+                                                              buffer_stop - buffer_start]
+                with time_stage("read"):
+                    data, truth = read_slices(data_file, index, start + n_kept, start + buffer_size,
+                                              subject_cache=subject_cache)
+                data = get_patch_from_3d_data(data, (patch_shape[0], patch_shape[1], data.shape[-1]),
+                                              position + (0,))
+                truth = get_patch_from_3d_data(truth, (patch_shape[0], patch_shape[1], truth.shape[-1]),
+                                               position + (0,))
+                if data_buffer is None:
+                    data_buffer = np.empty(data.shape[:-1] + (buffer_size,), dtype=data.dtype)
+                    truth_buffer = np.empty(truth.shape[:-1] + (buffer_size,), dtype=truth.dtype)
+                data_buffer[..., n_kept:] = data
+                truth_buffer[..., n_kept:] = truth
+                buffer_start, buffer_stop = start, start + buffer_size
+            offset = start - buffer_start
+            yield position + (start,), data_buffer[..., offset:offset + depth], truth_buffer[..., offset:offset + depth]
+
+
+def slab_generator25d(data_file, index_list, patch_shape, patch_overlap, patch_start_offset=None,
+                      shuffle_index_list=True, n_subjects=4, shuffle_buffer_size=32, subject_cache=None):
+    """
+    One epoch of the 2.5D patches of index_list (the patches of create_patch_index_list), read with iterate_slabs25d so
+    that each volume is read about once. The slabs of n_subjects subjects are interleaved at random into a shuffle
+    buffer of shuffle_buffer_size patches, from which they are drawn at random.
+    :return: generator of ((subject index, patch index), data, truth), copies of the slabs
+    """
+    patches_per_subject = OrderedDict()
+    for index, patch_index in create_patch_index_list(index_list, get_image_shapes(data_file), patch_shape,
+                                                      patch_overlap, patch_start_offset):
+        patches_per_subject.setdefault(index, list()).append(patch_index)
+    subjects = list(patches_per_subject.keys())
+    if shuffle_index_list:
+        shuffle(subjects)
+
+    def open_subject(index):
+        return index, iterate_slabs25d(data_file, index, patches_per_subject[index], patch_shape,
+                                       subject_cache=subject_cache)
+
+    active = [open_subject(index) for index in subjects[:n_subjects]]
+    pending = subjects[n_subjects:]
+    shuffle_buffer = list()
+    while active:
+        position = random.randrange(len(active)) if shuffle_index_list else 0
+        index, slabs = active[position]
+        try:
+            patch_index, data, truth = next(slabs)
+        except StopIteration:
+            active.pop(position)
+            if pending:
+                active.append(open_subject(pending.pop(0)))
+            continue
+        shuffle_buffer.append(((index, patch_index), np.array(data), np.array(truth)))
+        if len(shuffle_buffer) >= max(shuffle_buffer_size, 1):
+            yield shuffle_buffer.pop(random.randrange(len(shuffle_buffer)) if shuffle_index_list else 0)
+    if shuffle_index_list:
+        shuffle(shuffle_buffer)
+    for item in shuffle_buffer:
+        yield item
+
+
+def slab_data_generator25d(data_file, index_list, batch_size=1, n_labels=1, labels=None, patch_shape=None,
+                           patch_overlap=0, patch_start_offset=None, shuffle_index_list=True,
+                           augment_flipud=False, augment_fliplr=False,
+                           augment_rotation=False, augment_shift=False, augment_shear=False,
+                           augment_zoom=False, subject_cache=None, n_subjects=4, shuffle_buffer_size=32):
+    """
+    data_generator25d reading the patches with slab_generator25d.
+    """
+    while True:
+        x_list = list()
+        y_list = list()
+        for _, data, truth in slab_generator25d(data_file, index_list, patch_shape, patch_overlap,
+                                                patch_start_offset=patch_start_offset,
+                                                shuffle_index_list=shuffle_index_list, n_subjects=n_subjects,
+                                                shuffle_buffer_size=shuffle_buffer_size,
+                                                subject_cache=subject_cache):
+            add_patch(x_list, y_list, data, truth, patch_shape=patch_shape,
+                      augment_flipud=augment_flipud, augment_fliplr=augment_fliplr,
+                      augment_elastic=False, augment_rotation=augment_rotation,
+                      augment_shift=augment_shift, augment_shear=augment_shear,
+                      augment_zoom=augment_zoom, model_dim=25)
+            if len(x_list) == batch_size:
+                yield convert_data25d(x_list, y_list, n_labels=n_labels, labels=labels)
+                x_list = list()
+                y_list = list()
+        if len(x_list) > 0:
+            yield convert_data25d(x_list, y_list, n_labels=n_labels, labels=labels)
+        if subject_cache is not None:
+            subject_cache.report()
+            subject_cache.reset_stats()
 
 
 def get_number_of_patches25d(data_file, index_list, patch_shape=None, patch_overlap=0, patch_start_offset=None,
                              skip_blank=True):
     if patch_shape:
-        index_list = create_patch_index_list(index_list, data_file.root.data.shape[-3:], patch_shape, patch_overlap,
+        index_list = create_patch_index_list(index_list, get_image_shapes(data_file), patch_shape, patch_overlap,
                                              patch_start_offset)
         count = 0
         for i, index in enumerate(index_list, 0):
@@ -215,8 +407,9 @@ def get_number_of_patches25d(data_file, index_list, patch_shape=None, patch_over
 
 
 def convert_data25d(x_list, y_list, n_labels=1, labels=None):
-    x = np.asarray(x_list)
-    y = np.asarray(y_list)
+    with time_stage("batch"):
+        x = np.asarray(x_list)
+        y = np.asarray(y_list)
     if n_labels == 1:
         y[y > 0] = 1
     elif n_labels > 1:
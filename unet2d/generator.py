@@ -11,7 +11,11 @@ from unet3d.generator import get_train_valid_test_split, get_number_of_steps
 from unet3d.generator import get_train_valid_test_split_isbr
 from unet3d.generator import get_number_of_patches, create_patch_index_list
 from unet3d.generator import get_multi_class_labels, get_data_from_file
+from unet3d.data_cropped import get_image_shapes
+from unet3d.utils.timing import time_stage
 from unet3d.utils.threadsafe import threadsafe_generator
+from unet3d.utils.subject_cache import get_subject_cache, locality_shuffle
+from unet3d.utils.batch_cache import get_cached_generator
 
 import tensorlayer as tl
 from scipy.ndimage.filters import gaussian_filter
@@ -33,7 +37,9 @@ def get_training_and_validation_and_testing_generators2d(data_file, batch_size,
                                                              0, 0, -1],
                                                          project="brats",
                                                          is_extract_patch_agressive=False,
-                                                         data_type_generator="combined"):
+                                                         data_type_generator="combined",
+                                                         subject_cache_mb=0, locality_window=None,
+                                                         validation_cache_mb=0, validation_cache_dir=None):
     """
     Creates the training and validation generators that can be used when training the model.
     :param skip_blank: If True, any blank (all-zero) label images/patches will be skipped by the data generator.
@@ -65,6 +71,15 @@ def get_training_and_validation_and_testing_generators2d(data_file, batch_size,
     training and validation splits won't be overwritten when rerunning model training.
     :param permute: will randomly permute the data (data must be 3D cube)
     :param data_type_generator: "combined", "cascaded", "separated"
+    :param subject_cache_mb: Memory budget (in megabytes) of the LRU cache of decompressed subjects kept by each
+    generator. 0 disables the cache.
+    :param locality_window: If set, training patches are shuffled within windows of this many subjects so that
+    consecutive patches hit the subject cache.
+    :param validation_cache_mb: Memory budget (in megabytes) of the validation batches kept after the first epoch and
+    replayed by the following ones (see unet3d.utils.batch_cache). 0 disables the cache unless validation_cache_dir
+    is set.
+    :param validation_cache_dir: Directory of the validation batches beyond validation_cache_mb, stored as .npy files
+    read as memory maps.
     :return: Training data generator, validation data generator, number of training steps, number of validation steps
     """
 
@@ -105,7 +120,9 @@ def get_training_and_validation_and_testing_generators2d(data_file, batch_size,
                                           n_augment=n_augment,
                                           skip_blank=skip_blank,
                                           is_extract_patch_agressive=is_extract_patch_agressive,
-                                          data_type_generator=data_type_generator)
+                                          data_type_generator=data_type_generator,
+                                          subject_cache=get_subject_cache(subject_cache_mb, "training cache"),
+                                          locality_window=locality_window)
     print(">> valid data generator")
     validation_generator = data_generator2d(data_file, validation_list,
                                             batch_size=validation_batch_size,
@@ -115,7 +132,8 @@ def get_training_and_validation_and_testing_generators2d(data_file, batch_size,
                                             patch_overlap=0,
                                             skip_blank=skip_blank,
                                             is_extract_patch_agressive=is_extract_patch_agressive,
-                                            data_type_generator=data_type_generator)
+                                            data_type_generator=data_type_generator,
+                                            subject_cache=get_subject_cache(subject_cache_mb, "validation cache"))
 
     # Set the number of training and testing samples per epoch correctly
     print(">> compute number of training and validation steps")
@@ -162,6 +180,9 @@ def get_training_and_validation_and_testing_generators2d(data_file, batch_size,
                                                                      is_extract_patch_agressive=is_extract_patch_agressive),
                                                validation_batch_size)
 
+    validation_generator = get_cached_generator(validation_generator, num_validation_steps,
+                                                cache_size_mb=validation_cache_mb, cache_dir=validation_cache_dir)
+
     print("Number of training steps: ", num_training_steps)
     print("Number of validation steps: ", num_validation_steps)
 
@@ -176,27 +197,32 @@ def data_generator2d(data_file, index_list, batch_size=1, n_labels=1, labels=Non
                      augment_rotation=False, augment_shift=False, augment_shear=False,
                      augment_zoom=False, n_augment=False,
                      data_type_generator="combined",
-                     is_extract_patch_agressive=False):
+                     is_extract_patch_agressive=False,
+                     subject_cache=None, locality_window=None):
     orig_index_list = index_list
     while True:
         x_list = list()
         y_list = list()
         if patch_shape:
-            index_list = create_patch_index_list(orig_index_list, data_file.root.data.shape[-3:], patch_shape,
+            index_list = create_patch_index_list(orig_index_list, get_image_shapes(data_file), patch_shape,
                                                  patch_overlap, patch_start_offset,
                                                  is_extract_patch_agressive=is_extract_patch_agressive)
         else:
             index_list = copy.copy(orig_index_list)
 
         if shuffle_index_list:
-            shuffle(index_list)
+            if locality_window and patch_shape:
+                index_list = locality_shuffle(index_list, n_subjects_window=locality_window)
+            else:
+                shuffle(index_list)
         while len(index_list) > 0:
             index = index_list.pop()
             add_data2d(x_list, y_list, data_file, index, patch_shape=patch_shape,
                        augment_flipud=augment_flipud, augment_fliplr=augment_fliplr,
                        augment_elastic=augment_elastic, augment_rotation=augment_rotation,
                        augment_shift=augment_shift, augment_shear=augment_shear,
-                       augment_zoom=augment_zoom, data_type_generator=data_type_generator)
+                       augment_zoom=augment_zoom, data_type_generator=data_type_generator,
+                       subject_cache=subject_cache)
 
             if len(x_list) == batch_size or (len(index_list) == 0 and len(x_list) > 0):
                 if data_type_generator != "combined":
@@ -205,6 +231,9 @@ def data_generator2d(data_file, index_list, batch_size=1, n_labels=1, labels=Non
                     yield convert_data2d(x_list, y_list, n_labels=n_labels, labels=labels)
                 x_list = list()
                 y_list = list()
+        if subject_cache is not None:
+            subject_cache.report()
+            subject_cache.reset_stats()
 
 
 def squeeze_data_from_3d_to_2d(x):
@@ -216,8 +245,9 @@ def squeeze_data_from_3d_to_2d(x):
 
 
 def convert_data2d(x_list, y_list, n_labels=1, labels=None):
-    x = np.asarray(x_list)
-    y = np.asarray(y_list)
+    with time_stage("batch"):
+        x = np.asarray(x_list)
+        y = np.asarray(y_list)
     if n_labels == 1:
         y[y > 0] = 1
     elif n_labels > 1:
@@ -226,22 +256,23 @@ def convert_data2d(x_list, y_list, n_labels=1, labels=None):
 
 
 def convert_multioutput_data2d(x_list, y_list):
-    x = squeeze_data_from_3d_to_2d(np.asarray(x_list))
-    count = 0
-    for y in y_list:
-        if count == 0:
-            y_list_whole = [squeeze_data_from_3d_to_2d(y[0])]
-            y_list_core = [squeeze_data_from_3d_to_2d(y[1])]
-            y_list_enh = [squeeze_data_from_3d_to_2d(y[2])]
-        else:
-            y_list_whole.append(squeeze_data_from_3d_to_2d(y[0]))
-            y_list_core.append(squeeze_data_from_3d_to_2d(y[1]))
-            y_list_enh.append(squeeze_data_from_3d_to_2d(y[2]))
-        count += 1
-
-    y_whole = np.asarray(y_list_whole)
-    y_core = np.asarray(y_list_core)
-    y_enh = np.asarray(y_list_enh)
+    with time_stage("batch"):
+        x = squeeze_data_from_3d_to_2d(np.asarray(x_list))
+        count = 0
+        for y in y_list:
+            if count == 0:
+                y_list_whole = [squeeze_data_from_3d_to_2d(y[0])]
+                y_list_core = [squeeze_data_from_3d_to_2d(y[1])]
+                y_list_enh = [squeeze_data_from_3d_to_2d(y[2])]
+            else:
+                y_list_whole.append(squeeze_data_from_3d_to_2d(y[0]))
+                y_list_core.append(squeeze_data_from_3d_to_2d(y[1]))
+                y_list_enh.append(squeeze_data_from_3d_to_2d(y[2]))
+            count += 1
+
+        y_whole = np.asarray(y_list_whole)
+        y_core = np.asarray(y_list_core)
+        y_enh = np.asarray(y_list_enh)
 
     return x, [y_whole, y_core, y_enh]
 
@@ -340,13 +371,14 @@ def augment_data2d(data, augment_flipud=False, augment_fliplr=False, augment_ela
 def add_data2d(x_list, y_list, data_file, index, patch_shape=None,
                augment_flipud=False, augment_fliplr=False, augment_elastic=False,
                augment_rotation=False, augment_shift=False, augment_shear=False,
-               augment_zoom=False, skip_blank=True, data_type_generator="combined"):
+               augment_zoom=False, skip_blank=True, data_type_generator="combined", subject_cache=None):
     """
     Adds data from the data file to the given lists of feature and target data
     :return:
     """
-    data, truth = get_data_from_file(
-        data_file, index, patch_shape=patch_shape)
+    with time_stage("read"):
+        data, truth = get_data_from_file(
+            data_file, index, patch_shape=patch_shape, subject_cache=subject_cache)
 
     augment = augment_flipud or augment_fliplr or augment_elastic or augment_rotation or augment_shift or augment_shear or augment_zoom
     if augment:
@@ -354,10 +386,11 @@ def add_data2d(x_list, y_list, data_file, index, patch_shape=None,
         for i in range(data.shape[0]):
             data_list.append(data[i, :, :, :])
         data_list.append(truth[:, :, :])
-        data_list = augment_data2d(data=data_list, augment_flipud=augment_flipud, augment_fliplr=augment_fliplr,
-                                   augment_elastic=augment_elastic, augment_rotation=augment_rotation,
-                                   augment_shift=augment_shift, augment_shear=augment_shear,
-                                   augment_zoom=augment_zoom)
+        with time_stage("augment"):
+            data_list = augment_data2d(data=data_list, augment_flipud=augment_flipud, augment_fliplr=augment_fliplr,
+                                       augment_elastic=augment_elastic, augment_rotation=augment_rotation,
+                                       augment_shift=augment_shift, augment_shear=augment_shear,
+                                       augment_zoom=augment_zoom)
         for i in range(data.shape[0]):
             data[i, :, :, :] = data_list[i]
         truth[:, :, :] = data_list[-1]
@@ -406,7 +439,7 @@ def get_number_of_patches2d(data_file, index_list, patch_shape=None, patch_overl
                             skip_blank=True, data_type_generator=False):
 
     if patch_shape:
-        index_list = create_patch_index_list(index_list, data_file.root.data.shape[-3:], patch_shape, patch_overlap,
+        index_list = create_patch_index_list(index_list, get_image_shapes(data_file), patch_shape, patch_overlap,
                                              patch_start_offset)
         count = 0
         for i, index in enumerate(index_list, 0):
@@ -2,24 +2,54 @@ import os
 
 import nibabel as nib
 import numpy as np
-import tables
 
 from unet3d.utils import pickle_load
 from unet3d.utils.patches import reconstruct_from_patches2d, get_patch_from_3d_data, compute_patch_indices
+from unet3d.utils.patches import get_slab_view
 from unet3d.augment import permute_data, generate_permutation_keys, reverse_permute_data
+from unet3d.data import open_data_file
+from unet3d.data_cropped import is_cropped_data_file, write_uncropped_image
+from unet3d.utils.image_writer import get_image_writer, ImageWriter, LABEL_IMAGE, PROBABILITY_IMAGE
 from unet3d.training import load_old_model
 
 
+def slice_wise_prediction(model, data, batch_size=64, permute=False, data_type_generator="combined"):
+    """
+    Predicts a volume slice by slice along z, for models whose input covers whole slices: the slices are a strided
+    view of the volume (see get_slab_view), fed to the model batch_size at a time, and the predictions are written
+    straight into the output volume. Works for any number of slices.
+    :param data: numpy array (1, n_channels, x, y, z).
+    :return: prediction (n_labels, x, y, z), the outputs of a "separated" model concatenated along the labels
+    """
+    slices = get_slab_view(data[0], 1)
+    prediction = None
+    for start in range(0, len(slices), batch_size):
+        stop = min(start + batch_size, len(slices))
+        batch_prediction = predict(model, np.asarray(slices[start:stop]), permute=permute)
+        if data_type_generator != "combined":
+            batch_prediction = np.concatenate(batch_prediction, axis=1)
+        if prediction is None:
+            prediction = np.zeros(batch_prediction.shape[1:-2] + tuple(data.shape[-3:]),
+                                  dtype=batch_prediction.dtype)
+        prediction[..., start:stop] = np.moveaxis(batch_prediction, 0, -1)
+    return prediction
+
+
 def patch_wise_prediction(model, data, overlap=0, batch_size=64,
-                          permute=False, data_type_generator="combined"):
+                          permute=False, data_type_generator="combined", is_slice_axis=True):
     """
     :param batch_size:
     :param model:
     :param data:
     :param overlap:
+    :param is_slice_axis: If True and the model input covers whole slices, the volume is predicted with
+    slice_wise_prediction.
     :return:
     """
     patch_shape = model.input_shape[-2:]
+    if is_slice_axis and tuple(patch_shape) == tuple(data.shape[-3:-1]):
+        return slice_wise_prediction(model, data, batch_size=batch_size, permute=permute,
+                                     data_type_generator=data_type_generator)
     patch_shape = (*patch_shape, 1)
     predictions = list()
     indices = compute_patch_indices(data.shape[-3:], patch_size=patch_shape,
@@ -159,7 +189,7 @@ def multi_class_prediction(prediction, affine):
 
 def run_validation_case(data_index, output_dir, model, data_file, training_modalities,
                         output_label_map=False, threshold=0.5, labels=None, overlap=0, permute=False,
-                        data_type_generator="combined"):
+                        data_type_generator="combined", image_writer=None):
     """
     Runs a test case and writes predicted images to file.
     :param data_index: Index from of the list of test cases to get an image prediction from.
@@ -172,19 +202,22 @@ def run_validation_case(data_index, output_dir, model, data_file, training_modal
     :param training_modalities:
     :param data_file:
     :param model:
+    :param image_writer: unet3d.utils.image_writer.ImageWriter of the written images. Default writes .nii.gz files
+    with uint8 label maps in this thread.
     """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    if image_writer is None:
+        image_writer = ImageWriter()
 
     affine = data_file.root.affine[data_index]
     test_data = np.asarray([data_file.root.data[data_index]])
     for i, modality in enumerate(training_modalities):
         image = nib.Nifti1Image(test_data[0, i], affine)
-        image.to_filename(os.path.join(
-            output_dir, "data_{0}.nii.gz".format(modality)))
+        image_writer.write(image, image_writer.get_filename(output_dir, "data_{0}".format(modality)))
 
     test_truth = nib.Nifti1Image(data_file.root.truth[data_index][0], affine)
-    test_truth.to_filename(os.path.join(output_dir, "truth.nii.gz"))
+    image_writer.write(test_truth, image_writer.get_filename(output_dir, "truth"), kind=LABEL_IMAGE)
 
     # patch_shape = tuple([int(dim) for dim in model.input.shape[-3:]])
     patch_shape = model.input_shape[-2:]
@@ -199,24 +232,32 @@ def run_validation_case(data_index, output_dir, model, data_file, training_modal
 
     prediction_image = prediction_to_image(prediction, affine, label_map=output_label_map, threshold=threshold,
                                            labels=labels, data_type_generator=data_type_generator)
+    kind = LABEL_IMAGE if output_label_map else PROBABILITY_IMAGE
     if isinstance(prediction_image, list):
         for i, image in enumerate(prediction_image):
-            image.to_filename(os.path.join(
-                output_dir, "prediction_{0}.nii.gz".format(i + 1)))
+            image_writer.write(image, image_writer.get_filename(output_dir, "prediction_{0}".format(i + 1)),
+                               kind=kind)
     else:
-        prediction_image.to_filename(
-            os.path.join(output_dir, "prediction.nii.gz"))
+        image_writer.write(prediction_image, image_writer.get_filename(output_dir, "prediction"), kind=kind)
+        if is_cropped_data_file(data_file):
+            # the cases are predicted in their cropped grid, also write the label map in the grid of the full image
+            write_uncropped_image(data_file, data_index, np.asarray(prediction_image.dataobj),
+                                  image_writer.get_filename(output_dir, "prediction_full"),
+                                  image_writer=image_writer, kind=kind)
 
 
 def run_validation_cases(validation_keys_file, model_file, training_modalities, labels, hdf5_file,
                          output_label_map=False, output_dir=".", threshold=0.5, overlap=0, permute=False,
-                         data_type_generator="both"):
+                         data_type_generator="both", compress_level=1, probability_dtype=None, n_writer_threads=0):
     validation_indices = pickle_load(validation_keys_file)
 
     from unet3d.utils.model_utils import load_model_multi_gpu
     model = load_model_multi_gpu(model_file)
     # model = load_old_model(model_file)
-    data_file = tables.open_file(hdf5_file, "r")
+    data_file = open_data_file(hdf5_file)
+    # the images of a case are written while the next one is predicted
+    image_writer = get_image_writer(compress_level=compress_level, probability_dtype=probability_dtype,
+                                    n_threads=n_writer_threads)
     for index in validation_indices:
         print(">> processing", index)
         if 'subject_ids' in data_file.root:
@@ -227,7 +268,9 @@ def run_validation_cases(validation_keys_file, model_file, training_modalities,
                 output_dir, "validation_case_{}".format(index))
         run_validation_case(data_index=index, output_dir=case_directory, model=model, data_file=data_file,
                             training_modalities=training_modalities, output_label_map=output_label_map, labels=labels,
-                            threshold=threshold, overlap=overlap, permute=permute, data_type_generator=data_type_generator)
+                            threshold=threshold, overlap=overlap, permute=permute, data_type_generator=data_type_generator,
+                            image_writer=image_writer)
+    image_writer.close()
     data_file.close()
 
 
@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import threading
+from queue import Queue
+
+import h5py
+import numpy as np
+from keras import backend as K
+from keras.callbacks import Callback
+
+from unet3d.utils.timing import stage_timer, STAGES
+
+try:
+    from keras.engine.saving import save_attributes_to_hdf5_group
+except ImportError:
+    def save_attributes_to_hdf5_group(group, name, data):
+        group.attrs[name] = data
+
+
+def get_architecture_file(model_file):
+    """
+    :return: json file that pairs with a weights-only model file, e.g. model.h5 -> model.json
+    """
+    return os.path.splitext(model_file)[0] + ".json"
+
+
+def get_weights_snapshot(model):
+    """
+    Copies the weights of every layer to host memory in one backend call.
+    :return: list of (layer name, weight names, weight values)
+    """
+    layers = [layer for layer in model.layers]
+    symbolic_weights = [weight for layer in layers for weight in layer.weights]
+    values = K.batch_get_value(symbolic_weights)
+    snapshot = list()
+    i = 0
+    for layer in layers:
+        weight_names = list()
+        for j, weight in enumerate(layer.weights):
+            name = str(weight.name) if getattr(weight, "name", None) else "param_{}".format(j)
+            weight_names.append(name)
+        snapshot.append((layer.name, weight_names, values[i:i + len(weight_names)]))
+        i += len(weight_names)
+    return snapshot
+
+
+def write_weights_to_hdf5_group(group, snapshot):
+    """
+    Writes a snapshot in the layout of keras' save_weights, so that model.load_weights and load_model can read it.
+    """
+    import keras
+    save_attributes_to_hdf5_group(group, "layer_names", [name.encode("utf8") for name, _, _ in snapshot])
+    group.attrs["backend"] = K.backend().encode("utf8")
+    group.attrs["keras_version"] = str(keras.__version__).encode("utf8")
+    for layer_name, weight_names, values in snapshot:
+        layer_group = group.create_group(layer_name)
+        save_attributes_to_hdf5_group(layer_group, "weight_names", [name.encode("utf8") for name in weight_names])
+        for name, value in zip(weight_names, values):
+            dataset = layer_group.create_dataset(name, value.shape, dtype=value.dtype)
+            if not value.shape:
+                dataset[()] = value
+            else:
+                dataset[:] = value
+
+
+def write_snapshot(filepath, snapshot, model_config=None):
+    """
+    Writes a weights snapshot to filepath. With model_config, the file can be opened with keras' load_model (the
+    optimizer state is not saved, so the loaded model is not compiled). The file is written next to its destination
+    and renamed, so a reader never sees a partial checkpoint.
+    """
+    tmp_filepath = filepath + ".tmp"
+    with h5py.File(tmp_filepath, "w") as f:
+        if model_config is None:
+            write_weights_to_hdf5_group(f, snapshot)
+        else:
+            import keras
+            f.attrs["keras_version"] = str(keras.__version__).encode("utf8")
+            f.attrs["backend"] = K.backend().encode("utf8")
+            f.attrs["model_config"] = model_config.encode("utf8")
+            write_weights_to_hdf5_group(f.create_group("model_weights"), snapshot)
+    os.replace(tmp_filepath, filepath)
+
+
+class AsyncModelCheckpoint(Callback):
+    """
+    Checkpoint callback that does not block training: at the end of an epoch the weights are copied to host memory
+    and written to disk by a background thread. The optimizer state is never saved.
+    :param filepath: checkpoint file, written when the monitored value improves (or every epoch if save_best_only is
+    False).
+    :param monitor: quantity to monitor.
+    :param mode: "min", "max" or "auto".
+    :param save_best_only: if True, filepath only holds the best epoch.
+    :param save_weights_only: if True, filepath holds only the weights and the architecture is written once to
+    architecture_file. Otherwise filepath can be opened with load_model.
+    :param architecture_file: json architecture paired with weights-only checkpoints. Default is get_architecture_file.
+    :param n_last_checkpoints: if > 0, the weights of the last n epochs are also kept in <filepath>_epoch-XXX.h5.
+    :param verbose: 1 prints a message for every written checkpoint.
+    """
+
+    def __init__(self, filepath, monitor="val_loss", mode="auto", save_best_only=True, save_weights_only=False,
+                 architecture_file=None, n_last_checkpoints=0, verbose=1):
+        super(AsyncModelCheckpoint, self).__init__()
+        self.filepath = filepath
+        self.monitor = monitor
+        self.save_best_only = save_best_only
+        self.save_weights_only = save_weights_only
+        self.architecture_file = architecture_file or get_architecture_file(filepath)
+        self.n_last_checkpoints = n_last_checkpoints
+        self.verbose = verbose
+        if mode == "max" or (mode == "auto" and ("acc" in monitor or monitor.startswith("fmeasure"))):
+            self.monitor_op = np.greater
+            self.best = -np.inf
+        else:
+            self.monitor_op = np.less
+            self.best = np.inf
+        self.model_config = None
+        self.last_checkpoints = list()
+        self.queue = None
+        self.thread = None
+        self.error = None
+
+    def get_epoch_filepath(self, epoch):
+        return "{}_epoch-{:03d}.h5".format(os.path.splitext(self.filepath)[0], epoch + 1)
+
+    def write(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            try:
+                filepaths, snapshot, epoch, is_rolling = task
+                for filepath in filepaths:
+                    write_snapshot(filepath, snapshot, model_config=self.model_config)
+                    if self.verbose > 0:
+                        print("\nEpoch {:05d}: checkpoint written to {}".format(epoch + 1, filepath))
+                if is_rolling:
+                    self.last_checkpoints.append(filepaths[-1])
+                while len(self.last_checkpoints) > self.n_last_checkpoints:
+                    old_filepath = self.last_checkpoints.pop(0)
+                    if os.path.exists(old_filepath):
+                        os.remove(old_filepath)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def on_train_begin(self, logs=None):
+        if self.save_weights_only:
+            with open(self.architecture_file, "w") as f:
+                f.write(self.model.to_json())
+        else:
+            self.model_config = self.model.to_json()
+        # at most one snapshot waits while another one is written, which bounds the extra host memory
+        self.queue = Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.check_error()
+        logs = logs or {}
+        filepaths = list()
+        if self.save_best_only:
+            current = logs.get(self.monitor)
+            if current is not None and self.monitor_op(current, self.best):
+                if self.verbose > 0:
+                    print("\nEpoch {:05d}: {} improved from {:0.5f} to {:0.5f}".format(
+                        epoch + 1, self.monitor, self.best, current))
+                self.best = current
+                filepaths.append(self.filepath)
+        else:
+            filepaths.append(self.filepath)
+        is_rolling = self.n_last_checkpoints > 0
+        if is_rolling:
+            filepaths.append(self.get_epoch_filepath(epoch))
+        if filepaths:
+            self.queue.put((filepaths, get_weights_snapshot(self.model), epoch, is_rolling))
+
+    def on_train_end(self, logs=None):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.check_error()
+
+
+class TimingCallback(Callback):
+    """
+    Records for every training step the time spent waiting for the generator (from the end of the previous step to
+    the beginning of this one), the time of the train step, the batch size in bytes and the samples per second, with
+    the generator stages (unet3d.utils.timing) timed since the previous step. Batches are produced ahead by the
+    generator queue, so the stages are not those of the batch of the step. Rows are appended to filepath as json
+    lines, one summary row per epoch (phase "epoch") and the stages timed during validation (phase "validation").
+    The training generator must be wrapped with TimedGenerator to record the batch sizes.
+    :param filepath: jsonl file.
+    :param timer: StageTimer enabled for the duration of the training.
+    """
+
+    def __init__(self, filepath, timer=stage_timer):
+        super(TimingCallback, self).__init__()
+        self.filepath = filepath
+        self.timer = timer
+        self.file = None
+        self.epoch = 0
+        self.last_end = None
+        self.batch_begin = None
+        self.reset_epoch()
+
+    def reset_epoch(self):
+        self.n_steps = 0
+        self.n_samples = 0
+        self.wait_time = 0.
+        self.step_time = 0.
+        self.stage_times = dict([(name, 0.) for name in STAGES])
+
+    def write(self, row):
+        self.file.write(json.dumps(row) + "\n")
+
+    def on_train_begin(self, logs=None):
+        self.timer.enable()
+        self.file = open(self.filepath, "a")
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.reset_epoch()
+        self.last_end = time.perf_counter()
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_begin = time.perf_counter()
+
+    def on_batch_end(self, batch, logs=None):
+        end = time.perf_counter()
+        logs = logs or {}
+        wait_time = self.batch_begin - self.last_end
+        step_time = end - self.batch_begin
+        size = int(logs.get("size", 0))
+        stages = self.timer.pop_stages()
+        row = {"epoch": self.epoch + 1, "step": batch, "wait": wait_time, "step_time": step_time,
+               "batch_bytes": self.timer.pop_batch_bytes(), "samples_per_second": size / (wait_time + step_time)}
+        for name, (seconds, count) in stages.items():
+            row[name] = seconds
+            self.stage_times[name] = self.stage_times.get(name, 0.) + seconds
+        self.write(row)
+        self.n_steps += 1
+        self.n_samples += size
+        self.wait_time += wait_time
+        self.step_time += step_time
+        self.last_end = end
+
+    def on_epoch_end(self, epoch, logs=None):
+        validation_stages = self.timer.pop_stages()
+        if validation_stages:
+            row = {"epoch": epoch + 1, "phase": "validation", "seconds": time.perf_counter() - self.last_end}
+            row.update(dict([(name, seconds) for name, (seconds, _) in validation_stages.items()]))
+            self.write(row)
+        total_time = self.wait_time + self.step_time
+        wait_fraction = self.wait_time / total_time if total_time > 0 else 0.
+        samples_per_second = self.n_samples / total_time if total_time > 0 else 0.
+        row = {"epoch": epoch + 1, "phase": "epoch", "steps": self.n_steps, "wait": self.wait_time,
+               "step_time": self.step_time, "wait_fraction": wait_fraction, "samples_per_second": samples_per_second}
+        row.update(self.stage_times)
+        self.write(row)
+        self.file.flush()
+        print(">> epoch {}: data wait {:.1%} of {:.0f}s, {:.1f} samples/s, generator {}".format(
+            epoch + 1, wait_fraction, total_time, samples_per_second,
+            ", ".join(["{} {:.0f}s".format(name, seconds) for name, seconds in sorted(self.stage_times.items())])))
+
+    def on_train_end(self, logs=None):
+        self.timer.enable(False)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
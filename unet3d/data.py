@@ -9,17 +9,31 @@ import unet3d.utils.print_utils as print_utils
 # from .normalize_minh import normalize_minh_data_storage, reslice_image_set
 from unet3d.normalize import normalize_data_storage, reslice_image_set
 from unet3d.denoise import denoise_data_storage
+from unet3d.data_memmap import is_memmap_data_dir, open_memmap_data_file
+from unet3d.data_compact import get_data_atom, encode_data, get_node_scale
+from unet3d.data_compact import open_compact_data_file, write_compact_data_file
+from unet3d.data_cropped import write_cropped_data_to_file, is_cropped_hdf5_file, CroppedDataFile
+from unet3d.utils.foreground import write_foreground_storage
 
 
-def create_data_file(out_file, n_channels, n_samples, image_shape):
+def create_data_file(out_file, n_channels, n_samples, image_shape, data_dtype="float32", scale=None):
+    """
+    :param data_dtype: storage of the intensities: "float32", "float16" or "int16" (round(data * scale)). The data
+    is upcast to float32 when read through open_data_file.
+    :param scale: scale of the int16 storage.
+    """
     hdf5_file = tables.open_file(out_file, mode='w')
     filters = tables.Filters(complevel=5, complib='blosc')
 
     data_shape = tuple([0, n_channels] + list(image_shape))
     truth_shape = tuple([0, 1] + list(image_shape))
 
-    data_storage = hdf5_file.create_earray(hdf5_file.root, 'data', tables.Float32Atom(), shape=data_shape,
+    data_storage = hdf5_file.create_earray(hdf5_file.root, 'data', get_data_atom(data_dtype), shape=data_shape,
                                            filters=filters, expectedrows=n_samples)
+    if data_dtype == "int16":
+        if scale is None:
+            raise ValueError("int16 storage needs a scale")
+        data_storage.attrs.scale = scale
     truth_storage = hdf5_file.create_earray(hdf5_file.root, 'truth', tables.UInt8Atom(), shape=truth_shape,
                                             filters=filters, expectedrows=n_samples)
     affine_storage = hdf5_file.create_earray(hdf5_file.root, 'affine', tables.Float32Atom(), shape=(0, 4, 4),
@@ -36,10 +50,12 @@ def create_data_file(out_file, n_channels, n_samples, image_shape):
 
 
 def write_image_data_to_file(image_files, data_storage, truth_storage, image_shape, n_channels, affine_storage,
-                             truth_dtype=np.uint8, crop=True):
+                             truth_dtype=np.uint8, crop=True, image_cache=None, is_fast_crop=False,
+                             crop_threshold=None):
     for set_of_files in image_files:
         images = reslice_image_set(
-            set_of_files, image_shape, label_indices=len(set_of_files) - 1, crop=crop)
+            set_of_files, image_shape, label_indices=len(set_of_files) - 1, crop=crop, image_cache=image_cache,
+            is_fast_crop=is_fast_crop, crop_threshold=crop_threshold)
         subject_data = [image.get_fdata() for image in images]
 
         # data_temp = subject_data[0]
@@ -55,7 +71,8 @@ def write_image_data_to_file(image_files, data_storage, truth_storage, image_sha
 
 def add_data_to_storage(data_storage, truth_storage, affine_storage, subject_data,
                         affine, n_channels, truth_dtype):
-    data_storage.append(np.asarray(subject_data[:n_channels])[np.newaxis])
+    data_storage.append(encode_data(np.asarray(subject_data[:n_channels]), str(data_storage.dtype),
+                                    get_node_scale(data_storage))[np.newaxis])
     truth_storage.append(np.asarray(subject_data[n_channels], dtype=truth_dtype)[
         np.newaxis][np.newaxis])
     affine_storage.append(np.asarray(affine)[np.newaxis])
@@ -64,7 +81,9 @@ def add_data_to_storage(data_storage, truth_storage, affine_storage, subject_dat
 def write_data_to_file(training_data_files, out_file, image_shape, brats_dir,
                        config, truth_dtype=np.uint8,
                        subject_ids=None, normalize=True, crop=True, is_normalize="z",
-                       is_hist_match="0", dataset="test", is_denoise="0"):
+                       is_hist_match="0", dataset="test", is_denoise="0", data_dtype="float32",
+                       is_crop_foreground=False, crop_margin=0, crop_threshold=None, image_cache=None,
+                       is_fast_crop=False):
     """
     Takes in a set of training images and writes those images to an hdf5 file.
     :param training_data_files: List of tuples containing the training data files. The modalities should be listed in
@@ -74,27 +93,58 @@ def write_data_to_file(training_data_files, out_file, image_shape, brats_dir,
     :param out_file: Where the hdf5 file will be written to.
     :param image_shape: Shape of the images that will be saved to the hdf5 file.
     :param truth_dtype: Default is 8-bit unsigned integer. 
+    :param data_dtype: storage of the intensities, "float32", "float16" or "int16". The images are denoised and
+    normalized in a float32 file, then copied with write_compact_data_file, which reports the quantization error.
+    :param is_crop_foreground: if True, each subject is stored cropped to its foreground bounding box (extended by
+    crop_margin voxels, foreground above crop_threshold if set) at its native resolution instead of being resized to
+    image_shape, see unet3d.data_cropped.write_cropped_data_to_file. The foreground of each subject (above
+    crop_threshold if set, non-zero otherwise) is stored with the data, see unet3d.utils.foreground.
+    :param is_fast_crop: if True, the resized subjects (crop=True) are cropped to their foreground above
+    crop_threshold instead of nilearn's background mask, see unet3d.normalize.get_cropping_parameters.
+    :param image_cache: unet3d.utils.image_cache.ImageCache of the decoded images, shared by the data files built
+    from the same images, or None.
     :return: Location of the hdf5 file with the image data written to it. 
     """
+    if data_dtype != "float32" and is_crop_foreground:
+        raise ValueError("cropped subjects are stored as float32")
+    if data_dtype != "float32":
+        float32_file = os.path.splitext(out_file)[0] + "_float32.h5"
+        write_data_to_file(training_data_files, float32_file, image_shape, brats_dir, config,
+                           truth_dtype=truth_dtype, subject_ids=subject_ids, normalize=normalize, crop=crop,
+                           is_normalize=is_normalize, is_hist_match=is_hist_match, dataset=dataset,
+                           is_denoise=is_denoise, crop_threshold=crop_threshold, image_cache=image_cache,
+                           is_fast_crop=is_fast_crop)
+        write_compact_data_file(float32_file, out_file, data_dtype)
+        os.remove(float32_file)
+        return out_file
+
     n_samples = len(training_data_files)
     n_channels = len(training_data_files[0]) - 1
 
-    try:
-        hdf5_file, data_storage, truth_storage, affine_storage = create_data_file(out_file,
-                                                                                  n_channels=n_channels,
-                                                                                  n_samples=n_samples,
-                                                                                  image_shape=image_shape,
-                                                                                  )
-    except Exception as e:
-        # If something goes wrong, delete the incomplete data file
-        os.remove(out_file)
-        raise e
-
-    write_image_data_to_file(training_data_files, data_storage, truth_storage, image_shape,
-                             truth_dtype=truth_dtype, n_channels=n_channels,
-                             affine_storage=affine_storage, crop=crop)
-    if subject_ids:
-        hdf5_file.create_array(hdf5_file.root, 'subject_ids', obj=subject_ids)
+    if is_crop_foreground:
+        hdf5_file, data_storage = write_cropped_data_to_file(training_data_files, out_file, truth_dtype=truth_dtype,
+                                                             subject_ids=subject_ids, margin=crop_margin,
+                                                             threshold=crop_threshold, image_cache=image_cache)
+    else:
+        try:
+            hdf5_file, data_storage, truth_storage, affine_storage = create_data_file(out_file,
+                                                                                      n_channels=n_channels,
+                                                                                      n_samples=n_samples,
+                                                                                      image_shape=image_shape,
+                                                                                      )
+        except Exception as e:
+            # If something goes wrong, delete the incomplete data file
+            os.remove(out_file)
+            raise e
+
+        write_image_data_to_file(training_data_files, data_storage, truth_storage, image_shape,
+                                 truth_dtype=truth_dtype, n_channels=n_channels,
+                                 affine_storage=affine_storage, crop=crop, image_cache=image_cache,
+                                 is_fast_crop=is_fast_crop, crop_threshold=crop_threshold)
+        if subject_ids:
+            hdf5_file.create_array(hdf5_file.root, 'subject_ids', obj=subject_ids)
+        # before normalization, which moves the background away from 0
+        write_foreground_storage(hdf5_file, data_storage, threshold=crop_threshold)
 
     if is_denoise != "0":
         print_utils.print_separator()
@@ -123,4 +173,9 @@ def write_data_to_file(training_data_files, out_file, image_shape, brats_dir,
 
 def open_data_file(filename, readwrite="r"):
     # return tables.open_file(filename, readwrite, driver="H5FD_CORE")
-    return tables.open_file(filename, readwrite)
+    if is_memmap_data_dir(filename):
+        return open_memmap_data_file(filename)
+    hdf5_file = tables.open_file(filename, readwrite)
+    if is_cropped_hdf5_file(hdf5_file):
+        return CroppedDataFile(hdf5_file)
+    return open_compact_data_file(hdf5_file)
@@ -0,0 +1,216 @@
+import os
+import json
+
+import numpy as np
+import tables
+
+import unet3d.utils.print_utils as print_utils
+
+
+DATA_DTYPES = ("float32", "float16", "int16")
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+INT16_MAX = float(np.iinfo(np.int16).max)
+
+
+def get_data_atom(data_dtype="float32"):
+    if data_dtype not in DATA_DTYPES:
+        raise ValueError("data dtype {} NotImplemented error. Please check".format(data_dtype))
+    return tables.Atom.from_dtype(np.dtype(data_dtype))
+
+
+def get_int16_scale(max_value):
+    """
+    :return: scale mapping [-max_value, max_value] to the int16 range
+    """
+    return INT16_MAX / max_value if max_value > 0 else 1.
+
+
+def encode_data(data, data_dtype="float32", scale=None):
+    """
+    Converts float intensities to the storage dtype: float16 is clipped to its range, int16 stores
+    round(data * scale).
+    """
+    data = np.asarray(data, dtype=np.float32)
+    if data_dtype == "float16":
+        return np.clip(data, -FLOAT16_MAX, FLOAT16_MAX).astype(np.float16)
+    if data_dtype == "int16":
+        return np.clip(np.rint(data * scale), -INT16_MAX, INT16_MAX).astype(np.int16)
+    return data
+
+
+def decode_data(data, scale=None):
+    data = np.asarray(data, dtype=np.float32)
+    if scale is not None:
+        data *= np.float32(1. / scale)
+    return data
+
+
+def get_node_scale(node):
+    """
+    :return: int16 scale stored in the attributes of a pytables node, None if there is none
+    """
+    if "scale" in node.attrs:
+        return float(node.attrs.scale)
+    return None
+
+
+class DecodedArray(object):
+    """
+    Array of float16 or scaled int16 intensities that reads as float32, like the pytables array of a float32 data
+    file: indexing upcasts only the part that is read. Writes are encoded back to the storage dtype.
+    """
+
+    def __init__(self, array, scale=None):
+        self.array = array
+        self.scale = scale
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    @property
+    def nrows(self):
+        return self.array.shape[0]
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, key):
+        return decode_data(self.array[key], self.scale)
+
+    def __setitem__(self, key, value):
+        self.array[key] = encode_data(value, str(self.array.dtype), self.scale)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def read(self):
+        return self[:]
+
+
+class DecodedRoot(object):
+    def __init__(self, root, data):
+        self._root = root
+        self.data = data
+
+    def __getattr__(self, name):
+        return getattr(self._root, name)
+
+    def __contains__(self, name):
+        return name in self._root
+
+
+class DecodedDataFile(object):
+    """
+    Opened pytables data file whose root.data is stored as float16 or scaled int16, see write_compact_data_file.
+    root.data reads as float32, the other nodes are those of the file.
+    """
+
+    def __init__(self, hdf5_file):
+        self.hdf5_file = hdf5_file
+        self.filename = hdf5_file.filename
+        self.root = DecodedRoot(hdf5_file.root, DecodedArray(hdf5_file.root.data, get_node_scale(hdf5_file.root.data)))
+
+    @property
+    def isopen(self):
+        return self.hdf5_file.isopen
+
+    def close(self):
+        self.hdf5_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_compact_node(node):
+    return np.dtype(node.dtype) != np.float32
+
+
+def open_compact_data_file(hdf5_file):
+    """
+    :param hdf5_file: opened pytables data file.
+    :return: hdf5_file, wrapped in a DecodedDataFile if its data is not stored as float32
+    """
+    if "data" in hdf5_file.root and is_compact_node(hdf5_file.root.data):
+        return DecodedDataFile(hdf5_file)
+    return hdf5_file
+
+
+def get_quantization_error(data, decoded):
+    """
+    :return: dict of the max absolute error, root mean square error and the rmse relative to the std of the data
+    """
+    difference = decoded.astype(np.float64) - data
+    std = float(np.std(data))
+    rmse = float(np.sqrt(np.mean(np.square(difference))))
+    return {"max_error": float(np.max(np.abs(difference))), "rmse": rmse,
+            "relative_rmse": rmse / std if std > 0 else 0.}
+
+
+def get_quantization_report_file(data_file):
+    """
+    :return: json report of the quantization of a data file, e.g. data.h5 -> data_quantization.json
+    """
+    return os.path.splitext(data_file)[0] + "_quantization.json"
+
+
+def write_compact_data_file(in_file, out_file, data_dtype="float16"):
+    """
+    Copies a float32 data file (as written by unet3d.data.write_data_to_file) with its data stored as float16 or
+    scaled int16, which halves the volume read and decompressed per patch. The int16 scale maps the largest absolute
+    intensity of the file to the int16 range and is stored in root.data.attrs.scale. The quantization error of each
+    channel is written to get_quantization_report_file(out_file).
+    :return: quantization report
+    """
+    print_utils.print_processing("store data of {} as {}".format(in_file, data_dtype))
+    in_hdf5 = tables.open_file(in_file, "r")
+    out_hdf5 = tables.open_file(out_file, mode="w")
+    try:
+        data = in_hdf5.root.data
+        n_channels = data.shape[1]
+        scale = None
+        if data_dtype == "int16":
+            max_value = max([float(np.max(np.abs(data[index]))) for index in range(data.shape[0])])
+            scale = get_int16_scale(max_value)
+
+        for node in in_hdf5.root:
+            if node.name == "data":
+                continue
+            node._f_copy(out_hdf5.root, node.name)
+        data_storage = out_hdf5.create_earray(out_hdf5.root, "data", get_data_atom(data_dtype),
+                                              shape=(0,) + tuple(data.shape[1:]), filters=data.filters,
+                                              expectedrows=data.shape[0])
+        if scale is not None:
+            data_storage.attrs.scale = scale
+
+        errors = [list() for _ in range(n_channels)]
+        n_clipped = 0
+        for index in range(data.shape[0]):
+            subject = data[index]
+            encoded = encode_data(subject, data_dtype, scale)
+            data_storage.append(encoded[np.newaxis])
+            decoded = decode_data(encoded, scale)
+            n_clipped += int(np.sum(np.abs(subject) > FLOAT16_MAX)) if data_dtype == "float16" else 0
+            for channel in range(n_channels):
+                errors[channel].append(get_quantization_error(subject[channel], decoded[channel]))
+    finally:
+        out_hdf5.close()
+        in_hdf5.close()
+
+    report = {"data_dtype": data_dtype, "scale": scale, "n_clipped": n_clipped, "channels": list()}
+    for channel_errors in errors:
+        report["channels"].append(dict([(key, float(np.max([error[key] for error in channel_errors])))
+                                        for key in ("max_error", "rmse", "relative_rmse")]))
+    with open(get_quantization_report_file(out_file), "w") as f:
+        json.dump(report, f, indent=4)
+    print(">> quantization error per channel (max, rmse): {}".format(
+        [(round(channel["max_error"], 5), round(channel["rmse"], 5)) for channel in report["channels"]]))
+    return report
@@ -0,0 +1,259 @@
+import os
+
+import numpy as np
+import nibabel as nib
+import tables
+
+import unet3d.utils.print_utils as print_utils
+from unet3d.utils.foreground import compute_foreground, get_bbox_from_projections, get_bbox_slices
+from unet3d.utils.foreground import create_foreground_storage, add_foreground_to_storage, FOREGROUND_NODE
+
+
+CROPPED_LAYOUT = "cropped"
+SUBJECT_GROUP = "subjects"
+
+
+def get_subject_node_name(name, index):
+    return "{}_{:05d}".format(name, index)
+
+
+def get_cropped_affine(affine, bbox_start):
+    """
+    :return: affine of the volume cropped at bbox_start, so that it stays aligned with the full image in world space
+    """
+    cropped_affine = np.array(affine, dtype=np.float32)
+    cropped_affine[:3, 3] += np.dot(cropped_affine[:3, :3], bbox_start)
+    return cropped_affine
+
+
+class CroppedSubjectArray(object):
+    """
+    Per-subject arrays of different shapes, read like the (n_subjects, ...) array of a resized data file:
+    array[index] returns the volume of a subject and array[index, ...] indexes into it. shape is
+    (n_subjects, n_channels) followed by None for the spatial axes, whose sizes are in root.shapes.
+    """
+
+    def __init__(self, group, name, n_channels, shapes):
+        self.group = group
+        self.name = name
+        self.n_channels = n_channels
+        self.shapes = shapes
+
+    def get_node(self, index):
+        return getattr(self.group, get_subject_node_name(self.name, int(index)))
+
+    @property
+    def nrows(self):
+        return self.shapes.nrows
+
+    @property
+    def shape(self):
+        return (self.nrows, self.n_channels, None, None, None)
+
+    @property
+    def dtype(self):
+        return self.get_node(0).dtype
+
+    def __len__(self):
+        return self.nrows
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self.get_node(key[0])[key[1:]]
+        return self.get_node(key).read()
+
+    def __setitem__(self, index, value):
+        self.get_node(index)[...] = value
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class CroppedRoot(object):
+    def __init__(self, root):
+        self._root = root
+        group = getattr(root, SUBJECT_GROUP)
+        self.data = CroppedSubjectArray(group, "data", int(root._v_attrs.n_channels), root.shapes)
+        self.truth = CroppedSubjectArray(group, "truth", 1, root.shapes)
+        if get_subject_node_name(FOREGROUND_NODE, 0) in group:
+            self.foreground = CroppedSubjectArray(group, FOREGROUND_NODE, 1, root.shapes)
+
+    def __getattr__(self, name):
+        return getattr(self._root, name)
+
+    def __contains__(self, name):
+        return name in self._root
+
+
+class CroppedDataFile(object):
+    """
+    Opened pytables data file storing each subject cropped to its foreground bounding box, at the native resolution
+    (see write_cropped_data_to_file). root.data[index] and root.truth[index] are the volumes of a subject,
+    root.shapes[index] their spatial shape, root.bbox[index] the start and stop of the crop in the full image,
+    root.image_shapes[index] the shape of the full image and root.affine[index] the affine of the cropped volume.
+    root.foreground[index] is the foreground mask of a subject and root.foreground_bbox[index] its bounding box, in
+    the cropped volume.
+    """
+
+    def __init__(self, hdf5_file):
+        self.hdf5_file = hdf5_file
+        self.filename = hdf5_file.filename
+        self.root = CroppedRoot(hdf5_file.root)
+
+    @property
+    def isopen(self):
+        return self.hdf5_file.isopen
+
+    def close(self):
+        self.hdf5_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_cropped_hdf5_file(hdf5_file):
+    return getattr(hdf5_file.root._v_attrs, "layout", None) == CROPPED_LAYOUT
+
+
+def is_cropped_data_file(data_file):
+    return isinstance(data_file, CroppedDataFile)
+
+
+def get_image_shapes(data_file):
+    """
+    :return: spatial shape of the subjects: one shape shared by all the subjects of a resized data file, or an
+    array of one shape per subject for a cropped data file
+    """
+    if is_cropped_data_file(data_file):
+        return data_file.root.shapes[:]
+    return data_file.root.data.shape[-3:]
+
+
+def get_subject_shape(image_shapes, index):
+    """
+    :param image_shapes: as returned by get_image_shapes.
+    :return: spatial shape of the subject index
+    """
+    if np.ndim(image_shapes) == 2:
+        return tuple([int(dim) for dim in image_shapes[index]])
+    return tuple(image_shapes)
+
+
+def create_cropped_data_file(out_file, n_channels, n_samples, data_dtype="float32"):
+    hdf5_file = tables.open_file(out_file, mode='w')
+    hdf5_file.root._v_attrs.layout = CROPPED_LAYOUT
+    hdf5_file.root._v_attrs.n_channels = n_channels
+    hdf5_file.root._v_attrs.data_dtype = data_dtype
+    hdf5_file.create_group(hdf5_file.root, SUBJECT_GROUP)
+    filters = tables.Filters(complevel=5, complib='blosc')
+    for name, shape in (("shapes", (0, 3)), ("image_shapes", (0, 3)), ("bbox", (0, 2, 3))):
+        hdf5_file.create_earray(hdf5_file.root, name, tables.Int32Atom(), shape=shape, expectedrows=n_samples)
+    hdf5_file.create_earray(hdf5_file.root, 'affine', tables.Float32Atom(), shape=(0, 4, 4), filters=filters,
+                            expectedrows=n_samples)
+    create_foreground_storage(hdf5_file, n_samples)
+    return hdf5_file
+
+
+def add_cropped_subject(hdf5_file, data, truth, affine, margin=0, threshold=None, truth_dtype=np.uint8):
+    """
+    Appends a subject cropped to the bounding box of its foreground (see unet3d.utils.foreground.compute_foreground
+    for threshold), extended by margin voxels.
+    :param data: array of shape (n_channels, x, y, z).
+    :param truth: array of shape (x, y, z).
+    :param affine: affine of the full image.
+    """
+    index = hdf5_file.root.shapes.nrows
+    foreground = compute_foreground(data, threshold=threshold)
+    start, stop = get_bbox_from_projections(foreground["projections"], margin=margin)
+    crop = get_bbox_slices(start, stop)
+    group = getattr(hdf5_file.root, SUBJECT_GROUP)
+    filters = tables.Filters(complevel=5, complib='blosc')
+    data_dtype = np.dtype(hdf5_file.root._v_attrs.data_dtype)
+    hdf5_file.create_carray(group, get_subject_node_name("data", index),
+                            obj=np.asarray(data[(slice(None),) + crop], dtype=data_dtype), filters=filters)
+    hdf5_file.create_carray(group, get_subject_node_name("truth", index),
+                            obj=np.asarray(truth[crop], dtype=truth_dtype)[np.newaxis], filters=filters)
+    hdf5_file.create_carray(group, get_subject_node_name(FOREGROUND_NODE, index), obj=foreground["mask"][crop],
+                            filters=filters)
+    add_foreground_to_storage(hdf5_file, dict(foreground, start=foreground["start"] - start,
+                                              stop=foreground["stop"] - start), is_mask=False)
+    hdf5_file.root.shapes.append((stop - start)[np.newaxis])
+    hdf5_file.root.image_shapes.append(np.asarray(data.shape[-3:], dtype=np.int32)[np.newaxis])
+    hdf5_file.root.bbox.append(np.stack([start, stop])[np.newaxis])
+    hdf5_file.root.affine.append(get_cropped_affine(affine, start)[np.newaxis])
+
+
+def read_subject(set_of_files, image_cache=None):
+    """
+    Reads the modalities and the truth (last file) of a subject at their native resolution.
+    :param image_cache: unet3d.utils.image_cache.ImageCache of the decoded images, or None
+    :return: data (n_channels, x, y, z), truth (x, y, z), affine
+    """
+    from unet3d.utils.utils import read_image
+    images = [read_image(path, image_cache=image_cache) for path in set_of_files]
+    data = np.asarray([image.get_fdata(dtype=np.float32) for image in images[:-1]])
+    truth = np.asarray(images[-1].get_data())
+    return data, truth, images[0].affine
+
+
+def write_cropped_data_to_file(training_data_files, out_file, truth_dtype=np.uint8, subject_ids=None, margin=0,
+                               threshold=None, image_cache=None):
+    """
+    Writes each subject cropped to its foreground bounding box (plus margin voxels), without resizing, so that
+    neither the padding around the body nor the interpolation to a common shape is stored (see add_cropped_subject
+    for margin and threshold). Open the file with
+    unet3d.data.open_data_file.
+    :return: opened pytables file, data storage to be denoised / normalized in place
+    """
+    n_channels = len(training_data_files[0]) - 1
+    hdf5_file = create_cropped_data_file(out_file, n_channels, len(training_data_files))
+    n_voxels, n_image_voxels = 0, 0
+    for set_of_files in training_data_files:
+        data, truth, affine = read_subject(set_of_files, image_cache=image_cache)
+        add_cropped_subject(hdf5_file, data, truth, affine, margin=margin, threshold=threshold,
+                            truth_dtype=truth_dtype)
+        n_voxels += int(np.prod(hdf5_file.root.shapes[-1]))
+        n_image_voxels += int(np.prod(data.shape[-3:]))
+    if subject_ids:
+        hdf5_file.create_array(hdf5_file.root, 'subject_ids', obj=subject_ids)
+    print_utils.print_processing("cropped subjects keep {:.1f}% of the voxels".format(
+        100. * n_voxels / max(n_image_voxels, 1)))
+    return hdf5_file, CroppedRoot(hdf5_file.root).data
+
+
+def uncrop_volume(volume, bbox, image_shape, fill_value=0):
+    """
+    Puts a cropped volume (..., x, y, z) back in the full image.
+    :param bbox: start and stop of the crop, as in root.bbox.
+    """
+    full = np.full(tuple(volume.shape[:-3]) + tuple(image_shape), fill_value, dtype=volume.dtype)
+    start, stop = np.asarray(bbox[0]), np.asarray(bbox[1])
+    full[(Ellipsis,) + tuple([slice(int(a), int(b)) for a, b in zip(start, stop)])] = volume
+    return full
+
+
+def get_full_affine(data_file, index):
+    """
+    :return: affine of the full image of a subject of a cropped data file
+    """
+    affine = np.array(data_file.root.affine[index], dtype=np.float32)
+    affine[:3, 3] -= np.dot(affine[:3, :3], data_file.root.bbox[index][0])
+    return affine
+
+
+def write_uncropped_image(data_file, index, volume, out_file, image_writer=None, kind=None):
+    """
+    Writes a volume predicted on a cropped subject in the grid of its full image.
+    :param image_writer: unet3d.utils.image_writer.ImageWriter the image is written with (kind is its dtype policy),
+    or None to write it with nibabel in this thread.
+    """
+    image = nib.Nifti1Image(uncrop_volume(volume, data_file.root.bbox[index], data_file.root.image_shapes[index]),
+                            get_full_affine(data_file, index))
+    if image_writer is not None:
+        return image_writer.write(image, out_file, kind=kind)
+    image.to_filename(out_file)
+    return os.path.abspath(out_file)
@@ -0,0 +1,193 @@
+import os
+import argparse
+
+from keras.layers import Input, Permute
+from keras.models import Model
+
+from unet3d.training import load_old_model
+from unet3d.export import get_inbound, check_equivalence
+
+
+CHANNELS_FIRST = "channels_first"
+CHANNELS_LAST = "channels_last"
+# layers computing the same thing whatever the position of the channels, as long as all inputs share it
+ELEMENTWISE_LAYERS = ("Activation", "LeakyReLU", "ELU", "ThresholdedReLU", "ReLU", "Add", "Subtract", "Multiply",
+                      "Average", "Maximum", "Minimum", "Dropout", "GaussianNoise", "GaussianDropout", "AlphaDropout")
+# layers working on the channel axis given by "axis"
+AXIS_LAYERS = ("Concatenate", "BatchNormalization", "BatchNorm", "GroupNormalization", "InstanceNormalization")
+
+
+def get_channels_last_file(model_file):
+    """
+    :return: file of the channels-last model, e.g. model.h5 -> model_channels_last.h5
+    """
+    return os.path.splitext(model_file)[0] + "_channels_last.h5"
+
+
+def get_channels_last_axis(axis, n_dims):
+    """
+    Axis of a channels-first tensor once its channels are moved last, e.g. 1 -> -1, 2 -> 1
+    """
+    axis = axis % n_dims
+    if axis == 0:
+        return 0
+    if axis == 1:
+        return -1
+    return axis - 1
+
+
+def to_channels_last(tensor):
+    n_dims = len(tensor._keras_shape)
+    return Permute(tuple(range(2, n_dims)) + (1,))(tensor)
+
+
+def to_channels_first(tensor, name=None):
+    n_dims = len(tensor._keras_shape)
+    return Permute((n_dims - 1,) + tuple(range(1, n_dims - 1)), name=name)(tensor)
+
+
+def is_spatial(tensor):
+    return len(tensor._keras_shape) > 2
+
+
+def is_convertible(layer):
+    class_name = layer.__class__.__name__
+    config = layer.get_config()
+    if class_name == "Activation":
+        # softmax works on the last axis, which is not the same axis once the channels are last
+        return config["activation"] != "softmax"
+    if class_name in ELEMENTWISE_LAYERS:
+        return True
+    if class_name in AXIS_LAYERS:
+        return isinstance(config["axis"], int)
+    return config.get("data_format") == CHANNELS_FIRST
+
+
+def is_channels_last(model):
+    return any([layer.get_config().get("data_format") == CHANNELS_LAST for layer in model.layers])
+
+
+def convert_to_channels_last(model):
+    """
+    Rebuilds a channels-first model with its layers in channels-last, with the same weights (convolution kernels do
+    not depend on the data format). The inputs and outputs stay channels-first: the transposes are inserted where a
+    channels-last tensor meets a layer that cannot be converted (e.g. Reshape/Dense of the squeeze-excite blocks), and
+    at the outputs, so that the generators, the losses and patch_wise_prediction are unchanged.
+    :return: channels-last model (not compiled), number of inserted transposes
+    """
+    tensors = dict()
+    # tensors of the new graph whose channels are last
+    channels_last = set()
+    transposed = dict()
+    output_names = [layer.name for layer in model.output_layers]
+
+    def get_tensor(tensor, is_last, name=None):
+        new_tensor = tensors[id(tensor)]
+        if not is_spatial(new_tensor) or (id(new_tensor) in channels_last) == is_last:
+            return new_tensor
+        if id(new_tensor) not in transposed:
+            if is_last:
+                transposed[id(new_tensor)] = to_channels_last(new_tensor)
+                channels_last.add(id(transposed[id(new_tensor)]))
+            else:
+                transposed[id(new_tensor)] = to_channels_first(new_tensor, name=name)
+        return transposed[id(new_tensor)]
+
+    for layer in model.layers:
+        class_name = layer.__class__.__name__
+        if class_name == "InputLayer":
+            tensors[id(layer.output)] = Input(batch_shape=layer.batch_input_shape, dtype=layer.dtype,
+                                              name=layer.name)
+            continue
+        inputs, arguments = get_inbound(layer)
+        is_last = is_convertible(layer)
+        config = layer.get_config()
+        if is_last:
+            n_dims = len(layer.get_output_shape_at(0)) if class_name in AXIS_LAYERS else None
+            if "data_format" in config:
+                config["data_format"] = CHANNELS_LAST
+            if class_name in AXIS_LAYERS:
+                config["axis"] = get_channels_last_axis(config["axis"], n_dims)
+            if layer.name in output_names:
+                # the transpose back to channels-first takes the name of the output, used by the losses
+                config["name"] = layer.name + "_channels_last"
+        if isinstance(inputs, list):
+            new_inputs = [get_tensor(tensor, is_last) for tensor in inputs]
+        else:
+            new_inputs = get_tensor(inputs, is_last)
+        new_layer = layer.__class__.from_config(config)
+        new_output = new_layer(new_inputs, **arguments)
+        new_layer.set_weights(layer.get_weights())
+        outputs = layer.get_output_at(0)
+        if not isinstance(outputs, list):
+            outputs, new_output = [outputs], [new_output]
+        for tensor, new_tensor in zip(outputs, new_output):
+            tensors[id(tensor)] = new_tensor
+            if is_last and is_spatial(new_tensor):
+                channels_last.add(id(new_tensor))
+
+    outputs = [get_tensor(tensor, False, name=layer.name) for tensor, layer in zip(model.outputs, model.output_layers)]
+    new_model = Model(inputs=[tensors[id(tensor)] for tensor in model.inputs], outputs=outputs, name=model.name)
+    return new_model, len(transposed)
+
+
+def compile_like(new_model, model):
+    """
+    Compiles new_model with the loss, metrics and a new optimizer of the same configuration as model.
+    """
+    optimizer = model.optimizer.__class__.from_config(model.optimizer.get_config())
+    new_model.compile(optimizer=optimizer, loss=model.loss, metrics=model.metrics, loss_weights=model.loss_weights)
+    return new_model
+
+
+def set_model_data_format(model, data_format=CHANNELS_FIRST):
+    """
+    :param model: channels-first model, compiled or not.
+    :param data_format: "channels_first" returns the model as is. "channels_last" converts it (see
+    convert_to_channels_last), compiled like model. Models that are already channels-last are returned as is.
+    """
+    if data_format == CHANNELS_FIRST or is_channels_last(model):
+        return model
+    if data_format != CHANNELS_LAST:
+        raise ValueError("data format {} NotImplemented error. Please check".format(data_format))
+    new_model, n_transposes = convert_to_channels_last(model)
+    print(">> model converted to channels-last with {} transposes".format(n_transposes))
+    if getattr(model, "optimizer", None) is not None:
+        new_model = compile_like(new_model, model)
+    return new_model
+
+
+def convert_model_file(model_file, out_file=None, tolerance=1e-4):
+    """
+    Saves the channels-last version of a channels-first model file, after checking that it predicts the same.
+    Models that are already channels-last (e.g. trained with data_format "channels_last", see set_model_data_format)
+    are saved unchanged.
+    :return: out_file
+    """
+    if out_file is None:
+        out_file = get_channels_last_file(model_file)
+    model = load_old_model(model_file)
+    if is_channels_last(model):
+        print(">> {} is already channels-last".format(model_file))
+        if os.path.abspath(out_file) != os.path.abspath(model_file):
+            model.save(out_file, include_optimizer=False)
+        return out_file
+    new_model, n_transposes = convert_to_channels_last(model)
+    difference = check_equivalence(model, new_model, tolerance=tolerance)
+    print(">> {} transposes inserted, max difference {:.2e}".format(n_transposes, difference))
+    new_model.save(out_file, include_optimizer=False)
+    print(">> channels-last model saved to {}".format(out_file))
+    return out_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="convert a channels-first model to channels-last")
+    parser.add_argument('-i', '--model_file', type=str, required=True)
+    parser.add_argument('-o', '--out_file', type=str, default=None,
+                        help="default is <model>_channels_last.h5")
+    args = parser.parse_args()
+    convert_model_file(args.model_file, args.out_file)
+
+
+if __name__ == "__main__":
+    main()
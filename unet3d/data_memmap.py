@@ -0,0 +1,182 @@
+import os
+import json
+
+import numpy as np
+import tables
+
+import unet3d.utils.print_utils as print_utils
+from unet3d.data_compact import DecodedArray, get_node_scale
+from unet3d.data_cropped import is_cropped_hdf5_file
+
+
+MEMMAP_NODES = ("data", "truth", "affine")
+# small nodes copied in full when the data file has them
+OPTIONAL_NODES = ("subject_ids", "foreground_bbox", "foreground_voxels")
+MEMMAP_INFO_FILE = "info.json"
+
+
+class MemmapArray(object):
+    """
+    Read-only view of an uncompressed .npy file that behaves like a pytables array: indexing returns an in-memory
+    numpy array, so callers can modify what they get back. Only the pages covered by the index are read from disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.array = np.load(path, mmap_mode="r")
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    @property
+    def nrows(self):
+        return self.array.shape[0]
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, key):
+        value = self.array[key]
+        if isinstance(value, np.ndarray):
+            return np.array(value)
+        return value
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def read(self):
+        return self[:]
+
+
+class MemmapRoot(object):
+    def __init__(self, nodes):
+        self._nodes = nodes
+        for name, node in nodes.items():
+            setattr(self, name, node)
+
+    def __contains__(self, name):
+        return name in self._nodes
+
+
+class MemmapDataFile(object):
+    """
+    Drop-in replacement for an opened pytables data file. Exposes data_file.root.data, .truth, .affine and
+    (if present) .subject_ids and the foreground bounding boxes, backed by memory-mapped .npy files stored in one
+    directory.
+    """
+
+    def __init__(self, data_dir):
+        self.filename = data_dir
+        nodes = dict()
+        for name in list(MEMMAP_NODES) + list(OPTIONAL_NODES):
+            path = get_memmap_node_path(data_dir, name)
+            if os.path.exists(path):
+                nodes[name] = MemmapArray(path)
+        with open(os.path.join(data_dir, MEMMAP_INFO_FILE)) as f:
+            info = json.load(f)
+        if "data" in nodes and nodes["data"].dtype != np.float32:
+            nodes["data"] = DecodedArray(nodes["data"], info["data"].get("scale"))
+        for name in MEMMAP_NODES:
+            if name not in nodes:
+                raise ValueError("{} is missing in memmap data directory {}".format(name, data_dir))
+        self.root = MemmapRoot(nodes)
+        self.isopen = True
+
+    def close(self):
+        for name in list(self.root._nodes):
+            node = self.root._nodes[name]
+            if isinstance(node, DecodedArray):
+                node = node.array
+            if hasattr(node.array, "_mmap") and node.array._mmap is not None:
+                node.array._mmap.close()
+        self.isopen = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_memmap_node_path(data_dir, name):
+    return os.path.join(data_dir, "{}.npy".format(name))
+
+
+def get_memmap_dir(h5_file):
+    """
+    :param h5_file: path of the pytables .h5 data file
+    :return: directory holding the memory-mapped copy, e.g. brats_..._data.h5 -> brats_..._data_memmap
+    """
+    return os.path.splitext(h5_file)[0] + "_memmap"
+
+
+def is_memmap_data_dir(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MEMMAP_INFO_FILE))
+
+
+def is_memmap_data_file(data_file):
+    return isinstance(data_file, MemmapDataFile)
+
+
+def open_memmap_data_file(data_dir):
+    return MemmapDataFile(data_dir)
+
+
+def convert_h5_to_memmap(h5_file, out_dir=None, overwrite=False):
+    """
+    Copies a pytables data file (as written by unet3d.data.write_data_to_file) into uncompressed .npy files that can be
+    memory-mapped. The copy is done subject by subject, so the whole dataset never has to fit in memory.
+    :param h5_file: path of the .h5 data file.
+    :param out_dir: output directory. Default is get_memmap_dir(h5_file).
+    :param overwrite: if False and a complete copy already exists, the conversion is skipped.
+    :return: path of the output directory, which can be passed to unet3d.data.open_data_file.
+    """
+    if out_dir is None:
+        out_dir = get_memmap_dir(h5_file)
+    if is_memmap_data_dir(out_dir) and not overwrite:
+        print(">> {} exists. Will skip!!".format(out_dir))
+        return out_dir
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    info_path = os.path.join(out_dir, MEMMAP_INFO_FILE)
+    if os.path.exists(info_path):
+        os.remove(info_path)
+
+    print_utils.print_processing("convert {} to memmap".format(h5_file))
+    info = dict()
+    hdf5_file = tables.open_file(h5_file, "r")
+    if is_cropped_hdf5_file(hdf5_file):
+        hdf5_file.close()
+        raise ValueError("{} stores cropped subjects of different shapes, which are not memory-mapped".format(h5_file))
+    try:
+        for name in MEMMAP_NODES:
+            node = getattr(hdf5_file.root, name)
+            shape = tuple([int(dim) for dim in node.shape])
+            out_array = np.lib.format.open_memmap(get_memmap_node_path(out_dir, name), mode="w+",
+                                                  dtype=node.dtype, shape=shape)
+            for index in range(node.shape[0]):
+                out_array[index] = node[index]
+            out_array.flush()
+            info[name] = {"shape": list(shape), "dtype": str(node.dtype)}
+            if get_node_scale(node) is not None:
+                info[name]["scale"] = get_node_scale(node)
+            del out_array
+        for name in OPTIONAL_NODES:
+            if name in hdf5_file.root:
+                array = np.asarray(getattr(hdf5_file.root, name).read())
+                np.save(get_memmap_node_path(out_dir, name), array)
+                info[name] = {"shape": list(array.shape), "dtype": str(array.dtype)}
+    finally:
+        hdf5_file.close()
+
+    # written last so that an interrupted conversion is never picked up as complete
+    info["source"] = os.path.abspath(h5_file)
+    with open(info_path, "w") as f:
+        json.dump(info, f, indent=4)
+    return out_dir
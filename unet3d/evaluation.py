@@ -0,0 +1,299 @@
+import os
+import csv
+import glob
+import json
+from multiprocessing import Pool
+
+import numpy as np
+import nibabel as nib
+import pandas as pd
+from scipy.ndimage import binary_erosion, distance_transform_edt, generate_binary_structure
+
+from unet3d.utils.image_writer import find_image_file
+
+
+# evaluated regions of each project as (name, labels): a voxel belongs to a region if its label is in labels
+PROJECT_REGIONS = {
+    "brats": (("WholeTumor", (1, 2, 4)),
+              ("TumorCore", (1, 4)),
+              ("EnhancingTumor", (4,))),
+    "kits": (("KidneyAndTumor", (1, 2)),
+             ("Tumor", (2,))),
+}
+
+METRICS = ("dice", "sensitivity", "specificity")
+# boundary metrics, in mm when the voxel spacing is known
+SURFACE_METRICS = ("hd95", "asd", "surface_dice")
+
+CACHE_FILE = "scores.json"
+
+
+def get_label_regions(labels):
+    """
+    One region per label, e.g. (1, 2) -> (("label1", (1,)), ("label2", (2,)))
+    """
+    return tuple([("label{}".format(label), (label,)) for label in labels])
+
+
+def get_project_regions(project, labels=None):
+    """
+    :param project: "brats", "kits", "pros", "headneck", ...
+    :param labels: label values of the project, used when the project has no named regions (pros, headneck, ibsr).
+    :return: tuple of (region name, labels of the region)
+    """
+    if project in PROJECT_REGIONS:
+        return PROJECT_REGIONS[project]
+    if labels is None:
+        raise ValueError("no regions defined for project {}. Please give its labels".format(project))
+    return get_label_regions(labels)
+
+
+def get_header(regions, metrics=METRICS):
+    """
+    :return: column names, e.g. dice_WholeTumor, ..., sensitivity_WholeTumor, ..., specificity_WholeTumor, ...
+    """
+    return tuple(["{}_{}".format(metric, name) for metric in metrics for name, _ in regions])
+
+
+def get_confusion_matrix(truth, prediction, n_labels=None):
+    """
+    Counts every (truth label, prediction label) pair in a single pass.
+    :param truth: integer label image.
+    :param prediction: integer label image with the same shape.
+    :param n_labels: number of label values (max label + 1). Computed from the images if None.
+    :return: (n_labels, n_labels) array where [i, j] is the number of voxels with truth i and prediction j.
+    """
+    truth = np.asarray(truth).ravel()
+    prediction = np.asarray(prediction).ravel()
+    if truth.dtype.kind == "f":
+        truth = np.rint(truth)
+    if prediction.dtype.kind == "f":
+        prediction = np.rint(prediction)
+    truth = truth.astype(np.int64)
+    prediction = prediction.astype(np.int64)
+    max_label = max(int(truth.max()), int(prediction.max())) if truth.size else 0
+    if n_labels is None or n_labels <= max_label:
+        n_labels = max_label + 1
+    counts = np.bincount(truth * n_labels + prediction, minlength=n_labels * n_labels)
+    return counts.reshape(n_labels, n_labels)
+
+
+def get_region_counts(confusion_matrix, region_labels):
+    """
+    :return: tp, fp, fn, tn of the binary region "label in region_labels"
+    """
+    n_labels = confusion_matrix.shape[0]
+    in_region = np.isin(np.arange(n_labels), region_labels)
+    tp = confusion_matrix[in_region][:, in_region].sum()
+    fn = confusion_matrix[in_region][:, ~in_region].sum()
+    fp = confusion_matrix[~in_region][:, in_region].sum()
+    tn = confusion_matrix[~in_region][:, ~in_region].sum()
+    return int(tp), int(fp), int(fn), int(tn)
+
+
+def safe_divide(numerator, denominator):
+    # same convention as medpy.metric.binary: 0 when the denominator is 0
+    if denominator == 0:
+        return 0.
+    return float(numerator) / float(denominator)
+
+
+def get_region_scores(tp, fp, fn, tn):
+    return {"dice": safe_divide(2 * tp, 2 * tp + fp + fn),
+            "sensitivity": safe_divide(tp, tp + fn),
+            "specificity": safe_divide(tn, tn + fp)}
+
+
+def get_bounding_box(mask, margin=1):
+    """
+    :return: tuple of slices around the non-zero voxels of mask, enlarged by margin and clipped to the image.
+    """
+    bounding_box = list()
+    for axis in range(mask.ndim):
+        other_axes = tuple([i for i in range(mask.ndim) if i != axis])
+        indices = np.where(np.any(mask, axis=other_axes))[0]
+        start = max(indices[0] - margin, 0)
+        stop = min(indices[-1] + 1 + margin, mask.shape[axis])
+        bounding_box.append(slice(start, stop))
+    return tuple(bounding_box)
+
+
+def get_border(mask):
+    """
+    Voxels of mask that have a 6-connected (in 3D) background neighbour. Voxels outside the image count as background.
+    """
+    structure = generate_binary_structure(mask.ndim, 1)
+    return np.logical_xor(mask, binary_erosion(mask, structure=structure, border_value=0))
+
+
+def get_surface_distances(truth, prediction, spacing=None):
+    """
+    Distances from every border voxel of prediction to the border of truth and vice versa. Only the bounding box of
+    truth | prediction (plus one voxel, so that erosion sees the background around the objects) is processed: the
+    nearest border voxel always lies in that box, so the distance transforms of the crop give exact distances.
+    :param truth: boolean mask, must not be empty.
+    :param prediction: boolean mask, must not be empty.
+    :param spacing: voxel spacing. Distances are in voxels if None.
+    :return: prediction to truth distances, truth to prediction distances
+    """
+    bounding_box = get_bounding_box(np.logical_or(truth, prediction))
+    truth_border = get_border(truth[bounding_box])
+    prediction_border = get_border(prediction[bounding_box])
+    prediction_to_truth = distance_transform_edt(np.logical_not(truth_border), sampling=spacing)[prediction_border]
+    truth_to_prediction = distance_transform_edt(np.logical_not(prediction_border), sampling=spacing)[truth_border]
+    return prediction_to_truth, truth_to_prediction
+
+
+def get_surface_scores(truth, prediction, spacing=None, tolerance=1.):
+    """
+    :param truth: boolean mask.
+    :param prediction: boolean mask.
+    :param spacing: voxel spacing.
+    :param tolerance: distance (same unit as spacing) under which two borders agree, for surface_dice.
+    :return: dict with hd95 (95th percentile of the symmetric surface distances), asd (average symmetric surface
+    distance) and surface_dice. Distances are nan if one of the masks is empty; everything is nan if both are.
+    """
+    is_truth, is_prediction = np.any(truth), np.any(prediction)
+    if not is_truth and not is_prediction:
+        return {"hd95": np.nan, "asd": np.nan, "surface_dice": np.nan}
+    if not is_truth or not is_prediction:
+        return {"hd95": np.nan, "asd": np.nan, "surface_dice": 0.}
+    prediction_to_truth, truth_to_prediction = get_surface_distances(truth, prediction, spacing=spacing)
+    distances = np.concatenate([prediction_to_truth, truth_to_prediction])
+    return {"hd95": float(np.percentile(distances, 95)),
+            "asd": float((prediction_to_truth.mean() + truth_to_prediction.mean()) / 2.),
+            "surface_dice": float(np.sum(distances <= tolerance)) / distances.size}
+
+
+def get_scores(truth, prediction, regions, metrics=METRICS, spacing=None, tolerance=1.):
+    """
+    :param spacing: voxel spacing used by the surface metrics.
+    :param tolerance: tolerance of surface_dice.
+    :return: list of scores in the order of get_header(regions, metrics)
+    """
+    confusion_matrix = get_confusion_matrix(truth, prediction)
+    is_surface = any([metric in SURFACE_METRICS for metric in metrics])
+    region_scores = list()
+    for _, region_labels in regions:
+        scores = get_region_scores(*get_region_counts(confusion_matrix, region_labels))
+        if is_surface:
+            scores.update(get_surface_scores(np.isin(truth, region_labels), np.isin(prediction, region_labels),
+                                             spacing=spacing, tolerance=tolerance))
+        region_scores.append(scores)
+    return [scores[metric] for metric in metrics for scores in region_scores]
+
+
+def get_file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def evaluate_case(case_folder, regions, metrics=METRICS, tolerance=1., is_cache=True,
+                  truth_name="truth.nii.gz", prediction_name="prediction.nii.gz"):
+    """
+    Scores one case folder. The scores are cached in case_folder/scores.json together with the modification time and
+    size of the images, so re-running a report only recomputes cases whose prediction changed.
+    """
+    # the cases may be written uncompressed (.nii), see unet3d.utils.image_writer
+    truth_file = find_image_file(os.path.join(case_folder, truth_name))
+    prediction_file = find_image_file(os.path.join(case_folder, prediction_name))
+    cache_file = os.path.join(case_folder, CACHE_FILE)
+    key = json.dumps([regions, list(metrics), tolerance])
+    signature = [get_file_signature(truth_file), get_file_signature(prediction_file)]
+
+    cache = dict()
+    if is_cache and os.path.exists(cache_file):
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+        if cache.get("signature") != signature:
+            cache = dict()
+        elif key in cache.get("scores", dict()):
+            return cache["scores"][key]
+
+    truth_image = nib.load(truth_file)
+    truth = np.asanyarray(truth_image.dataobj)
+    prediction = np.asanyarray(nib.load(prediction_file).dataobj)
+    spacing = truth_image.header.get_zooms()[:truth.ndim]
+    scores = get_scores(truth, prediction, regions, metrics=metrics, spacing=spacing, tolerance=tolerance)
+
+    if is_cache:
+        cache["signature"] = signature
+        cache.setdefault("scores", dict())[key] = scores
+        with open(cache_file, "w") as f:
+            json.dump(cache, f)
+    return scores
+
+
+def _evaluate_case_star(args):
+    case_folder, regions, metrics, tolerance = args
+    return os.path.basename(case_folder), evaluate_case(case_folder, regions, metrics=metrics, tolerance=tolerance)
+
+
+def get_case_folders(prediction_folder):
+    return [case_folder for case_folder in sorted(glob.glob(os.path.join(prediction_folder, "*")))
+            if os.path.isdir(case_folder)]
+
+
+def evaluate_prediction_folder(prediction_folder, csv_file, regions, metrics=METRICS, n_workers=1, tolerance=1.):
+    """
+    Evaluates every case folder (truth.nii.gz and prediction.nii.gz) of a prediction folder in a process pool.
+    Rows are appended to csv_file + ".part" as soon as a case is done, so an interrupted evaluation resumes where it
+    stopped; the file is renamed to csv_file once all cases are evaluated.
+    :param prediction_folder: folder written by run_validation_cases.
+    :param csv_file: per-case output csv (one row per subject, one column per metric and region).
+    :param regions: tuple of (region name, labels), see get_project_regions.
+    :param metrics: subset of METRICS + SURFACE_METRICS.
+    :param n_workers: number of processes. 1 evaluates in this process.
+    :param tolerance: tolerance of surface_dice, in mm.
+    :return: pandas DataFrame indexed by subject id.
+    """
+    header = get_header(regions, metrics)
+    part_file = csv_file + ".part"
+
+    done_ids = set()
+    if os.path.exists(part_file):
+        done_ids = set(pd.read_csv(part_file, index_col=0).index.astype(str))
+        print(">> resume {}: {} cases already evaluated".format(part_file, len(done_ids)))
+    case_folders = [case_folder for case_folder in get_case_folders(prediction_folder)
+                    if os.path.basename(case_folder) not in done_ids]
+
+    tasks = [(case_folder, regions, metrics, tolerance) for case_folder in case_folders]
+    is_new_file = not os.path.exists(part_file)
+    with open(part_file, "a") as f:
+        writer = csv.writer(f)
+        if is_new_file:
+            writer.writerow([""] + list(header))
+            f.flush()
+        if n_workers > 1 and len(tasks) > 1:
+            pool = Pool(processes=min(n_workers, len(tasks)))
+            results = pool.imap_unordered(_evaluate_case_star, tasks)
+        else:
+            pool = None
+            results = map(_evaluate_case_star, tasks)
+        try:
+            for i, (subject_id, scores) in enumerate(results):
+                writer.writerow([subject_id] + scores)
+                f.flush()
+                print(">> evaluated {} ({}/{})".format(subject_id, i + 1, len(tasks)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    df = pd.read_csv(part_file, index_col=0)
+    df.index = df.index.astype(str)
+    df = df.sort_index()
+    df.to_csv(csv_file)
+    os.remove(part_file)
+    return df
+
+
+def get_scores_from_df(df):
+    """
+    :return: dict of column name -> non-nan values
+    """
+    scores = dict()
+    for column in df.columns:
+        values = df[column].values
+        scores[column] = values[np.isnan(values) == False]
+    return scores
@@ -0,0 +1,183 @@
+import os
+import argparse
+
+import numpy as np
+from keras.layers import Input
+from keras.models import Model
+
+from unet3d.training import load_old_model
+from unet3d.utils.model_utils import get_template_model
+
+
+DROPOUT_LAYERS = ("Dropout", "SpatialDropout1D", "SpatialDropout2D", "SpatialDropout3D", "GaussianNoise",
+                  "GaussianDropout", "AlphaDropout")
+FOLDABLE_CONVOLUTIONS = ("Conv1D", "Conv2D", "Conv3D")
+BATCH_NORMALIZATIONS = ("BatchNormalization", "BatchNorm")
+
+
+def get_inference_model_file(model_file):
+    """
+    :return: file of the inference-only model, e.g. model.h5 -> model_inference.h5
+    """
+    return os.path.splitext(model_file)[0] + "_inference.h5"
+
+
+def get_inbound(layer):
+    """
+    :return: input tensor(s) of the layer and the keyword arguments it was called with
+    """
+    if len(layer._inbound_nodes) != 1:
+        raise ValueError("layer {} is used {} times, shared layers are not supported".format(
+            layer.name, len(layer._inbound_nodes)))
+    return layer.get_input_at(0), layer._inbound_nodes[0].arguments or dict()
+
+
+def get_channel_axis(layer):
+    n_dims = len(layer.get_output_shape_at(0))
+    if layer.get_config().get("data_format") == "channels_first":
+        return 1
+    return n_dims - 1
+
+
+def is_foldable(convolution, batch_normalization):
+    """
+    A batch normalization folds into the convolution it follows if the convolution is linear, feeds only the
+    batch normalization, and both work on the same channel axis. Batch normalizations called with training=True keep
+    using the statistics of the batch and are not folded.
+    """
+    if convolution.__class__.__name__ not in FOLDABLE_CONVOLUTIONS:
+        return False
+    if convolution.get_config()["activation"] != "linear" or len(convolution._outbound_nodes) != 1:
+        return False
+    _, arguments = get_inbound(batch_normalization)
+    if arguments.get("training"):
+        return False
+    axis = batch_normalization.axis
+    axis = axis[0] if isinstance(axis, (list, tuple)) else axis
+    n_dims = len(batch_normalization.get_output_shape_at(0))
+    return axis % n_dims == get_channel_axis(convolution)
+
+
+def fold_batch_normalization(convolution, batch_normalization):
+    """
+    :return: kernel and bias of the convolution followed by the batch normalization (in inference mode)
+    """
+    weights = convolution.get_weights()
+    kernel = weights[0]
+    bias = weights[1] if convolution.use_bias else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+    bn_weights = list(batch_normalization.get_weights())
+    gamma = bn_weights.pop(0) if batch_normalization.scale else np.ones(kernel.shape[-1], dtype=kernel.dtype)
+    beta = bn_weights.pop(0) if batch_normalization.center else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+    moving_mean, moving_variance = bn_weights
+    scale = gamma / np.sqrt(moving_variance + batch_normalization.epsilon)
+    return (kernel * scale).astype(kernel.dtype), ((bias - moving_mean) * scale + beta).astype(kernel.dtype)
+
+
+def get_inference_model(model):
+    """
+    Rebuilds a model for inference: batch normalizations are folded into the preceding convolution kernels and
+    dropout/noise layers (identities at inference) are removed. GroupNormalization and InstanceNormalization use the
+    statistics of each sample and are kept.
+    :param model: functional keras model. The template model of a multi_gpu_model is rebuilt (the wrapper calls it
+    once per gpu, see get_template_model).
+    :return: inference model, number of folded batch normalizations, number of removed layers
+    """
+    model = get_template_model(model)
+    folded_weights = dict()
+    folded = set()
+    for layer in model.layers:
+        if layer.__class__.__name__ not in BATCH_NORMALIZATIONS:
+            continue
+        convolution = layer._inbound_nodes[0].inbound_layers[0]
+        if is_foldable(convolution, layer):
+            folded_weights[convolution.name] = fold_batch_normalization(convolution, layer)
+            folded.add(layer.name)
+
+    tensors = dict()
+    n_removed = 0
+    for layer in model.layers:
+        class_name = layer.__class__.__name__
+        if class_name == "InputLayer":
+            tensors[id(layer.output)] = Input(batch_shape=layer.batch_input_shape, dtype=layer.dtype,
+                                              name=layer.name)
+            continue
+        inputs, arguments = get_inbound(layer)
+        if isinstance(inputs, list):
+            new_inputs = [tensors[id(tensor)] for tensor in inputs]
+        else:
+            new_inputs = tensors[id(inputs)]
+        output = layer.get_output_at(0)
+        if class_name in DROPOUT_LAYERS or layer.name in folded:
+            tensors[id(output)] = new_inputs
+            n_removed += 1
+            continue
+        config = layer.get_config()
+        weights = layer.get_weights()
+        if layer.name in folded_weights:
+            config["use_bias"] = True
+            weights = list(folded_weights[layer.name])
+        new_layer = layer.__class__.from_config(config)
+        new_output = new_layer(new_inputs, **arguments)
+        new_layer.set_weights(weights)
+        if isinstance(output, list):
+            for tensor, new_tensor in zip(output, new_output):
+                tensors[id(tensor)] = new_tensor
+        else:
+            tensors[id(output)] = new_output
+
+    inference_model = Model(inputs=[tensors[id(tensor)] for tensor in model.inputs],
+                            outputs=[tensors[id(tensor)] for tensor in model.outputs],
+                            name=model.name)
+    return inference_model, len(folded), n_removed
+
+
+def check_equivalence(model, inference_model, n_samples=2, tolerance=1e-4, seed=0):
+    """
+    Compares the predictions of both models on random inputs.
+    :return: largest absolute difference between the predictions
+    :raise ValueError: if the difference exceeds tolerance.
+    """
+    random = np.random.RandomState(seed)
+    data = [random.normal(size=(n_samples,) + tuple(shape[1:])).astype(np.float32)
+            for shape in (model.input_shape if isinstance(model.input_shape, list) else [model.input_shape])]
+    prediction = model.predict(data)
+    inference_prediction = inference_model.predict(data)
+    if not isinstance(prediction, list):
+        prediction, inference_prediction = [prediction], [inference_prediction]
+    difference = max([float(np.max(np.abs(a - b))) for a, b in zip(prediction, inference_prediction)])
+    if difference > tolerance:
+        raise ValueError("the inference model differs from the model by {} (tolerance {})".format(
+            difference, tolerance))
+    return difference
+
+
+def export_inference_model(model_file, out_file=None, tolerance=1e-4):
+    """
+    Saves the inference-only model of model_file (without optimizer), after checking that it predicts the same.
+    :return: out_file
+    """
+    if out_file is None:
+        out_file = get_inference_model_file(model_file)
+    model = get_template_model(load_old_model(model_file))
+    inference_model, n_folded, n_removed = get_inference_model(model)
+    difference = check_equivalence(model, inference_model, tolerance=tolerance)
+    print(">> folded {} batch normalizations, removed {} layers ({} -> {} layers), max difference {:.2e}".format(
+        n_folded, n_removed, len(model.layers), len(inference_model.layers), difference))
+    inference_model.save(out_file, include_optimizer=False)
+    print(">> inference model saved to {}".format(out_file))
+    return out_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="export an inference-only model")
+    parser.add_argument('-i', '--model_file', type=str, required=True)
+    parser.add_argument('-o', '--out_file', type=str, default=None,
+                        help="default is <model>_inference.h5")
+    parser.add_argument('-t', '--tolerance', type=float, default=1e-4,
+                        help="largest difference allowed between the predictions of both models")
+    args = parser.parse_args()
+    export_inference_model(args.model_file, args.out_file, tolerance=args.tolerance)
+
+
+if __name__ == "__main__":
+    main()
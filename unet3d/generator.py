@@ -7,6 +7,13 @@ import time
 
 from unet3d.utils import pickle_dump, pickle_load
 from unet3d.utils.patches import compute_patch_indices, get_random_nd_index, get_patch_from_3d_data
+from unet3d.data_memmap import is_memmap_data_file
+from unet3d.data_compact import DecodedArray, decode_data
+from unet3d.data_cropped import get_image_shapes, get_subject_shape
+from unet3d.utils.foreground import get_foreground_bboxes
+from unet3d.utils.subject_cache import get_subject_cache, locality_shuffle
+from unet3d.utils.batch_cache import get_cached_generator
+from unet3d.utils.timing import time_stage
 
 import tensorlayer as tl
 from scipy.ndimage.filters import gaussian_filter
@@ -23,9 +30,22 @@ def get_training_and_validation_and_testing_generators(data_file, batch_size, n_
                                                        augment_flipud=False, augment_fliplr=False, augment_elastic=False,
                                                        augment_rotation=False, augment_shift=False, augment_shear=False,
                                                        augment_zoom=False, n_augment=0, skip_blank=False,
-                                                       project="brats"):
+                                                       project="brats", subject_cache_mb=0, locality_window=None,
+                                                       is_foreground_sampling=False,
+                                                       validation_cache_mb=0, validation_cache_dir=None):
     """
     Creates the training and validation generators that can be used when training the model.
+    :param subject_cache_mb: Memory budget (in megabytes) of the LRU cache of decompressed subjects kept by each
+    generator. 0 disables the cache.
+    :param locality_window: If set, training patches are shuffled within windows of this many subjects so that
+    consecutive patches hit the subject cache.
+    :param validation_cache_mb: Memory budget (in megabytes) of the validation batches kept after the first epoch and
+    replayed by the following ones (see unet3d.utils.batch_cache). 0 disables the cache unless validation_cache_dir
+    is set.
+    :param validation_cache_dir: Directory of the validation batches beyond validation_cache_mb, stored as .npy files
+    read as memory maps.
+    :param is_foreground_sampling: If True, training patches tile the foreground bounding box stored with the data
+    (see unet3d.utils.foreground) instead of the whole image, which skips the patches of background.
     :param skip_blank: If True, any blank (all-zero) label images/patches will be skipped by the data generator.
     :param validation_batch_size: Batch size for the validation data.
     :param training_patch_start_offset: Tuple of length 3 containing integer values. Training data will randomly be
@@ -75,6 +95,12 @@ def get_training_and_validation_and_testing_generators(data_file, batch_size, n_
 
     print("training_list:", training_list)
 
+    foreground_bboxes = None
+    if is_foreground_sampling:
+        foreground_bboxes = get_foreground_bboxes(data_file)
+        if foreground_bboxes is None:
+            print(">> no foreground stored in the data file, sample the whole images")
+
     print(">> training data generator")
     training_generator = data_generator(data_file, training_list,
                                         batch_size=batch_size,
@@ -92,7 +118,10 @@ def get_training_and_validation_and_testing_generators(data_file, batch_size, n_
                                         augment_shear=augment_shear,
                                         augment_zoom=augment_zoom,
                                         n_augment=n_augment,
-                                        skip_blank=skip_blank)
+                                        skip_blank=skip_blank,
+                                        subject_cache=get_subject_cache(subject_cache_mb, "training cache"),
+                                        locality_window=locality_window,
+                                        foreground_bboxes=foreground_bboxes)
     print(">> valid data generator")
     validation_generator = data_generator(data_file, validation_list,
                                           batch_size=validation_batch_size,
@@ -101,7 +130,8 @@ def get_training_and_validation_and_testing_generators(data_file, batch_size, n_
                                           patch_shape=patch_shape,
                                           patch_overlap=validation_patch_overlap,
                                           is_create_patch_index_list_original=is_create_patch_index_list_original,
-                                          skip_blank=skip_blank
+                                          skip_blank=skip_blank,
+                                          subject_cache=get_subject_cache(subject_cache_mb, "validation cache")
                                           )
 
     # Set the number of training and testing samples per epoch correctly
@@ -109,12 +139,16 @@ def get_training_and_validation_and_testing_generators(data_file, batch_size, n_
     print(">> compute number of training and validation steps")
     num_training_steps = get_number_of_steps(get_number_of_patches(data_file, training_list, patch_shape,
                                                                    patch_start_offset=training_patch_start_offset,
-                                                                   patch_overlap=0),
+                                                                   patch_overlap=0,
+                                                                   foreground_bboxes=foreground_bboxes),
                                              batch_size)
     num_validation_steps = get_number_of_steps(get_number_of_patches(data_file, validation_list, patch_shape,
                                                                      patch_overlap=validation_patch_overlap),
                                                validation_batch_size)
 
+    validation_generator = get_cached_generator(validation_generator, num_validation_steps,
+                                                cache_size_mb=validation_cache_mb, cache_dir=validation_cache_dir)
+
     print("Number of training steps: ", num_training_steps)
     print("Number of validation steps: ", num_validation_steps)
 
@@ -205,38 +239,47 @@ def data_generator(data_file, index_list, batch_size=1, n_labels=1, labels=None,
                    skip_blank=True, is_create_patch_index_list_original=True,
                    augment_flipud=False, augment_fliplr=False, augment_elastic=False,
                    augment_rotation=False, augment_shift=False, augment_shear=False,
-                   augment_zoom=False, n_augment=False):
+                   augment_zoom=False, n_augment=False, subject_cache=None, locality_window=None,
+                   foreground_bboxes=None):
     orig_index_list = index_list
     while True:
         x_list = list()
         y_list = list()
         if patch_shape:
-            index_list = create_patch_index_list(orig_index_list, data_file.root.data.shape[-3:], patch_shape,
-                                                 patch_overlap, patch_start_offset)
+            index_list = create_patch_index_list(orig_index_list, get_image_shapes(data_file), patch_shape,
+                                                 patch_overlap, patch_start_offset,
+                                                 foreground_bboxes=foreground_bboxes)
         else:
             index_list = copy.copy(orig_index_list)
 
         if shuffle_index_list:
-            shuffle(index_list)
+            if locality_window and patch_shape:
+                index_list = locality_shuffle(index_list, n_subjects_window=locality_window)
+            else:
+                shuffle(index_list)
         while len(index_list) > 0:
             index = index_list.pop()
             add_data(x_list, y_list, data_file, index, patch_shape=patch_shape,
                      augment_flipud=augment_flipud, augment_fliplr=augment_fliplr,
                      augment_elastic=augment_elastic, augment_rotation=augment_rotation,
                      augment_shift=augment_shift, augment_shear=augment_shear,
-                     augment_zoom=augment_zoom)
+                     augment_zoom=augment_zoom, subject_cache=subject_cache)
 
             if len(x_list) == batch_size or (len(index_list) == 0 and len(x_list) > 0):
                 yield convert_data(x_list, y_list, n_labels=n_labels, labels=labels)
                 x_list = list()
                 y_list = list()
+        if subject_cache is not None:
+            subject_cache.report()
+            subject_cache.reset_stats()
 
 
 def get_number_of_patches(data_file, index_list, patch_shape=None, patch_overlap=0,
-                          patch_start_offset=None, is_extract_patch_agressive=False):
+                          patch_start_offset=None, is_extract_patch_agressive=False, foreground_bboxes=None):
     if patch_shape:
-        index_list = create_patch_index_list(index_list, data_file.root.data.shape[-3:], patch_shape, patch_overlap,
-                                             patch_start_offset, is_extract_patch_agressive=is_extract_patch_agressive)
+        index_list = create_patch_index_list(index_list, get_image_shapes(data_file), patch_shape, patch_overlap,
+                                             patch_start_offset, is_extract_patch_agressive=is_extract_patch_agressive,
+                                             foreground_bboxes=foreground_bboxes)
 
         return len(index_list)
     else:
@@ -245,37 +288,67 @@ def get_number_of_patches(data_file, index_list, patch_shape=None, patch_overlap
 
 def create_patch_index_list(index_list, image_shape, patch_shape, patch_overlap,
                             patch_start_offset=None,
-                            is_extract_patch_agressive=False):
+                            is_extract_patch_agressive=False, foreground_bboxes=None):
+    """
+    :param foreground_bboxes: if set, array (n_subjects, 2, 3) of the start and stop of the region of each subject
+    tiled by the patches (see unet3d.utils.foreground.get_foreground_bboxes), instead of the whole image.
+    """
     patch_index = list()
     for index in index_list:
+        shape = get_subject_shape(image_shape, index)
+        if foreground_bboxes is not None:
+            start, stop = foreground_bboxes[index]
+            shape = tuple(np.subtract(stop, start))
         if patch_start_offset is not None:
             random_start_offset = np.negative(
                 get_random_nd_index(patch_start_offset))
-            patches = compute_patch_indices(image_shape, patch_shape,
+            patches = compute_patch_indices(shape, patch_shape,
                                             overlap=patch_overlap, start=random_start_offset,
                                             is_extract_patch_agressive=is_extract_patch_agressive)
         else:
-            patches = compute_patch_indices(image_shape, patch_shape,
+            patches = compute_patch_indices(shape, patch_shape,
                                             overlap=patch_overlap,
                                             is_extract_patch_agressive=is_extract_patch_agressive)
+        if foreground_bboxes is not None:
+            patches = patches + np.asarray(foreground_bboxes[index][0])
         patch_index.extend(itertools.product([index], patches))
     return patch_index
 
 
-def get_data_from_file(data_file, index, patch_shape=None):
+def get_data_from_file(data_file, index, patch_shape=None, subject_cache=None):
     if patch_shape:
         index, patch_index = index
+        if is_memmap_data_file(data_file):
+            # slice the patch straight from the memory map so only its pages are read
+            data = data_file.root.data
+            if isinstance(data, DecodedArray):
+                x = decode_data(get_patch_from_3d_data(data.array.array[index], patch_shape, patch_index),
+                                data.scale)
+            else:
+                x = np.array(get_patch_from_3d_data(data.array[index], patch_shape, patch_index))
+            y = get_patch_from_3d_data(data_file.root.truth.array[index, 0], patch_shape, patch_index)
+            return x, np.array(y)
+        if subject_cache is not None:
+            # patches are views of the cached volumes and augmentation writes into them, so copy
+            data, truth = subject_cache.get(data_file, index)
+            x = get_patch_from_3d_data(data, patch_shape, patch_index)
+            y = get_patch_from_3d_data(truth, patch_shape, patch_index)
+            return np.array(x), np.array(y)
         data, truth = get_data_from_file(data_file, index, patch_shape=None)
         x = get_patch_from_3d_data(data, patch_shape, patch_index)
         y = get_patch_from_3d_data(truth, patch_shape, patch_index)
+    elif subject_cache is not None:
+        x, y = subject_cache.get(data_file, index)
+        x, y = np.array(x), np.array(y)
     else:
         x, y = data_file.root.data[index], data_file.root.truth[index, 0]
     return x, y
 
 
 def convert_data(x_list, y_list, n_labels=1, labels=None):
-    x = np.asarray(x_list)
-    y = np.asarray(y_list)
+    with time_stage("batch"):
+        x = np.asarray(x_list)
+        y = np.asarray(y_list)
     if n_labels == 1:
         y[y > 0] = 1
     elif n_labels > 1:
@@ -291,13 +364,14 @@ def get_multi_class_labels(data, n_labels, labels=None):
     :param labels: integer values of the labels.
     :return: binary numpy array of shape: (n_samples, n_labels, ...)
     """
-    new_shape = [data.shape[0], n_labels] + list(data.shape[2:])
-    y = np.zeros(new_shape, np.int8)
-    for label_index in range(n_labels):
-        if labels is not None:
-            y[:, label_index][data[:, 0] == labels[label_index]] = 1
-        else:
-            y[:, label_index][data[:, 0] == (label_index + 1)] = 1
+    with time_stage("labels"):
+        new_shape = [data.shape[0], n_labels] + list(data.shape[2:])
+        y = np.zeros(new_shape, np.int8)
+        for label_index in range(n_labels):
+            if labels is not None:
+                y[:, label_index][data[:, 0] == labels[label_index]] = 1
+            else:
+                y[:, label_index][data[:, 0] == (label_index + 1)] = 1
     return y
 
 
@@ -402,23 +476,38 @@ def augment_data(data, augment_flipud=False, augment_fliplr=False, augment_elast
 def add_data(x_list, y_list, data_file, index, patch_shape=None,
              augment_flipud=False, augment_fliplr=False, augment_elastic=False,
              augment_rotation=False, augment_shift=False, augment_shear=False,
-             augment_zoom=False, skip_blank=True, model_dim=3):
+             augment_zoom=False, skip_blank=True, model_dim=3, subject_cache=None):
     """
     Adds data from the data file to the given lists of feature and target data
     :return:
     """
-    data, truth = get_data_from_file(data_file, index, patch_shape=patch_shape)
-
+    with time_stage("read"):
+        data, truth = get_data_from_file(data_file, index, patch_shape=patch_shape, subject_cache=subject_cache)
+    add_patch(x_list, y_list, data, truth, patch_shape=patch_shape, augment_flipud=augment_flipud,
+              augment_fliplr=augment_fliplr, augment_elastic=augment_elastic, augment_rotation=augment_rotation,
+              augment_shift=augment_shift, augment_shear=augment_shear, augment_zoom=augment_zoom,
+              model_dim=model_dim)
+
+
+def add_patch(x_list, y_list, data, truth, patch_shape=None,
+              augment_flipud=False, augment_fliplr=False, augment_elastic=False,
+              augment_rotation=False, augment_shift=False, augment_shear=False,
+              augment_zoom=False, model_dim=3):
+    """
+    Augments a patch read from the data file and adds it to the given lists of feature and target data (2.5D patches
+    only if the truth of their central slice is not blank). Augmentation writes into data and truth.
+    """
     augment = augment_flipud or augment_fliplr or augment_elastic or augment_rotation or augment_shift or augment_shear or augment_zoom
     if augment:
         data_list = list()
         for i in range(data.shape[0]):
             data_list.append(data[i, :, :, :])
         data_list.append(truth[:, :, :])
-        data_list = augment_data(data=data_list, augment_flipud=augment_flipud, augment_fliplr=augment_fliplr,
-                                 augment_elastic=augment_elastic, augment_rotation=augment_rotation,
-                                 augment_shift=augment_shift, augment_shear=augment_shear,
-                                 augment_zoom=augment_zoom)
+        with time_stage("augment"):
+            data_list = augment_data(data=data_list, augment_flipud=augment_flipud, augment_fliplr=augment_fliplr,
+                                     augment_elastic=augment_elastic, augment_rotation=augment_rotation,
+                                     augment_shift=augment_shift, augment_shear=augment_shear,
+                                     augment_zoom=augment_zoom)
         for i in range(data.shape[0]):
             data[i, :, :, :] = data_list[i]
         truth[:, :, :] = data_list[-1]
@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+from unet3d.utils.path_utils import get_shape_from_string
+from unet3d.utils.model_utils import get_template_model
+
+
+# number of weight-sized slots each optimizer keeps per parameter
+OPTIMIZER_SLOTS = {"SGD": 1, "RMSprop": 1, "Adagrad": 1, "Adadelta": 2, "Adam": 2, "Adamax": 2, "Nadam": 2}
+GB = 1024. ** 3
+
+
+def get_dtype_size(layer):
+    from keras import backend as K
+    return np.dtype(getattr(layer, "dtype", None) or K.floatx()).itemsize
+
+
+def get_model_patch_shape(model):
+    """
+    Spatial shape of the (channels-first) input of the model, e.g. (128, 128, 128) for an input of (4, 128, 128, 128)
+    """
+    return tuple(model.input_shape[2:])
+
+
+def get_n_elements(shape, scale=1.):
+    """
+    Elements of one sample of a tensor of the given shape (batch axis excluded). The spatial tensors are scaled by
+    scale, the ratio between the patch volume and the volume the model was built for.
+    """
+    n_elements = int(np.prod(shape[1:]))
+    if len(shape) > 2:
+        n_elements = int(np.ceil(n_elements * scale))
+    return n_elements
+
+
+def get_layer_outputs(layer):
+    shapes = layer.get_output_shape_at(0)
+    tensors = layer.get_output_at(0)
+    if not isinstance(tensors, list):
+        shapes, tensors = [shapes], [tensors]
+    return tensors, shapes
+
+
+def get_layer_inputs(layer):
+    tensors = layer.get_input_at(0)
+    return tensors if isinstance(tensors, list) else [tensors]
+
+
+def get_optimizer_slots(model):
+    optimizer = getattr(model, "optimizer", None)
+    if optimizer is None:
+        return OPTIMIZER_SLOTS["Adam"]
+    if optimizer.__class__.__name__ == "SGD" and not float(optimizer.get_config().get("momentum", 0.)):
+        return 0
+    return OPTIMIZER_SLOTS.get(optimizer.__class__.__name__, 2)
+
+
+def estimate_memory(model, batch_size=1, patch_shape=None, is_training=True):
+    """
+    Estimates the memory of a built keras model, walking its layers.
+    - parameters: weights, plus their gradients and the optimizer slots when training.
+    - activations: when training, every layer output is kept for the backward pass, plus the gradients of the two
+    largest outputs being back-propagated. At inference, the peak of the outputs alive at the same time, an output
+    being freed once all the layers reading it are computed.
+    Workspaces of the convolution algorithms and allocator fragmentation are not counted, see get_batch_size.
+    :param patch_shape: spatial shape of the patches. None is the shape the model was built for. Other shapes scale
+    the spatial activations by the volume ratio, which holds for fully convolutional models.
+    :return: dict of bytes: parameters, activations_per_sample, activations, total
+    """
+    model = get_template_model(model)
+    scale = 1.
+    if patch_shape is not None:
+        scale = float(np.prod(patch_shape)) / float(np.prod(get_model_patch_shape(model)))
+
+    n_consumers = dict()
+    for layer in model.layers:
+        if layer.__class__.__name__ != "InputLayer":
+            for tensor in get_layer_inputs(layer):
+                n_consumers[id(tensor)] = n_consumers.get(id(tensor), 0) + 1
+
+    output_ids = set([id(tensor) for tensor in model.outputs])
+    sizes = dict()
+    alive = 0
+    peak = 0
+    outputs = list()
+    for layer in model.layers:
+        tensors, shapes = get_layer_outputs(layer)
+        for tensor, shape in zip(tensors, shapes):
+            sizes[id(tensor)] = get_n_elements(shape, scale) * get_dtype_size(layer)
+            outputs.append(sizes[id(tensor)])
+            alive += sizes[id(tensor)]
+        peak = max(peak, alive)
+        if layer.__class__.__name__ != "InputLayer":
+            for tensor in get_layer_inputs(layer):
+                n_consumers[id(tensor)] -= 1
+                if n_consumers[id(tensor)] == 0 and id(tensor) not in output_ids:
+                    alive -= sizes[id(tensor)]
+
+    n_params = model.count_params()
+    parameters = n_params * np.dtype("float32").itemsize
+    if is_training:
+        parameters *= 2 + get_optimizer_slots(model)
+        activations_per_sample = sum(outputs) + sum(sorted(outputs)[-2:])
+    else:
+        activations_per_sample = peak
+    return {"batch_size": batch_size, "n_parameters": n_params, "parameters": int(parameters),
+            "activations_per_sample": int(activations_per_sample),
+            "activations": int(activations_per_sample * batch_size),
+            "total": int(parameters + activations_per_sample * batch_size)}
+
+
+def get_device_memory():
+    """
+    :return: memory of one device in bytes, number of devices. The gpus seen by tensorflow, or the physical memory
+    of the machine if there is none.
+    """
+    from tensorflow.python.client import device_lib
+    gpus = [device for device in device_lib.list_local_devices() if device.device_type == "GPU"]
+    if gpus:
+        return min([int(gpu.memory_limit) for gpu in gpus]), len(gpus)
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"), 1
+
+
+def get_memory_budget(memory_budget_gb=None):
+    """
+    :return: memory budget in bytes, None (the memory of the device) if memory_budget_gb is None
+    """
+    return None if memory_budget_gb is None else int(memory_budget_gb * GB)
+
+
+def get_batch_size(model, memory_budget=None, patch_shape=None, max_batch_size=256, memory_fraction=0.8,
+                   is_training=True):
+    """
+    Largest batch whose estimated memory fits the budget.
+    :param memory_budget: bytes available on each device. None uses get_device_memory; with several gpus the batch
+    is split between them (multi_gpu_model), so the batch size is multiplied by the number of gpus.
+    :param memory_fraction: part of the budget given to the estimate, the rest is left to the convolution
+    workspaces and the fragmentation of the allocator.
+    :raise ValueError: if a single sample does not fit.
+    """
+    n_devices = 1
+    if memory_budget is None:
+        memory_budget, n_devices = get_device_memory()
+    estimate = estimate_memory(model, batch_size=1, patch_shape=patch_shape, is_training=is_training)
+    available = memory_budget * memory_fraction - estimate["parameters"]
+    batch_size = int(available // estimate["activations_per_sample"]) if available > 0 else 0
+    if batch_size < 1:
+        raise ValueError("a sample of patch {} needs {:.2f} GB, more than the budget of {:.2f} GB".format(
+            patch_shape or get_model_patch_shape(model), estimate["total"] / GB, memory_budget * memory_fraction / GB))
+    return min(batch_size * n_devices, max_batch_size)
+
+
+def get_patch_shape(model, patch_shapes, memory_budget=None, min_batch_size=1, **kwargs):
+    """
+    Largest patch (in volume) of patch_shapes that fits at least min_batch_size samples in the budget.
+    :return: patch shape, its batch size
+    """
+    for patch_shape in sorted(patch_shapes, key=lambda shape: np.prod(shape), reverse=True):
+        try:
+            batch_size = get_batch_size(model, memory_budget=memory_budget, patch_shape=patch_shape, **kwargs)
+        except ValueError:
+            continue
+        if batch_size >= min_batch_size:
+            return tuple(patch_shape), batch_size
+    raise ValueError("none of the patches {} fits {} samples".format(patch_shapes, min_batch_size))
+
+
+def is_out_of_memory(error):
+    return error.__class__.__name__ == "ResourceExhaustedError"
+
+
+def measure_throughput(model, batch_size, n_steps=10, n_warmup=2, is_training=True, seed=0):
+    """
+    Runs n_steps training (or prediction) steps of random batches on the local device.
+    :return: samples per second, None if the batch does not fit in memory
+    """
+    random = np.random.RandomState(seed)
+    x = random.normal(size=(batch_size,) + tuple(model.input_shape[1:])).astype(np.float32)
+    output_shapes = model.output_shape if isinstance(model.output_shape, list) else [model.output_shape]
+    y = [(random.rand(*((batch_size,) + tuple(shape[1:]))) > 0.5).astype(np.float32) for shape in output_shapes]
+    y = y[0] if len(y) == 1 else y
+    try:
+        for step in range(n_warmup + n_steps):
+            if step == n_warmup:
+                start = time.perf_counter()
+            if is_training:
+                model.train_on_batch(x, y)
+            else:
+                model.predict_on_batch(x)
+    except Exception as error:
+        if is_out_of_memory(error):
+            return None
+        raise
+    return batch_size * n_steps / (time.perf_counter() - start)
+
+
+def tune_batch_size(model, memory_budget=None, max_batch_size=256, n_steps=10, is_training=True):
+    """
+    Measures the throughput of the powers of two up to the estimated largest batch (get_batch_size), and that batch.
+    Batches running out of memory stop the search.
+    :return: batch size of the best measured throughput, list of dict(batch_size, samples_per_second)
+    """
+    largest = get_batch_size(model, memory_budget=memory_budget, max_batch_size=max_batch_size,
+                             is_training=is_training)
+    candidates = sorted(set([2 ** i for i in range(int(np.log2(largest)) + 1)] + [largest]))
+    results = list()
+    for batch_size in candidates:
+        samples_per_second = measure_throughput(model, batch_size, n_steps=n_steps, is_training=is_training)
+        if samples_per_second is None:
+            print(">> batch {}: out of memory".format(batch_size))
+            break
+        print(">> batch {}: {:.2f} samples/s".format(batch_size, samples_per_second))
+        results.append({"batch_size": batch_size, "samples_per_second": samples_per_second})
+    if not results:
+        raise ValueError("batch of {} does not fit in memory".format(candidates[0]))
+    best = max(results, key=lambda result: result["samples_per_second"])
+    return best["batch_size"], results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="memory estimate and batch size of a model")
+    parser.add_argument('-i', '--model_file', type=str, required=True)
+    parser.add_argument('-ps', '--patch_shapes', type=str, default=None,
+                        help="candidate patch shapes separated by commas, e.g. 128-128-128,160-192-128")
+    parser.add_argument('-g', '--memory_budget', type=float, default=None,
+                        help="memory of each device in GB, default is the memory of the device")
+    parser.add_argument('-ba', '--batch_size', type=int, default=1, help="batch size of the estimate")
+    parser.add_argument('-t', '--is_throughput', type=int, default=0, choices=[0, 1],
+                        help="measure the throughput of the batch sizes on the local device")
+    parser.add_argument('-o', '--out_file', type=str, default=None, help="json report")
+    args = parser.parse_args()
+
+    from unet3d.training import load_old_model
+    model = load_old_model(args.model_file)
+    memory_budget = get_memory_budget(args.memory_budget)
+    report = {"model_file": args.model_file,
+              "estimate": estimate_memory(model, batch_size=args.batch_size),
+              "batch_size": get_batch_size(model, memory_budget=memory_budget)}
+    print(">> batch {}: parameters {:.2f} GB, activations {:.2f} GB, total {:.2f} GB".format(
+        args.batch_size, report["estimate"]["parameters"] / GB, report["estimate"]["activations"] / GB,
+        report["estimate"]["total"] / GB))
+    print(">> largest batch in budget: {}".format(report["batch_size"]))
+    if args.patch_shapes is not None:
+        patch_shapes = [get_shape_from_string(shape) for shape in args.patch_shapes.split(",")]
+        report["patch_shape"], report["patch_batch_size"] = get_patch_shape(model, patch_shapes,
+                                                                            memory_budget=memory_budget)
+        print(">> largest patch in budget: {} (batch {})".format(report["patch_shape"], report["patch_batch_size"]))
+    if args.is_throughput:
+        report["best_batch_size"], report["throughput"] = tune_batch_size(model, memory_budget=memory_budget)
+        print(">> best measured batch: {}".format(report["best_batch_size"]))
+    if args.out_file is not None:
+        with open(args.out_file, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -143,6 +143,8 @@ class GroupNormalization(Layer):
 
     def call(self, inputs, **kwargs):
         input_shape = K.int_shape(inputs)
+        if self.axis % len(input_shape) == len(input_shape) - 1:
+            return self.call_channels_last(inputs)
         tensor_input_shape = K.shape(inputs)
 
         # Prepare broadcasting shape.
@@ -187,6 +189,32 @@ class GroupNormalization(Layer):
 
         return outputs
 
+    def call_channels_last(self, inputs):
+        """
+        Channels on the last axis: the groups are split from the last axis, so that channel c belongs to the same
+        group as with the channels on axis 1.
+        """
+        input_shape = K.int_shape(inputs)
+        tensor_input_shape = K.shape(inputs)
+        n_dims = len(input_shape)
+        group_size = input_shape[-1] // self.groups
+
+        group_shape = [tensor_input_shape[i] for i in range(n_dims - 1)] + [self.groups, group_size]
+        inputs = K.reshape(inputs, K.stack(group_shape))
+
+        group_reduction_axes = list(range(1, n_dims - 1)) + [n_dims]
+        mean = K.mean(inputs, axis=group_reduction_axes, keepdims=True)
+        variance = K.var(inputs, axis=group_reduction_axes, keepdims=True)
+        outputs = (inputs - mean) / (K.sqrt(variance + self.epsilon))
+
+        broadcast_shape = [1] * (n_dims - 1) + [self.groups, group_size]
+        if self.scale:
+            outputs = outputs * K.reshape(self.gamma, broadcast_shape)
+        if self.center:
+            outputs = outputs + K.reshape(self.beta, broadcast_shape)
+
+        return K.reshape(outputs, tensor_input_shape)
+
     def get_config(self):
         config = {
             'groups': self.groups,
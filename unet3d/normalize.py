@@ -11,7 +11,8 @@ from .utils import crop_img, crop_img_to, read_image
 
 from unet3d.utils.utils import resize, read_image_files
 from unet3d.utils.path_utils import get_template_path
-from unet3d.utils.volume import get_background_mask
+from unet3d.utils.volume import get_volume_paths_from_one_volume, get_background_mask
+from unet3d.utils.foreground import get_foreground_from_files, get_bbox_slices
 from unet3d.utils.utils import str2bool
 
 
@@ -33,18 +34,31 @@ def get_cropping_parameters_old(in_files):
     return crop_img(foreground, return_slices=True, copy=True)
 
 
-def get_cropping_parameters(in_files):
-    mask = get_background_mask(in_files[0][0])
-    return crop_img(mask, return_slices=True, copy=True)
+def get_cropping_parameters(in_files, image_cache=None, is_fast_crop=False, threshold=None):
+    """
+    :param is_fast_crop: if True, crops to the bounding box of the voxels above threshold (non-zero if threshold is
+    None) of the subject's images, read once (see unet3d.utils.foreground). Otherwise crops to the mask of nilearn's
+    compute_multi_background_mask (background estimated from the image borders, opening and connected components).
+    :return: crop slices, 1 voxel around the foreground
+    """
+    if not is_fast_crop:
+        mask = get_background_mask(in_files[0][0])
+        return crop_img(mask, return_slices=True, copy=True)
+    # 1 voxel around the foreground, as crop_img pads the bounding box
+    foreground = get_foreground_from_files(get_volume_paths_from_one_volume(in_files[0][0]), threshold=threshold,
+                                           margin=1, image_cache=image_cache)
+    return list(get_bbox_slices(foreground["start"], foreground["stop"]))
 
 
-def reslice_image_set(in_files, image_shape, out_files=None, label_indices=None, crop=False):
+def reslice_image_set(in_files, image_shape, out_files=None, label_indices=None, crop=False, image_cache=None,
+                      is_fast_crop=False, crop_threshold=None):
     if crop:
-        crop_slices = get_cropping_parameters([in_files])
+        crop_slices = get_cropping_parameters([in_files], image_cache=image_cache, is_fast_crop=is_fast_crop,
+                                              threshold=crop_threshold)
     else:
         crop_slices = None
     images = read_image_files(
-        in_files, image_shape=image_shape, crop=crop_slices, label_indices=label_indices)
+        in_files, image_shape=image_shape, crop=crop_slices, label_indices=label_indices, image_cache=image_cache)
     if out_files:
         for image, out_file in zip(images, out_files):
             image.to_filename(out_file)
@@ -2,12 +2,15 @@ import os
 
 import nibabel as nib
 import numpy as np
-import tables
 
 from .training import load_old_model
 from .utils import pickle_load
 from .utils.patches import reconstruct_from_patches, get_patch_from_3d_data, compute_patch_indices
 from .augment import permute_data, generate_permutation_keys, reverse_permute_data
+from .data import open_data_file
+from .data_cropped import is_cropped_data_file, write_uncropped_image
+from .utils.image_writer import get_image_writer, ImageWriter, LABEL_IMAGE, PROBABILITY_IMAGE
+from .utils.foreground import has_foreground, get_bbox_slices
 
 
 def patch_wise_prediction(model, data, overlap=0, batch_size=1, permute=False):
@@ -40,6 +43,20 @@ def patch_wise_prediction(model, data, overlap=0, batch_size=1, permute=False):
     return reconstruct_from_patches(predictions, patch_indices=indices, data_shape=output_shape)
 
 
+def foreground_prediction(model, data, bbox, overlap=0, permute=False):
+    """
+    Patch-wise prediction of the foreground bounding box only, pasted back in a prediction of zeros of the whole
+    image: the patches of background are not predicted.
+    :param bbox: start and stop of the foreground, as in root.foreground_bbox.
+    """
+    roi = get_bbox_slices(bbox[0], bbox[1])
+    roi_prediction = patch_wise_prediction(model=model, data=data[(slice(None), slice(None)) + roi],
+                                           overlap=overlap, permute=permute)
+    prediction = np.zeros((roi_prediction.shape[0],) + tuple(data.shape[-3:]), dtype=roi_prediction.dtype)
+    prediction[(slice(None),) + roi] = roi_prediction
+    return prediction
+
+
 def get_prediction_labels(prediction, threshold=0.5, labels=None):
     n_samples = prediction.shape[0]
     label_arrays = []
@@ -106,7 +123,8 @@ def multi_class_prediction(prediction, affine):
 
 
 def run_validation_case(data_index, output_dir, model, data_file, training_modalities,
-                        output_label_map=False, threshold=0.5, labels=None, overlap=0, permute=False):
+                        output_label_map=False, threshold=0.5, labels=None, overlap=0, permute=False,
+                        is_foreground_roi=False, image_writer=None):
     """
     Runs a test case and writes predicted images to file.
     :param data_index: Index from of the list of test cases to get an image prediction from.
@@ -119,47 +137,64 @@ def run_validation_case(data_index, output_dir, model, data_file, training_modal
     :param training_modalities:
     :param data_file:
     :param model:
+    :param is_foreground_roi: If True and the data file stores the foreground (see unet3d.utils.foreground), only the
+    foreground bounding box is predicted.
+    :param image_writer: unet3d.utils.image_writer.ImageWriter of the written images. Default writes .nii.gz files
+    with uint8 label maps in this thread.
     """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    if image_writer is None:
+        image_writer = ImageWriter()
 
     affine = data_file.root.affine[data_index]
     test_data = np.asarray([data_file.root.data[data_index]])
     for i, modality in enumerate(training_modalities):
         image = nib.Nifti1Image(test_data[0, i], affine)
-        image.to_filename(os.path.join(
-            output_dir, "data_{0}.nii.gz".format(modality)))
+        image_writer.write(image, image_writer.get_filename(output_dir, "data_{0}".format(modality)))
 
     test_truth = nib.Nifti1Image(data_file.root.truth[data_index][0], affine)
-    test_truth.to_filename(os.path.join(output_dir, "truth.nii.gz"))
+    image_writer.write(test_truth, image_writer.get_filename(output_dir, "truth"), kind=LABEL_IMAGE)
 
     # patch_shape = tuple([int(dim) for dim in model.input.shape[-3:]])
     patch_shape = model.input_shape[-3:]
     if patch_shape == test_data.shape[-3:]:
         prediction = predict(model, test_data, permute=permute)
+    elif is_foreground_roi and has_foreground(data_file):
+        prediction = foreground_prediction(model, test_data, data_file.root.foreground_bbox[data_index],
+                                           overlap=overlap, permute=permute)[np.newaxis]
     else:
         prediction = patch_wise_prediction(
             model=model, data=test_data, overlap=overlap, permute=permute)[np.newaxis]
     prediction_image = prediction_to_image(prediction, affine, label_map=output_label_map, threshold=threshold,
                                            labels=labels)
+    kind = LABEL_IMAGE if output_label_map else PROBABILITY_IMAGE
     if isinstance(prediction_image, list):
         for i, image in enumerate(prediction_image):
-            image.to_filename(os.path.join(
-                output_dir, "prediction_{0}.nii.gz".format(i + 1)))
+            image_writer.write(image, image_writer.get_filename(output_dir, "prediction_{0}".format(i + 1)),
+                               kind=kind)
     else:
-        prediction_image.to_filename(
-            os.path.join(output_dir, "prediction.nii.gz"))
+        image_writer.write(prediction_image, image_writer.get_filename(output_dir, "prediction"), kind=kind)
+        if is_cropped_data_file(data_file):
+            # the cases are predicted in their cropped grid, also write the label map in the grid of the full image
+            write_uncropped_image(data_file, data_index, np.asarray(prediction_image.dataobj),
+                                  image_writer.get_filename(output_dir, "prediction_full"),
+                                  image_writer=image_writer, kind=kind)
 
 
 def run_validation_cases(validation_keys_file, model_file, training_modalities, labels, hdf5_file,
                          output_label_map=False, output_dir=".", threshold=0.5, overlap=0, permute=False,
-                         data_type_generator="both"):
+                         data_type_generator="both", is_foreground_roi=False,
+                         compress_level=1, probability_dtype=None, n_writer_threads=0):
     validation_indices = pickle_load(validation_keys_file)
 
     from unet3d.utils.model_utils import load_model_multi_gpu
     model = load_model_multi_gpu(model_file)
     # model = load_old_model(model_file)
-    data_file = tables.open_file(hdf5_file, "r")
+    data_file = open_data_file(hdf5_file)
+    # the images of a case are written while the next one is predicted
+    image_writer = get_image_writer(compress_level=compress_level, probability_dtype=probability_dtype,
+                                    n_threads=n_writer_threads)
     for index in validation_indices:
         print(">> processing", index)
         if 'subject_ids' in data_file.root:
@@ -170,7 +205,9 @@ def run_validation_cases(validation_keys_file, model_file, training_modalities,
                 output_dir, "validation_case_{}".format(index))
         run_validation_case(data_index=index, output_dir=case_directory, model=model, data_file=data_file,
                             training_modalities=training_modalities, output_label_map=output_label_map, labels=labels,
-                            threshold=threshold, overlap=overlap, permute=permute)
+                            threshold=threshold, overlap=overlap, permute=permute,
+                            is_foreground_roi=is_foreground_roi, image_writer=image_writer)
+    image_writer.close()
     data_file.close()
 
 
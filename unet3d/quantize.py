@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+
+from unet3d.data import open_data_file
+from unet3d.utils import pickle_load
+from unet3d.utils.path_utils import get_shape_from_string
+from unet3d.evaluation import get_project_regions, get_header, get_scores
+
+
+def get_quantized_model_file(model_file):
+    """
+    :return: file of the quantized model, e.g. model.h5 -> model_int8.tflite
+    """
+    return os.path.splitext(model_file)[0] + "_int8.tflite"
+
+
+def get_patch_shape(model, model_dim):
+    """
+    Patch shape read by the generators of a model, e.g. (160, 192, 1) for a 2d model of input (4, 160, 192)
+    """
+    if model_dim == 2:
+        return tuple(model.input_shape[-2:]) + (1,)
+    return tuple(model.input_shape[-3:])
+
+
+def get_calibration_generator(data_file, index_list, model_dim, patch_shape, batch_size=8, labels=(1, 2, 4)):
+    """
+    Validation generator of the model dimension, without shuffling nor augmentation.
+    """
+    kwargs = dict(batch_size=batch_size, n_labels=len(labels), labels=labels, patch_shape=patch_shape,
+                  shuffle_index_list=False)
+    if model_dim == 2:
+        from unet2d.generator import data_generator2d
+        return data_generator2d(data_file, index_list, **kwargs)
+    if model_dim == 25:
+        from unet25d.generator import data_generator25d
+        return data_generator25d(data_file, index_list, **kwargs)
+    from unet3d.generator import data_generator
+    return data_generator(data_file, index_list, **kwargs)
+
+
+def get_representative_dataset(generator, n_batches):
+    """
+    :return: function yielding the calibration samples one by one, as expected by TFLiteConverter
+    """
+    def representative_dataset():
+        for _ in range(n_batches):
+            x, _ = next(generator)
+            for sample in x:
+                yield [sample[np.newaxis].astype(np.float32)]
+    return representative_dataset
+
+
+def convert_to_tflite(model, representative_dataset=None):
+    """
+    Converts a keras model of the current session with post-training quantization: weights and activations are
+    quantized to int8 with the ranges seen on representative_dataset (inputs and outputs stay float32). Without
+    representative_dataset, or with a tensorflow that does not support it, only the weights are quantized.
+    :return: tflite flatbuffer
+    """
+    converter = tf.lite.TFLiteConverter.from_session(K.get_session(), model.inputs, model.outputs)
+    if hasattr(tf.lite, "Optimize"):
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if representative_dataset is not None:
+            converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+    else:
+        print(">> tensorflow {} has no calibration, quantize the weights only".format(tf.__version__))
+        converter.post_training_quantize = True
+    return converter.convert()
+
+
+class TFLiteModel(object):
+    """
+    Adapter of a tflite model with the interface used by patch_wise_prediction: input_shape, output_shape and predict.
+    The interpreter is resized when the batch size changes.
+    """
+
+    def __init__(self, model_file):
+        self.interpreter = tf.lite.Interpreter(model_path=model_file)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.batch_size = int(self.input_details[0]["shape"][0])
+        self.input_shape = (None,) + tuple(self.input_details[0]["shape"][1:])
+        output_shapes = [(None,) + tuple(details["shape"][1:]) for details in self.output_details]
+        self.output_shape = output_shapes[0] if len(output_shapes) == 1 else output_shapes
+
+    def resize(self, batch_size):
+        for details in self.input_details:
+            self.interpreter.resize_tensor_input(details["index"], [batch_size] + list(details["shape"][1:]))
+        self.interpreter.allocate_tensors()
+        self.batch_size = batch_size
+
+    def predict(self, data):
+        if len(data) != self.batch_size:
+            self.resize(len(data))
+        self.interpreter.set_tensor(self.input_details[0]["index"], np.asarray(data, dtype=np.float32))
+        self.interpreter.invoke()
+        outputs = [self.interpreter.get_tensor(details["index"]) for details in self.output_details]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+def get_patch_wise_prediction(model_dim):
+    if model_dim == 2:
+        from unet2d.prediction import patch_wise_prediction
+    elif model_dim == 25:
+        from unet25d.prediction import patch_wise_prediction
+    else:
+        from unet3d.prediction import patch_wise_prediction
+    return patch_wise_prediction
+
+
+def get_label_map(prediction, labels, threshold=0.5):
+    from unet3d.prediction import get_prediction_labels
+    return get_prediction_labels(prediction[np.newaxis], threshold=threshold, labels=labels)[0]
+
+
+def compare_models(model, quantized_model, data_file, index_list, model_dim, labels=(1, 2, 4), project="brats",
+                   batch_size=16):
+    """
+    Predicts the cases of index_list with both models.
+    :return: dict with the mean dice of each region for both models, their difference and the prediction times
+    """
+    patch_wise_prediction = get_patch_wise_prediction(model_dim)
+    regions = get_project_regions(project, labels)
+    header = get_header(regions, metrics=("dice",))
+    scores = {"float": list(), "int8": list()}
+    times = {"float": 0., "int8": 0.}
+    for index in index_list:
+        data = data_file.root.data[index][np.newaxis]
+        truth = data_file.root.truth[index, 0]
+        for name, current_model in (("float", model), ("int8", quantized_model)):
+            kwargs = dict() if model_dim == 3 else dict(batch_size=batch_size)
+            start = time.perf_counter()
+            prediction = patch_wise_prediction(current_model, data, **kwargs)
+            times[name] += time.perf_counter() - start
+            scores[name].append(get_scores(truth, get_label_map(prediction, labels), regions, metrics=("dice",)))
+        print(">> case {}: dice float {} int8 {}".format(index, np.round(scores["float"][-1], 4),
+                                                        np.round(scores["int8"][-1], 4)))
+    report = {"n_cases": len(index_list), "time_float": times["float"], "time_int8": times["int8"],
+              "speedup": times["float"] / times["int8"] if times["int8"] > 0 else None}
+    for i, column in enumerate(header):
+        dice_float = float(np.mean([case_scores[i] for case_scores in scores["float"]]))
+        dice_int8 = float(np.mean([case_scores[i] for case_scores in scores["int8"]]))
+        report[column] = {"float": dice_float, "int8": dice_int8, "delta": dice_int8 - dice_float}
+    return report
+
+
+def quantize_model(model_file, data_file, validation_keys_file, testing_keys_file, model_dim=3, out_file=None,
+                   labels=(1, 2, 4), project="brats", n_calibration_batches=8, calibration_batch_size=8,
+                   n_test_cases=None):
+    """
+    Writes the int8 tflite model of model_file, calibrated on batches of the validation generator, and a json report
+    (<out_file>.json) of the dice difference and speedup against the float model on the testing cases.
+    :param model_dim: 2, 25 or 3.
+    :param n_test_cases: number of testing cases of the report. None uses all of them, 0 skips the report.
+    :return: out_file, report
+    """
+    from unet3d.utils.model_utils import load_model_multi_gpu
+    from unet3d.export import get_inference_model
+
+    if out_file is None:
+        out_file = get_quantized_model_file(model_file)
+    K.set_learning_phase(0)
+    model, _, _ = get_inference_model(load_model_multi_gpu(model_file))
+    data_file = open_data_file(data_file)
+    try:
+        generator = get_calibration_generator(data_file, pickle_load(validation_keys_file), model_dim,
+                                              get_patch_shape(model, model_dim), batch_size=calibration_batch_size,
+                                              labels=labels)
+        print(">> quantize {} with {} calibration batches".format(model_file, n_calibration_batches))
+        with open(out_file, "wb") as f:
+            f.write(convert_to_tflite(model, get_representative_dataset(generator, n_calibration_batches)))
+        print(">> quantized model saved to {}".format(out_file))
+
+        report = None
+        testing_list = pickle_load(testing_keys_file)
+        if n_test_cases is not None:
+            testing_list = testing_list[:n_test_cases]
+        if testing_list:
+            report = compare_models(model, TFLiteModel(out_file), data_file, testing_list, model_dim,
+                                    labels=labels, project=project)
+            report["model_file"] = model_file
+            with open(out_file + ".json", "w") as f:
+                json.dump(report, f, indent=4)
+            print(">> speedup x{:.2f}, dice delta {}".format(
+                report["speedup"] or 0., dict([(key, round(value["delta"], 4)) for key, value in report.items()
+                                               if isinstance(value, dict)])))
+    finally:
+        data_file.close()
+    return out_file, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="int8 post-training quantization of a model for cpu inference")
+    parser.add_argument('-i', '--model_file', type=str, required=True)
+    parser.add_argument('-d', '--data_file', type=str, required=True)
+    parser.add_argument('-v', '--validation_keys_file', type=str, required=True)
+    parser.add_argument('-t', '--testing_keys_file', type=str, required=True)
+    parser.add_argument('-dim', '--model_dim', type=int, default=3, choices=[2, 25, 3])
+    parser.add_argument('-o', '--out_file', type=str, default=None, help="default is <model>_int8.tflite")
+    parser.add_argument('-l', '--labels', type=str, default="1-2-4")
+    parser.add_argument('-p', '--project', type=str, default="brats")
+    parser.add_argument('-nc', '--n_calibration_batches', type=int, default=8)
+    parser.add_argument('-nt', '--n_test_cases', type=int, default=None)
+    args = parser.parse_args()
+    quantize_model(args.model_file, args.data_file, args.validation_keys_file, args.testing_keys_file,
+                   model_dim=args.model_dim, out_file=args.out_file, labels=get_shape_from_string(args.labels),
+                   project=args.project, n_calibration_batches=args.n_calibration_batches,
+                   n_test_cases=args.n_test_cases)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,19 @@
+import os
 import math
 from functools import partial
 
+import h5py
+
 from keras import backend as K
 from keras.callbacks import ModelCheckpoint, CSVLogger, LearningRateScheduler, ReduceLROnPlateau, EarlyStopping
-from keras.models import load_model
+from keras.models import load_model, model_from_json
 
 from unet3d.metrics import (dice_coefficient, dice_coefficient_loss, dice_coef, dice_coef_loss,
                             weighted_dice_coefficient_loss, weighted_dice_coefficient, minh_dice_coef_loss,
                             tversky_loss, focal_loss, ignore_unknown_xentropy, minh_dice_coef_metric,
                             tv_minh_loss, tv_weighted_loss)
+from unet3d.callbacks import AsyncModelCheckpoint, TimingCallback, get_architecture_file
+from unet3d.utils.timing import TimedGenerator
 
 K.set_image_dim_ordering('th')
 
@@ -20,16 +25,33 @@ def step_decay(epoch, initial_lrate, drop, epochs_drop):
 
 def get_callbacks(model_file, initial_learning_rate=0.0001, learning_rate_drop=0.5, learning_rate_epochs=None,
                   learning_rate_patience=50, logging_file="training.log", verbosity=1,
-                  early_stopping_patience=None):
+                  early_stopping_patience=None, is_async_checkpoint=False, is_checkpoint_weights_only=False,
+                  n_last_checkpoints=0, timing_file=None):
+    """
+    :param is_async_checkpoint: if True, checkpoints are written by a background thread (AsyncModelCheckpoint)
+    instead of ModelCheckpoint, without the optimizer state.
+    :param is_checkpoint_weights_only: with is_async_checkpoint, model_file holds only the weights and the architecture
+    is written to get_architecture_file(model_file).
+    :param n_last_checkpoints: with is_async_checkpoint, the weights of the last n epochs are kept as well.
+    :param timing_file: if given, the data wait and step times are written to this jsonl file (TimingCallback).
+    """
     callbacks = list()
+    if timing_file:
+        callbacks.append(TimingCallback(timing_file))
     # callbacks.append(ModelCheckpoint(model_file,
     #                                  save_best_only=True,
     #                                  monitor="val_minh_dice_coef_metric",
     #                                  mode="max",
     #                                  period=1))
 
-    callbacks.append(ModelCheckpoint(model_file,
-                                     save_best_only=True))
+    if is_async_checkpoint:
+        callbacks.append(AsyncModelCheckpoint(model_file,
+                                              save_best_only=True,
+                                              save_weights_only=is_checkpoint_weights_only,
+                                              n_last_checkpoints=n_last_checkpoints))
+    else:
+        callbacks.append(ModelCheckpoint(model_file,
+                                         save_best_only=True))
 
     callbacks.append(CSVLogger(logging_file, append=True))
     if learning_rate_epochs:
@@ -46,6 +68,30 @@ def get_callbacks(model_file, initial_learning_rate=0.0001, learning_rate_drop=0
 
 def load_old_model(model_file):
     print("Loading pre-trained model")
+    custom_objects = get_custom_objects()
+    architecture_file = get_architecture_file(model_file)
+    if is_weights_only_file(model_file) and os.path.exists(architecture_file):
+        # written by AsyncModelCheckpoint(save_weights_only=True)
+        with open(architecture_file, "r") as f:
+            model = model_from_json(f.read(), custom_objects=custom_objects)
+        model.load_weights(model_file)
+        return model
+    try:
+        return load_model(model_file, custom_objects=custom_objects)
+    except ValueError as error:
+        if 'InstanceNormalization' in str(error):
+            raise ValueError(str(error) + "\n\nPlease install keras-contrib to use InstanceNormalization:\n"
+                                          "'pip install git+https://www.github.com/keras-team/keras-contrib.git'")
+        else:
+            raise error
+
+
+def is_weights_only_file(model_file):
+    with h5py.File(model_file, "r") as f:
+        return "model_config" not in f.attrs
+
+
+def get_custom_objects():
     custom_objects = {'dice_coefficient_loss': dice_coefficient_loss, 'dice_coefficient': dice_coefficient,
                       'dice_coef': dice_coef, 'dice_coef_loss': dice_coef_loss,
                       'weighted_dice_coefficient': weighted_dice_coefficient,
@@ -63,19 +109,13 @@ def load_old_model(model_file):
         custom_objects["InstanceNormalization"] = InstanceNormalization
     except ImportError:
         pass
-    try:
-        return load_model(model_file, custom_objects=custom_objects)
-    except ValueError as error:
-        if 'InstanceNormalization' in str(error):
-            raise ValueError(str(error) + "\n\nPlease install keras-contrib to use InstanceNormalization:\n"
-                                          "'pip install git+https://www.github.com/keras-team/keras-contrib.git'")
-        else:
-            raise error
+    return custom_objects
 
 
 def train_model(experiment, model, model_file, training_generator, validation_generator, steps_per_epoch, validation_steps,
                 initial_learning_rate=0.001, learning_rate_drop=0.5, learning_rate_epochs=None, n_epochs=500,
-                learning_rate_patience=20, early_stopping_patience=None):
+                learning_rate_patience=20, early_stopping_patience=None,
+                is_async_checkpoint=False, is_checkpoint_weights_only=False, n_last_checkpoints=0, timing_file=None):
     """
     Train a Keras model.
     :param early_stopping_patience: If set, training will end early if the validation loss does not improve after the
@@ -92,8 +132,15 @@ def train_model(experiment, model, model_file, training_generator, validation_ge
     :param learning_rate_drop: How much at which to the learning rate will decay.
     :param learning_rate_epochs: Number of epochs after which the learning rate will drop.
     :param n_epochs: Total number of epochs to train the model.
+    :param is_async_checkpoint: Write checkpoints from a background thread (see get_callbacks).
+    :param is_checkpoint_weights_only: Asynchronous checkpoints hold only the weights, paired with a json architecture.
+    :param n_last_checkpoints: Number of last epochs whose asynchronous checkpoints are kept.
+    :param timing_file: If given, the time spent waiting for the training generator, in the train step and in the
+    stages of the generator is written to this jsonl file.
     :return: 
     """
+    if timing_file:
+        training_generator = TimedGenerator(training_generator)
     if experiment == None:
         history = model.fit_generator(generator=training_generator,
                                       steps_per_epoch=steps_per_epoch,
@@ -106,7 +153,11 @@ def train_model(experiment, model, model_file, training_generator, validation_ge
                                                               learning_rate_drop=learning_rate_drop,
                                                               learning_rate_epochs=learning_rate_epochs,
                                                               learning_rate_patience=learning_rate_patience,
-                                                              early_stopping_patience=early_stopping_patience))
+                                                              early_stopping_patience=early_stopping_patience,
+                                                              is_async_checkpoint=is_async_checkpoint,
+                                                              is_checkpoint_weights_only=is_checkpoint_weights_only,
+                                                              n_last_checkpoints=n_last_checkpoints,
+                                                              timing_file=timing_file))
     else:
         with experiment.train():
             history = model.fit_generator(generator=training_generator,
@@ -123,4 +174,8 @@ def train_model(experiment, model, model_file, training_generator, validation_ge
                                                                   learning_rate_drop=learning_rate_drop,
                                                                   learning_rate_epochs=learning_rate_epochs,
                                                                   learning_rate_patience=learning_rate_patience,
-                                                                  early_stopping_patience=early_stopping_patience))
+                                                                  early_stopping_patience=early_stopping_patience,
+                                                                  is_async_checkpoint=is_async_checkpoint,
+                                                                  is_checkpoint_weights_only=is_checkpoint_weights_only,
+                                                                  n_last_checkpoints=n_last_checkpoints,
+                                                                  timing_file=timing_file))
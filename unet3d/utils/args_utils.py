@@ -110,7 +110,7 @@ def train():
                         help="patch shape to train")
     parser.add_argument('-ba', '--batch_size', type=int,
                         default=1,
-                        help="train batch size")
+                        help="train batch size, 0 selects the largest that fits the memory budget")
     parser.add_argument('-r', '--crop', type=str,
                         default="1", choices=config_dict["crop"])
     parser.add_argument('-b', '--is_bias_correction', type=str,
@@ -140,7 +140,7 @@ def train2d():
                         help="patch shape to train")
     parser.add_argument('-ba', '--batch_size', type=int,
                         default=64,
-                        help="train batch size")
+                        help="train batch size, 0 selects the largest that fits the memory budget")
     parser.add_argument('-r', '--crop', type=str,
                         default="1", choices=config_dict["crop"])
     parser.add_argument('-b', '--is_bias_correction', type=str,
@@ -170,7 +170,7 @@ def train25d():
                         help="patch shape to train")
     parser.add_argument('-ba', '--batch_size', type=int,
                         default=64,
-                        help="train batch size")
+                        help="train batch size, 0 selects the largest that fits the memory budget")
     parser.add_argument('-r', '--crop', type=str,
                         default="1", choices=config_dict["crop"])
     parser.add_argument('-b', '--is_bias_correction', type=str,
@@ -0,0 +1,126 @@
+import os
+import atexit
+import shutil
+import tempfile
+
+import numpy as np
+
+from unet3d.utils.threadsafe import threadsafe_generator
+
+
+def get_outputs(y):
+    """
+    :return: list of the target arrays of a batch: y of a single output model, or the list of y of the cascaded and
+    separated models (see convert_multioutput_data)
+    """
+    return list(y) if isinstance(y, (list, tuple)) else [y]
+
+
+class BatchCache(object):
+    """
+    Batches (x, y) of a deterministic generator (the validation patches: fixed overlap, no augmentation), kept after
+    their first pass so that the following epochs do not read the data file, cut the patches and build the one-hot
+    labels again. The batches are kept in memory up to max_bytes; the following ones are written as .npy files
+    under cache_dir and read back as read-only memory maps. Without cache_dir, a set of batches larger than
+    max_bytes is not cached. The targets y may be a list of arrays (multi-output models).
+    """
+
+    def __init__(self, max_bytes, cache_dir=None, name="validation cache"):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.name = name
+        self.batches = list()
+        self.n_bytes = 0
+        self.n_disk_bytes = 0
+        self.batch_dir = None
+        self.is_overflow = False
+
+    def get_batch_dir(self):
+        if self.batch_dir is None:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            self.batch_dir = tempfile.mkdtemp(prefix="batches_", dir=self.cache_dir)
+            atexit.register(self.clear)
+        return self.batch_dir
+
+    def add(self, x, y):
+        """
+        Keeps a copy of the batch (x, y). Returns False once the batches exceed the budget and cannot be cached.
+        """
+        if self.is_overflow:
+            return False
+        outputs = get_outputs(y)
+        batch_bytes = x.nbytes + sum([output.nbytes for output in outputs])
+        if self.n_bytes + batch_bytes <= self.max_bytes:
+            self.batches.append((np.array(x), self.get_y(y, [np.array(output) for output in outputs])))
+            self.n_bytes += batch_bytes
+        elif self.cache_dir:
+            arrays = list()
+            names = ["x"] + ["y{}".format(i) for i in range(len(outputs))]
+            for name, array in zip(names, [x] + outputs):
+                filename = os.path.join(self.get_batch_dir(), "{}_{:06d}.npy".format(name, len(self.batches)))
+                np.save(filename, array)
+                arrays.append(np.load(filename, mmap_mode="r"))
+            self.batches.append((arrays[0], self.get_y(y, arrays[1:])))
+            self.n_disk_bytes += batch_bytes
+        else:
+            print(">> {}: the batches exceed {:.0f}mb, not cached".format(self.name, self.max_bytes / 1024. ** 2))
+            self.clear()
+            self.is_overflow = True
+            return False
+        return True
+
+    @staticmethod
+    def get_y(y, outputs):
+        """
+        :return: outputs in the structure of y (a single array or a list)
+        """
+        if isinstance(y, (list, tuple)):
+            return type(y)(outputs)
+        return outputs[0]
+
+    def clear(self):
+        self.batches = list()
+        self.n_bytes = 0
+        self.n_disk_bytes = 0
+        if self.batch_dir is not None:
+            shutil.rmtree(self.batch_dir, ignore_errors=True)
+            self.batch_dir = None
+
+    def report(self):
+        print(">> {}: {} batches, {:.0f}mb in memory, {:.0f}mb on disk".format(
+            self.name, len(self.batches), self.n_bytes / 1024. ** 2, self.n_disk_bytes / 1024. ** 2))
+
+
+@threadsafe_generator
+def cached_batch_generator(generator, n_steps, cache):
+    """
+    Yields the batches of generator. The first n_steps batches (the validation_steps keras reads per epoch) are
+    kept in cache and replayed in the same order for every following epoch.
+    """
+    for _ in range(n_steps):
+        x, y = next(generator)
+        cache.add(x, y)
+        yield x, y
+    if cache.is_overflow:
+        while True:
+            yield next(generator)
+    cache.report()
+    while True:
+        for x, y in cache.batches:
+            yield x, y
+
+
+def get_cached_generator(generator, n_steps, cache_size_mb=0, cache_dir=None, name="validation cache"):
+    """
+    :param generator: generator of deterministic batches, e.g. the validation generator.
+    :param n_steps: number of batches of an epoch.
+    :param cache_size_mb: memory budget of the cached batches in megabytes.
+    :param cache_dir: directory of the batches beyond the memory budget. None caches only in memory.
+    :return: generator replaying the batches of the first epoch (see cached_batch_generator), or generator if
+    caching is disabled (no budget and no cache_dir)
+    """
+    if (not cache_size_mb and not cache_dir) or n_steps <= 0:
+        return generator
+    cache = BatchCache(max_bytes=int((cache_size_mb or 0) * 1024 ** 2), cache_dir=cache_dir, name=name)
+    return cached_batch_generator(generator, n_steps, cache)
@@ -0,0 +1,142 @@
+import numpy as np
+import tables
+
+
+FOREGROUND_NODE = "foreground"
+FOREGROUND_BBOX_NODE = "foreground_bbox"
+FOREGROUND_VOXELS_NODE = "foreground_voxels"
+
+
+def get_foreground_mask(data, threshold=None):
+    """
+    :param data: volume (x, y, z) or channels (n_channels, x, y, z).
+    :param threshold: None: the foreground is the non-zero voxels. Otherwise the voxels above threshold (e.g. -500 for
+    the body in CT images).
+    :return: boolean mask (x, y, z), foreground in any channel
+    """
+    data = np.asarray(data)
+    mask = data != 0 if threshold is None else data > threshold
+    if mask.ndim == 4:
+        mask = np.any(mask, axis=0)
+    return mask
+
+
+def get_projections(mask):
+    """
+    :return: per-axis projections of a 3d mask (is there foreground in each plane x, y and z), from two np.any
+    reductions of the volume
+    """
+    xy = np.any(mask, axis=2)
+    return np.any(xy, axis=1), np.any(xy, axis=0), np.any(mask, axis=(0, 1))
+
+
+def get_bbox_from_projections(projections, margin=0):
+    """
+    :return: start and stop (excluded) of the foreground along each axis, extended by margin voxels and clipped to the
+    volume. The whole volume if there is no foreground.
+    """
+    start, stop = list(), list()
+    for projection in projections:
+        indices = np.flatnonzero(projection)
+        if len(indices) == 0:
+            return np.zeros(len(projections), dtype=np.int32), \
+                np.asarray([len(p) for p in projections], dtype=np.int32)
+        start.append(max(indices[0] - margin, 0))
+        stop.append(min(indices[-1] + 1 + margin, len(projection)))
+    return np.asarray(start, dtype=np.int32), np.asarray(stop, dtype=np.int32)
+
+
+def get_bbox_slices(start, stop):
+    return tuple([slice(int(a), int(b)) for a, b in zip(start, stop)])
+
+
+def compute_foreground(data, threshold=None, margin=0, mask=None):
+    """
+    Foreground of a subject: mask, per-axis projections and bounding box, computed once and shared by the cropping,
+    the patch sampling, the inference roi and the dataset analysis.
+    :param data: volume (x, y, z) or channels (n_channels, x, y, z). Not used if mask is given.
+    :param mask: foreground mask given by the dataset (e.g. the External body contour of headneck).
+    :return: dict of mask, projections, start, stop (excluded) and n_voxels
+    """
+    if mask is None:
+        mask = get_foreground_mask(data, threshold=threshold)
+    else:
+        mask = np.asarray(mask) > 0
+    projections = get_projections(mask)
+    start, stop = get_bbox_from_projections(projections, margin=margin)
+    return {"mask": mask, "projections": projections, "start": start, "stop": stop,
+            "n_voxels": int(np.count_nonzero(mask))}
+
+
+def load_volume(path, image_cache=None):
+    if image_cache is not None:
+        from unet3d.utils.utils import read_image
+        return np.squeeze(np.asanyarray(read_image(path, image_cache=image_cache).dataobj))
+    import nibabel as nib
+    return np.squeeze(np.asanyarray(nib.load(path).dataobj))
+
+
+def get_foreground_from_files(paths, threshold=None, margin=0, mask_file=None, image_cache=None):
+    """
+    Foreground of the images of a subject, each image read once. The images must share their grid.
+    :param mask_file: if set, the foreground is this mask instead of the non-zero voxels of the images.
+    :param image_cache: unet3d.utils.image_cache.ImageCache the images are read through, or None
+    :return: dict of compute_foreground
+    """
+    if mask_file is not None:
+        return compute_foreground(None, margin=margin, mask=load_volume(mask_file, image_cache=image_cache))
+    mask = None
+    for path in paths:
+        image_mask = get_foreground_mask(load_volume(path, image_cache=image_cache), threshold=threshold)
+        mask = image_mask if mask is None else np.logical_or(mask, image_mask, out=mask)
+    return compute_foreground(None, margin=margin, mask=mask)
+
+
+def create_foreground_storage(hdf5_file, n_samples, image_shape=None):
+    """
+    Creates the foreground nodes of a data file: root.foreground_bbox (start, stop), root.foreground_voxels and, for
+    subjects of a common image_shape, root.foreground (masks).
+    """
+    if image_shape is not None:
+        hdf5_file.create_earray(hdf5_file.root, FOREGROUND_NODE, tables.BoolAtom(), shape=(0,) + tuple(image_shape),
+                                filters=tables.Filters(complevel=5, complib='blosc'), expectedrows=n_samples)
+    hdf5_file.create_earray(hdf5_file.root, FOREGROUND_BBOX_NODE, tables.Int32Atom(), shape=(0, 2, 3),
+                            expectedrows=n_samples)
+    hdf5_file.create_earray(hdf5_file.root, FOREGROUND_VOXELS_NODE, tables.Int64Atom(), shape=(0,),
+                            expectedrows=n_samples)
+
+
+def add_foreground_to_storage(hdf5_file, foreground, is_mask=True):
+    """
+    Appends the foreground of a subject. is_mask=False leaves the mask out of root.foreground (the subjects of
+    cropped data files store it in their own node).
+    """
+    if is_mask:
+        getattr(hdf5_file.root, FOREGROUND_NODE).append(foreground["mask"][np.newaxis])
+    bbox = np.stack([foreground["start"], foreground["stop"]])
+    getattr(hdf5_file.root, FOREGROUND_BBOX_NODE).append(bbox[np.newaxis])
+    getattr(hdf5_file.root, FOREGROUND_VOXELS_NODE).append(np.asarray([foreground["n_voxels"]], dtype=np.int64))
+
+
+def write_foreground_storage(hdf5_file, data_storage, threshold=None):
+    """
+    Computes and stores the foreground of every subject of data_storage. Must run before normalization, which
+    moves the background away from 0.
+    """
+    create_foreground_storage(hdf5_file, data_storage.shape[0], image_shape=data_storage.shape[-3:])
+    for index in range(data_storage.shape[0]):
+        add_foreground_to_storage(hdf5_file, compute_foreground(data_storage[index], threshold=threshold))
+
+
+def has_foreground(data_file):
+    return FOREGROUND_BBOX_NODE in data_file.root
+
+
+def get_foreground_bboxes(data_file):
+    """
+    :return: array (n_subjects, 2, 3) of the start and stop of the foreground of each subject, None if the data file
+    has no stored foreground
+    """
+    if not has_foreground(data_file):
+        return None
+    return getattr(data_file.root, FOREGROUND_BBOX_NODE)[:]
@@ -0,0 +1,144 @@
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+import nibabel as nib
+
+
+IMAGE_CACHE_INFO_FILE = "image.json"
+IMAGE_CACHE_DATA_FILE = "data.npy"
+IMAGE_CACHE_HEADER_FILE = "header.bin"
+
+
+class ImageCache(object):
+    """
+    Disk cache of decoded nifti images, shared by the prepare_data runs that build the data file variants
+    (is_denoise, is_normalize, is_hist_match, image_shape) from the same .nii.gz files. Each entry is an uncompressed
+    .npy array, opened as a read-only memory map, with the nifti header and the affine of the image. An entry is
+    keyed by the path, modification time and size of the source file, plus the crop and the resizing applied to it,
+    so an edited source file is decoded again. The least recently used entries are removed once the cache exceeds
+    max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes, name="image cache"):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.name = name
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_key(self, in_file, image_shape=None, interpolation="linear", crop=None):
+        stat = os.stat(in_file)
+        key = [os.path.abspath(in_file), stat.st_mtime_ns, stat.st_size]
+        if image_shape or crop:
+            key.append([[int(dim) for dim in image_shape] if image_shape else None, interpolation,
+                        [[s.start, s.stop, s.step] for s in crop] if crop else None])
+        return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, in_file, image_shape=None, interpolation="linear", crop=None):
+        """
+        :return: cached image, its data memory-mapped, None if it is not in the cache
+        """
+        entry_dir = self.get_entry_dir(self.get_key(in_file, image_shape, interpolation, crop))
+        try:
+            with open(os.path.join(entry_dir, IMAGE_CACHE_INFO_FILE)) as f:
+                info = json.load(f)
+            with open(os.path.join(entry_dir, IMAGE_CACHE_HEADER_FILE), "rb") as f:
+                header = nib.Nifti1Header(binaryblock=f.read())
+            data = np.load(os.path.join(entry_dir, IMAGE_CACHE_DATA_FILE), mmap_mode="r")
+            # the modification time of an entry orders the evictions
+            os.utime(entry_dir)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return nib.Nifti1Image(data, np.asarray(info["affine"]), header=header)
+
+    def put(self, in_file, image, image_shape=None, interpolation="linear", crop=None):
+        """
+        Stores image, read from in_file and cropped / resized with the given parameters.
+        """
+        entry_dir = self.get_entry_dir(self.get_key(in_file, image_shape, interpolation, crop))
+        # written in a temporary directory and renamed, so that an interrupted write is never read
+        tmp_dir = "{}.tmp{}".format(entry_dir, os.getpid())
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        data = np.asanyarray(image.dataobj)
+        np.save(os.path.join(tmp_dir, IMAGE_CACHE_DATA_FILE), data)
+        with open(os.path.join(tmp_dir, IMAGE_CACHE_HEADER_FILE), "wb") as f:
+            f.write(nib.Nifti1Header.from_header(image.header).binaryblock)
+        with open(os.path.join(tmp_dir, IMAGE_CACHE_INFO_FILE), "w") as f:
+            json.dump({"source": os.path.abspath(in_file), "affine": np.asarray(image.affine).tolist(),
+                       "nbytes": int(data.nbytes)}, f)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # written meanwhile by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def get_entries(self):
+        """
+        :return: list of (last access time, bytes, directory) of the complete entries
+        """
+        entries = list()
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            try:
+                with open(os.path.join(entry_dir, IMAGE_CACHE_INFO_FILE)) as f:
+                    n_bytes = json.load(f)["nbytes"]
+                entries.append((os.stat(entry_dir).st_mtime, n_bytes, entry_dir))
+            except (IOError, OSError, ValueError):
+                continue
+        return entries
+
+    def get_size(self):
+        return sum([n_bytes for _, n_bytes, _ in self.get_entries()])
+
+    def evict(self):
+        entries = sorted(self.get_entries())
+        n_bytes = sum([entry[1] for entry in entries])
+        # the most recent entry is kept even if it is larger than the budget
+        while len(entries) > 1 and n_bytes > self.max_bytes:
+            _, entry_bytes, entry_dir = entries.pop(0)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            n_bytes -= entry_bytes
+            self.evictions += 1
+
+    def clear(self):
+        for _, _, entry_dir in self.get_entries():
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def get_hit_rate(self):
+        n_requests = self.hits + self.misses
+        if n_requests == 0:
+            return 0.
+        return self.hits / float(n_requests)
+
+    def report(self):
+        print(">> {}: hit rate {:.1%} ({} hits, {} misses, {} evictions), {:.2f}gb in {}".format(
+            self.name, self.get_hit_rate(), self.hits, self.misses, self.evictions, self.get_size() / 1024. ** 3,
+            self.cache_dir))
+
+
+def get_image_cache(cache_dir, cache_size_gb, name="image cache"):
+    """
+    :param cache_dir: directory of the cache. None disables caching.
+    :param cache_size_gb: disk budget of the cache in gigabytes.
+    :return: ImageCache or None
+    """
+    if not cache_dir:
+        return None
+    return ImageCache(cache_dir, max_bytes=int(cache_size_gb * 1024 ** 3), name=name)
@@ -0,0 +1,170 @@
+import os
+import gzip
+import threading
+from queue import Queue
+
+import numpy as np
+import nibabel as nib
+
+
+LABEL_IMAGE = "label"
+PROBABILITY_IMAGE = "probability"
+
+
+def get_image_extension(compress_level):
+    return ".nii.gz" if compress_level else ".nii"
+
+
+def find_image_file(path):
+    """
+    :return: path, or the same image with the other extension (.nii / .nii.gz) if only that one exists
+    """
+    if os.path.exists(path):
+        return path
+    if path.endswith(".nii.gz"):
+        other_path = path[:-len(".gz")]
+    elif path.endswith(".nii"):
+        other_path = path + ".gz"
+    else:
+        return path
+    return other_path if os.path.exists(other_path) else path
+
+
+def get_output_image(image, kind=None, label_dtype=np.uint8, probability_dtype=None):
+    """
+    Applies the dtype policy of the written images.
+    :param kind: LABEL_IMAGE, PROBABILITY_IMAGE or None (written as is).
+    :param label_dtype: dtype of the label maps.
+    :param probability_dtype: dtype of the probability maps. None keeps the dtype of the prediction, np.float32
+    halves the float64 maps, np.uint8 / np.int16 store them quantized with a scale factor in the header (nibabel
+    chooses the scaling, get_fdata returns the probabilities).
+    :return: nibabel image
+    """
+    if kind == LABEL_IMAGE and label_dtype is not None:
+        return nib.Nifti1Image(np.asarray(image.dataobj, dtype=label_dtype), image.affine)
+    if kind == PROBABILITY_IMAGE and probability_dtype is not None:
+        probability_dtype = np.dtype(probability_dtype)
+        if probability_dtype.kind == "f":
+            return nib.Nifti1Image(np.asarray(image.dataobj, dtype=probability_dtype), image.affine)
+        output_image = nib.Nifti1Image(np.asarray(image.dataobj, dtype=np.float32), image.affine)
+        output_image.set_data_dtype(probability_dtype)
+        return output_image
+    return image
+
+
+def write_image(image, out_file, compress_level=1):
+    """
+    Writes a nifti image, gzipped at compress_level if out_file ends with .gz. The file is written next to its
+    destination and renamed, so a reader never sees a partial image.
+    """
+    tmp_file = out_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        if out_file.endswith(".gz"):
+            with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=compress_level or 1) as gz:
+                file_holder = nib.FileHolder(fileobj=gz)
+                image.to_file_map({"image": file_holder, "header": file_holder})
+        else:
+            file_holder = nib.FileHolder(fileobj=f)
+            image.to_file_map({"image": file_holder, "header": file_holder})
+    os.rename(tmp_file, out_file)
+    return os.path.abspath(out_file)
+
+
+class ImageWriter(object):
+    """
+    Writes the images of the predicted cases, with a gzip level (0 writes uncompressed .nii files), a dtype policy
+    for the label and probability maps (see get_output_image) and n_threads background threads, so that prediction
+    continues while the previous case is compressed. At most max_queued images wait to be written, which bounds the
+    extra memory. The written arrays must not be modified after write is called.
+    """
+
+    def __init__(self, compress_level=1, label_dtype=np.uint8, probability_dtype=None, n_threads=0, max_queued=8):
+        self.compress_level = compress_level
+        self.label_dtype = label_dtype
+        self.probability_dtype = probability_dtype
+        self.n_threads = n_threads
+        self.error = None
+        self.queue = None
+        self.threads = list()
+        if n_threads > 0:
+            self.queue = Queue(maxsize=max_queued)
+            for _ in range(n_threads):
+                thread = threading.Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def get_filename(self, output_dir, name):
+        """
+        :return: output file of the image name (without extension) in output_dir
+        """
+        return os.path.join(output_dir, name + get_image_extension(self.compress_level))
+
+    def write_now(self, image, out_file, kind=None):
+        image = get_output_image(image, kind=kind, label_dtype=self.label_dtype,
+                                 probability_dtype=self.probability_dtype)
+        return write_image(image, out_file, compress_level=self.compress_level)
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            try:
+                self.write_now(*task)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, image, out_file, kind=None):
+        """
+        Writes image to out_file, in a background thread if the writer has threads.
+        :param kind: LABEL_IMAGE, PROBABILITY_IMAGE or None, see get_output_image.
+        :return: absolute path of out_file
+        """
+        self.check_error()
+        if self.queue is None:
+            return self.write_now(image, out_file, kind=kind)
+        self.queue.put((image, out_file, kind))
+        return os.path.abspath(out_file)
+
+    def wait(self):
+        """
+        Waits until the queued images are written.
+        """
+        if self.queue is not None:
+            self.queue.join()
+        self.check_error()
+
+    def close(self):
+        if self.queue is not None:
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.queue = None
+            self.threads = list()
+        self.check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_image_writer(compress_level=1, probability_dtype=None, n_threads=0):
+    """
+    :param probability_dtype: name of the dtype of the probability maps ("float32", "int16", "uint8") or None.
+    :return: ImageWriter
+    """
+    return ImageWriter(compress_level=compress_level,
+                       probability_dtype=np.dtype(probability_dtype) if probability_dtype else None,
+                       n_threads=n_threads)
@@ -17,6 +17,14 @@ from unet3d.metrics import dice_coefficient_loss
 from keras.losses import categorical_crossentropy
 
 
+def get_template_model(model):
+    """
+    :return: the model replicated by multi_gpu_model, or model itself
+    """
+    nested = [layer for layer in model.layers if isinstance(layer, Model)]
+    return nested[0] if len(nested) == 1 else model
+
+
 def load_model_multi_gpu(model_file):
 
     print(">> load old model")
@@ -74,12 +74,80 @@ def get_patch_from_3d_data(data, patch_shape, patch_index):
     patch_shape = np.asarray(patch_shape)
     image_shape = data.shape[-3:]
     if np.any(patch_index < 0) or np.any((patch_index + patch_shape) > image_shape):
-        data, patch_index = fix_out_of_bound_patch_attempt(
-            data, patch_shape, patch_index)
+        return get_out_of_bound_patch(data, patch_shape, patch_index)
     return data[..., patch_index[0]:patch_index[0]+patch_shape[0], patch_index[1]:patch_index[1]+patch_shape[1],
                 patch_index[2]:patch_index[2]+patch_shape[2]]
 
 
+def get_out_of_bound_patch(data, patch_shape, patch_index):
+    """
+    Returns a patch that lies partly (or completely) outside of the data, with the same values as
+    fix_out_of_bound_patch_attempt (edge padding) but without padding the whole volume: the in-bounds window is copied
+    into a preallocated patch and only the out-of-bounds margins are filled with the edge values.
+    Works for any number of leading (channel) axes and any number of patch axes (2D, 2.5D and 3D patches).
+    :param data: numpy array from which to get the patch.
+    :param patch_shape: shape/size of the patch (the last len(patch_shape) axes of data).
+    :param patch_index: corner index of the patch.
+    :return: numpy array with the patch shape specified.
+    """
+    ndim = len(patch_shape)
+    image_shape = data.shape[-ndim:]
+    patch = np.empty(data.shape[:-ndim] + tuple(int(size) for size in patch_shape), dtype=data.dtype)
+
+    source = [Ellipsis]
+    target = [Ellipsis]
+    margins = list()
+    for start, size, length in zip(patch_index, patch_shape, image_shape):
+        start, size, length = int(start), int(size), int(length)
+        target_start = min(max(-start, 0), size)
+        target_stop = max(min(length - start, size), 0)
+        if target_start >= target_stop:
+            # the patch misses the image on this axis: every voxel takes the value of the nearest edge slice
+            edge = 0 if start < 0 else length - 1
+            target_start, target_stop = 0, 1
+            source.append(slice(edge, edge + 1))
+        else:
+            source.append(slice(start + target_start, start + target_stop))
+        target.append(slice(target_start, target_stop))
+        margins.append((target_start, target_stop, size))
+    patch[tuple(target)] = data[tuple(source)]
+
+    # edge padding is separable: extend the copied window one axis at a time, corners are filled by the later axes
+    for axis, (target_start, target_stop, size) in enumerate(margins):
+        axis = axis - ndim
+        if target_start > 0:
+            index = [slice(None)] * patch.ndim
+            index[axis] = slice(0, target_start)
+            edge = [slice(None)] * patch.ndim
+            edge[axis] = slice(target_start, target_start + 1)
+            patch[tuple(index)] = patch[tuple(edge)]
+        if target_stop < size:
+            index = [slice(None)] * patch.ndim
+            index[axis] = slice(target_stop, size)
+            edge = [slice(None)] * patch.ndim
+            edge[axis] = slice(target_stop - 1, target_stop)
+            patch[tuple(index)] = patch[tuple(edge)]
+    return patch
+
+
+def get_slab_view(data, depth):
+    """
+    Returns the slabs of depth slices along the last axis of data, one per slice, each slice at position
+    (depth - 1) // 2 of its slab (the central slice of the 2.5D training patches). Slices out of the volume repeat
+    the edge slices, as get_patch_from_3d_data. The slabs are a read-only strided view of the (edge padded) volume,
+    so no slab is copied until it is put in a batch.
+    :param data: numpy array (..., x, y, z).
+    :param depth: number of slices of a slab, 1 for the slices of 2D models.
+    :return: numpy array (z, ..., x, y, depth) where [i] is the slab of slice i.
+    """
+    before = (depth - 1) // 2
+    if depth > 1:
+        data = np.pad(data, [(0, 0)] * (data.ndim - 1) + [(before, depth - 1 - before)], mode="edge")
+    n_slices = data.shape[-1] - depth + 1
+    return np.lib.stride_tricks.as_strided(data, shape=(n_slices,) + data.shape[:-1] + (depth,),
+                                           strides=(data.strides[-1],) + data.strides, writeable=False)
+
+
 def fix_out_of_bound_patch_attempt(data, patch_shape, patch_index, ndim=3):
     """
     Pads the data and alters the patch index so that a patch will be correct.
@@ -0,0 +1,345 @@
+import os
+import json
+import time
+import socket
+import subprocess
+
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+def get_total_memory_gb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024. ** 3
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_visible_gpus():
+    """
+    :return: ids of the gpus visible to the jobs: those of CUDA_VISIBLE_DEVICES if set, otherwise those listed by
+    nvidia-smi. Empty without gpu. Tensorflow is not imported, so that the scheduler does not hold gpu memory.
+    """
+    devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if devices is not None:
+        return [device.strip() for device in devices.split(",") if device.strip() and device.strip() != "-1"]
+    try:
+        output = subprocess.check_output(["nvidia-smi", "-L"], stderr=subprocess.DEVNULL).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return list()
+    return [str(i) for i, line in enumerate([line for line in output.splitlines() if line.startswith("GPU ")])]
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class LockFile(object):
+    """
+    Exclusive lock held through a file created with O_CREAT | O_EXCL. The file stores the pid and host of its owner;
+    a lock whose owner died on this host, or that is older than stale_after seconds, is considered stale and taken over.
+    """
+
+    def __init__(self, path, stale_after=None):
+        self.path = path
+        self.stale_after = stale_after
+        self.is_locked = False
+
+    def read_owner(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def is_stale(self):
+        owner = self.read_owner()
+        if owner is None:
+            # unreadable: being written right now, or written by a crashed process
+            try:
+                return time.time() - os.path.getmtime(self.path) > 60
+            except OSError:
+                return True
+        if self.stale_after is not None and time.time() - owner["time"] > self.stale_after:
+            return True
+        if owner["host"] == socket.gethostname():
+            return not is_process_alive(owner["pid"])
+        return False
+
+    def acquire(self, pid=None):
+        for _ in range(2):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.is_stale():
+                    return False
+                print(">> remove stale lock {}".format(self.path))
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"pid": os.getpid() if pid is None else pid, "host": socket.gethostname(),
+                           "time": time.time()}, f)
+            self.is_locked = True
+            return True
+        return False
+
+    def set_owner(self, pid):
+        """
+        Hands the lock over to a child process, so that it stays valid only while the child runs.
+        """
+        with open(self.path, "w") as f:
+            json.dump({"pid": pid, "host": socket.gethostname(), "time": time.time()}, f)
+
+    def release(self):
+        if self.is_locked and os.path.exists(self.path):
+            os.remove(self.path)
+        self.is_locked = False
+
+
+class Job(object):
+    """
+    A shell command of a sweep.
+    :param name: unique name of the job, e.g. the model filename. Used for the lock file and the saved state.
+    :param cmd: shell command.
+    :param output_path: if given and existing, the job is considered finished and skipped.
+    :param n_cpu: number of cpu slots used by the job.
+    :param mem_gb: memory reserved by the job.
+    :param n_gpu: number of gpus given to the job (through CUDA_VISIBLE_DEVICES) on a machine with gpus.
+    :param is_lock: if False, the job runs even if another process holds its lock.
+    :param is_rerun: if True, the job runs even if it is already finished.
+    :param dependencies: names of the jobs that must be finished before this one starts.
+    """
+
+    def __init__(self, name, cmd, output_path=None, n_cpu=1, mem_gb=0, n_gpu=0, is_lock=True, is_rerun=False,
+                 dependencies=None):
+        self.name = name
+        self.cmd = cmd
+        self.output_path = output_path
+        self.n_cpu = n_cpu
+        self.mem_gb = mem_gb
+        self.n_gpu = n_gpu
+        self.is_lock = is_lock
+        self.is_rerun = is_rerun
+        self.dependencies = list(dependencies) if dependencies else list()
+
+
+class Scheduler(object):
+    """
+    Runs jobs in parallel subprocesses while their cpu, memory and gpu reservations fit the machine. Each job
+    reserving gpus runs with its own gpus in CUDA_VISIBLE_DEVICES, so a machine with n gpus runs n one-gpu jobs at
+    the same time. Without gpu, the gpu reservations are ignored. Job states are saved
+    in state_dir/jobs.json after every change, and state_dir/<name>.lock prevents two schedulers (or a restarted one)
+    from running the same job. Finished jobs are skipped when the sweep is started again.
+    :param state_dir: directory of the state file, lock files and job logs.
+    :param n_cpu: cpu slots. Default is the number of cpus.
+    :param mem_gb: memory slots in gb. Default is the physical memory.
+    :param max_jobs: maximum number of jobs running at the same time. None limits the jobs by their reservations only.
+    :param gpus: ids of the gpu slots. Default is get_visible_gpus.
+    :param stale_after: seconds after which a lock is stale even if its owner still runs. None never expires locks.
+    :param poll_interval: seconds between two checks of the running jobs.
+    """
+
+    def __init__(self, state_dir, n_cpu=None, mem_gb=None, max_jobs=None, gpus=None, stale_after=None,
+                 poll_interval=5):
+        self.state_dir = state_dir
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        self.n_cpu = n_cpu if n_cpu else os.cpu_count()
+        self.mem_gb = mem_gb if mem_gb else get_total_memory_gb()
+        self.max_jobs = max_jobs
+        self.gpus = list(gpus) if gpus is not None else get_visible_gpus()
+        self.free_gpus = list(self.gpus)
+        self.job_gpus = dict()
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.jobs = list()
+        self.state_file = os.path.join(state_dir, "jobs.json")
+        self.state = self.load_state()
+
+    def load_state(self):
+        if not os.path.exists(self.state_file):
+            return dict()
+        with open(self.state_file, "r") as f:
+            return json.load(f)
+
+    def save_state(self):
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(tmp_file, self.state_file)
+
+    def set_state(self, job, status, **kwargs):
+        # schedulers sharing state_dir update the file in turn, each one re-reading it first
+        state_lock = LockFile(self.state_file + ".lock", stale_after=60)
+        while not state_lock.acquire():
+            time.sleep(0.1)
+        try:
+            self.state = self.load_state()
+            job_state = self.state.setdefault(job.name, {"cmd": job.cmd, "attempts": 0})
+            job_state["status"] = status
+            job_state["time"] = time.time()
+            job_state.update(kwargs)
+            self.save_state()
+        finally:
+            state_lock.release()
+
+    def get_lock(self, job):
+        return LockFile(os.path.join(self.state_dir, "{}.lock".format(job.name)), stale_after=self.stale_after)
+
+    def add(self, job):
+        if job.name in [queued.name for queued in self.jobs]:
+            print(">> {} is already queued. Will skip!!".format(job.name))
+            return
+        self.jobs.append(job)
+
+    def is_finished(self, job):
+        if job.is_rerun:
+            return False
+        if job.output_path is not None:
+            return os.path.exists(job.output_path)
+        return self.state.get(job.name, dict()).get("status") == DONE
+
+    def fits(self, job, running):
+        used_cpu = sum([running_job.n_cpu for running_job, _, _ in running])
+        used_mem = sum([running_job.mem_gb for running_job, _, _ in running])
+        if self.max_jobs is not None and len(running) >= self.max_jobs:
+            return False
+        if not running:
+            # a job larger than the machine still runs, alone
+            return True
+        if self.gpus and job.n_gpu > len(self.free_gpus):
+            return False
+        if used_cpu + job.n_cpu > self.n_cpu:
+            return False
+        if self.mem_gb is not None and used_mem + job.mem_gb > self.mem_gb:
+            return False
+        return True
+
+    def start(self, job):
+        lock = self.get_lock(job)
+        if job.is_lock and not lock.acquire():
+            print("{} is running elsewhere. Will skip!!".format(job.name))
+            return None
+        print(">> RUNNING:", job.cmd)
+        log = open(os.path.join(self.state_dir, "{}.log".format(job.name)), "a")
+        env = None
+        if self.gpus and job.n_gpu > 0:
+            # a job larger than the machine gets all the free gpus
+            gpus = self.free_gpus[:job.n_gpu]
+            self.free_gpus = self.free_gpus[len(gpus):]
+            self.job_gpus[job.name] = gpus
+            env = dict(os.environ, CUDA_VISIBLE_DEVICES=",".join(gpus))
+            print(">> gpus {}".format(",".join(gpus)))
+        process = subprocess.Popen(job.cmd, shell=True, stdout=log, stderr=subprocess.STDOUT, env=env)
+        if job.is_lock:
+            lock.set_owner(process.pid)
+        attempts = self.state.get(job.name, dict()).get("attempts", 0) + 1
+        self.set_state(job, RUNNING, pid=process.pid, host=socket.gethostname(), attempts=attempts)
+        log.close()
+        return process, lock
+
+    def finish(self, job, process, lock):
+        status = DONE if process.returncode == 0 else FAILED
+        print(">> {}: {} (return code {})".format(status, job.name, process.returncode))
+        self.set_state(job, status, returncode=process.returncode)
+        self.free_gpus.extend(self.job_gpus.pop(job.name, list()))
+        if job.is_lock:
+            lock.release()
+
+    def get_finished(self):
+        """
+        Names of the jobs that do not need to run: their output exists (or they are done), or every job depending on
+        them is itself finished, so their output is not needed anymore.
+        """
+        finished = set([job.name for job in self.jobs if self.is_finished(job)])
+        dependents = dict()
+        for job in self.jobs:
+            for dependency in job.dependencies:
+                dependents.setdefault(dependency, list()).append(job.name)
+        is_changed = True
+        while is_changed:
+            is_changed = False
+            for job in self.jobs:
+                if job.name in finished or job.is_rerun or job.name not in dependents:
+                    continue
+                if all([name in finished for name in dependents[job.name]]):
+                    finished.add(job.name)
+                    is_changed = True
+        return finished
+
+    def run(self):
+        """
+        Runs all queued jobs and returns when they are all finished. A job starts once all its dependencies are
+        finished; if one of them fails (or runs elsewhere), the job is skipped until the next run.
+        :return: dict of job name -> status
+        """
+        names = set([job.name for job in self.jobs])
+        finished = self.get_finished()
+        not_done = set()
+        pending = list()
+        for job in self.jobs:
+            if job.name in finished:
+                print("{} exists or in training. Will skip!!".format(job.output_path or job.name))
+                continue
+            pending.append(job)
+
+        running = list()
+        try:
+            while pending or running:
+                is_progress = False
+                for job in list(pending):
+                    # dependencies that are not jobs of this scheduler are assumed to be available
+                    dependencies = [name for name in job.dependencies if name in names]
+                    if any([name in not_done for name in dependencies]):
+                        print("{} waits for a job that did not finish. Will skip!!".format(job.name))
+                        pending.remove(job)
+                        not_done.add(job.name)
+                        is_progress = True
+                        continue
+                    if not all([name in finished for name in dependencies]):
+                        continue
+                    if not self.fits(job, running):
+                        continue
+                    pending.remove(job)
+                    is_progress = True
+                    started = self.start(job)
+                    if started is None:
+                        not_done.add(job.name)
+                    else:
+                        running.append((job,) + started)
+
+                still_running = list()
+                for job, process, lock in running:
+                    if process.poll() is None:
+                        still_running.append((job, process, lock))
+                    else:
+                        self.finish(job, process, lock)
+                        is_progress = True
+                        if process.returncode == 0:
+                            finished.add(job.name)
+                        else:
+                            not_done.add(job.name)
+                running = still_running
+                if running:
+                    time.sleep(self.poll_interval)
+                elif pending and not is_progress:
+                    print(">> circular dependencies between {}".format([job.name for job in pending]))
+                    break
+        finally:
+            # interrupted: the children keep their locks through their pid and are detected when they exit
+            for job, process, lock in running:
+                print(">> {} is still running (pid {})".format(job.name, process.pid))
+        self.state = self.load_state()
+        return dict([(job.name, self.state.get(job.name, dict()).get("status", SKIPPED)) for job in self.jobs])
@@ -10,9 +10,28 @@ def sitk_resample_to_spacing(image, new_spacing=(1.0, 1.0, 1.0), interpolator=si
     zoom_factor = np.divide(image.GetSpacing(), new_spacing)
     new_size = np.asarray(np.ceil(np.round(np.multiply(zoom_factor, image.GetSize()), decimals=5)), dtype=np.int16)
     offset = calculate_origin_offset(new_spacing, image.GetSpacing())
-    reference_image = sitk_new_blank_image(size=new_size, spacing=new_spacing, direction=image.GetDirection(),
-                                           origin=image.GetOrigin() + offset, default_value=default_value)
-    return sitk_resample_to_image(image, reference_image, interpolator=interpolator, default_value=default_value)
+    return sitk_resample(image, size=new_size, spacing=new_spacing, origin=image.GetOrigin() + offset,
+                         direction=image.GetDirection(), interpolator=interpolator, default_value=default_value)
+
+
+def sitk_resample(image, size, spacing, origin, direction, interpolator=sitk.sitkLinear, default_value=0.,
+                  output_pixel_type=None):
+    """
+    Resamples image on the grid of the given size, spacing, origin and direction, set on the filter itself rather
+    than through a reference image, so no blank image of the output size is allocated.
+    """
+    if output_pixel_type is None:
+        output_pixel_type = image.GetPixelID()
+    resample_filter = sitk.ResampleImageFilter()
+    resample_filter.SetInterpolator(interpolator)
+    resample_filter.SetTransform(sitk.Transform())
+    resample_filter.SetOutputPixelType(output_pixel_type)
+    resample_filter.SetDefaultPixelValue(default_value)
+    resample_filter.SetSize([int(dim) for dim in size])
+    resample_filter.SetOutputSpacing([float(dim) for dim in spacing])
+    resample_filter.SetOutputOrigin([float(dim) for dim in origin])
+    resample_filter.SetOutputDirection(direction)
+    return resample_filter.Execute(image)
 
 
 def sitk_resample_to_image(image, reference_image, default_value=0., interpolator=sitk.sitkLinear, transform=None,
@@ -40,29 +59,69 @@ def sitk_new_blank_image(size, spacing, direction, origin, default_value=0.):
 
 
 def resample_to_spacing(data, spacing, target_spacing, interpolation="linear", default_value=0.):
+    """
+    Resamples an array (x, y, z) of the given spacing to target_spacing. float64 data are resampled as float32.
+    """
+    if data.dtype == np.float64:
+        data = data.astype(np.float32)
     image = data_to_sitk_image(data, spacing=spacing)
-    if interpolation is "linear":
-        interpolator = sitk.sitkLinear
-    elif interpolation is "nearest":
-        interpolator = sitk.sitkNearestNeighbor
-    else:
-        raise ValueError("'interpolation' must be either 'linear' or 'nearest'. '{}' is not recognized".format(
-            interpolation))
-    resampled_image = sitk_resample_to_spacing(image, new_spacing=target_spacing, interpolator=interpolator,
+    resampled_image = sitk_resample_to_spacing(image, new_spacing=np.asarray(target_spacing)[::-1],
+                                               interpolator=get_interpolator(interpolation),
                                                default_value=default_value)
     return sitk_image_to_data(resampled_image)
 
 
+def get_interpolator(interpolation):
+    if interpolation == "linear":
+        return sitk.sitkLinear
+    elif interpolation == "nearest":
+        return sitk.sitkNearestNeighbor
+    raise ValueError("'interpolation' must be either 'linear' or 'nearest'. '{}' is not recognized".format(
+        interpolation))
+
+
+def resample_to_grid(data, affine, shape, spacing, origin, interpolation="linear", default_value=0.):
+    """
+    Resamples data (x, y, z) of the given affine, in one pass, on the grid of the world axes given by shape, spacing
+    and origin (world coordinate of the first voxel). The points of the grid outside of the image are default_value.
+    float64 data are resampled as float32.
+    :return: array of the given shape
+    """
+    if data.dtype == np.float64:
+        data = data.astype(np.float32)
+    affine = np.asarray(affine, dtype=np.float64)
+    zooms = np.linalg.norm(affine[:3, :3], axis=0)
+    direction = affine[:3, :3] / zooms
+    if data.flags.f_contiguous and not data.flags.c_contiguous:
+        # nibabel arrays are in fortran order: their transpose is c-contiguous, so GetImageFromArray copies it once
+        # instead of making a c-contiguous copy first, and the image keeps the axes of data
+        image = sitk.GetImageFromArray(data.T)
+    else:
+        image = sitk.GetImageFromArray(data)
+        zooms, direction = zooms[::-1], direction[:, ::-1]
+    image.SetSpacing([float(dim) for dim in zooms])
+    image.SetDirection([float(value) for value in direction.flatten()])
+    image.SetOrigin([float(value) for value in affine[:3, 3]])
+    # the output axes are reversed too, so that the array read from the image is indexed (x, y, z)
+    resampled_image = sitk_resample(image, size=np.asarray(shape)[::-1], spacing=np.asarray(spacing)[::-1],
+                                    origin=origin, direction=np.eye(3)[:, ::-1].flatten().tolist(),
+                                    interpolator=get_interpolator(interpolation), default_value=default_value)
+    return sitk.GetArrayFromImage(resampled_image)
+
+
 def data_to_sitk_image(data, spacing=(1., 1., 1.)):
-    if len(data.shape) == 3:
-        data = np.rot90(data, 1, axes=(0, 2))
-    image = sitk.GetImageFromArray(data)
-    image.SetSpacing(np.asarray(spacing, dtype=np.float))
+    """
+    sitk reads arrays in (z, y, x) order, so the axes of the image are those of data reversed: the memory of data is
+    imported as is instead of being reordered, and the spacing is reversed with the axes.
+    :param spacing: spacing of the axes of data.
+    """
+    image = sitk.GetImageFromArray(np.ascontiguousarray(data))
+    image.SetSpacing([float(dim) for dim in spacing][::-1])
     return image
 
 
 def sitk_image_to_data(image):
-    data = sitk.GetArrayFromImage(image)
-    if len(data.shape) == 3:
-        data = np.rot90(data, -1, axes=(0, 2))
-    return data
+    """
+    :return: array of the image, in the axis order of data_to_sitk_image
+    """
+    return sitk.GetArrayFromImage(image)
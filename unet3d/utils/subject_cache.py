@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+from random import shuffle
+
+
+class SubjectCache(object):
+    """
+    Byte-budgeted LRU cache of decompressed subjects (data and truth) read from one opened data file. Consecutive
+    patches of the same subject are cut from memory instead of re-reading and re-decompressing the whole volume.
+    Cached arrays must not be modified: get_data_from_file copies every patch it cuts from them.
+    """
+
+    def __init__(self, max_bytes, name="subject cache"):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.subjects = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, data_file, index):
+        with self.lock:
+            if index in self.subjects:
+                self.subjects.move_to_end(index)
+                self.hits += 1
+                return self.subjects[index]
+            self.misses += 1
+
+        data, truth = data_file.root.data[index], data_file.root.truth[index, 0]
+        subject_bytes = data.nbytes + truth.nbytes
+        if subject_bytes > self.max_bytes:
+            return data, truth
+
+        with self.lock:
+            if index not in self.subjects:
+                while self.subjects and self.n_bytes + subject_bytes > self.max_bytes:
+                    _, (old_data, old_truth) = self.subjects.popitem(last=False)
+                    self.n_bytes -= old_data.nbytes + old_truth.nbytes
+                    self.evictions += 1
+                self.subjects[index] = (data, truth)
+                self.n_bytes += subject_bytes
+        return data, truth
+
+    def clear(self):
+        with self.lock:
+            self.subjects.clear()
+            self.n_bytes = 0
+
+    def get_hit_rate(self):
+        n_requests = self.hits + self.misses
+        if n_requests == 0:
+            return 0.
+        return self.hits / float(n_requests)
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.get_hit_rate(), "n_subjects": len(self.subjects),
+                "mb": self.n_bytes / 1024. ** 2}
+
+    def report(self):
+        stats = self.get_stats()
+        print(">> {}: hit rate {:.1%} ({} hits, {} misses, {} evictions), {} subjects in {:.0f}mb".format(
+            self.name, stats["hit_rate"], stats["hits"], stats["misses"], stats["evictions"],
+            stats["n_subjects"], stats["mb"]))
+
+
+def get_subject_cache(cache_size_mb, name="subject cache"):
+    """
+    :param cache_size_mb: memory budget of the cache in megabytes. 0 or None disables caching.
+    :return: SubjectCache or None
+    """
+    if not cache_size_mb:
+        return None
+    return SubjectCache(max_bytes=int(cache_size_mb * 1024 ** 2), name=name)
+
+
+def locality_shuffle(index_list, n_subjects_window=4):
+    """
+    Shuffles a list of (subject_index, patch_index) tuples so that only a few subjects are active at a time. Subjects
+    are shuffled and split into windows of n_subjects_window subjects; the patches of each window are shuffled
+    together. With a cache that can hold n_subjects_window subjects, every subject is decompressed once per epoch.
+    :param index_list: list of (subject_index, patch_index) as returned by create_patch_index_list.
+    :param n_subjects_window: number of subjects whose patches are mixed together.
+    :return: shuffled list. The generators pop() from the end, so windows are consumed from the back.
+    """
+    patches_per_subject = OrderedDict()
+    for index in index_list:
+        patches_per_subject.setdefault(index[0], list()).append(index)
+
+    subjects = list(patches_per_subject.keys())
+    shuffle(subjects)
+    n_subjects_window = max(int(n_subjects_window), 1)
+
+    shuffled_list = list()
+    for i in range(0, len(subjects), n_subjects_window):
+        window = list()
+        for subject in subjects[i:i + n_subjects_window]:
+            window.extend(patches_per_subject[subject])
+        shuffle(window)
+        shuffled_list.extend(window)
+    return shuffled_list
+
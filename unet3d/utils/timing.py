@@ -0,0 +1,135 @@
+import os
+import time
+import threading
+from collections import deque
+
+
+STAGES = ("read", "augment", "labels", "batch")
+
+
+class NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimer(object):
+    """
+    Accumulates the time spent in the stages of the data generators (see STAGES) and the size of the generated
+    batches. The generators may run in the background thread of fit_generator, so the totals are guarded by a lock
+    and consumed with pop_stages / pop_batch_bytes. Disabled, stage() returns a shared no-op context.
+    """
+
+    def __init__(self):
+        self.is_enabled = False
+        self.lock = threading.Lock()
+        self.totals = dict()
+        self.counts = dict()
+        self.batch_bytes = deque()
+
+    def enable(self, is_enabled=True):
+        self.is_enabled = is_enabled
+        self.pop_stages()
+        with self.lock:
+            self.batch_bytes.clear()
+
+    def stage(self, name):
+        if not self.is_enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0.) + seconds
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def add_batch(self, n_bytes):
+        if self.is_enabled:
+            with self.lock:
+                self.batch_bytes.append(n_bytes)
+
+    def pop_stages(self):
+        """
+        :return: dict of stage name -> (seconds, number of calls) since the previous pop
+        """
+        with self.lock:
+            stages = dict([(name, (self.totals[name], self.counts[name])) for name in self.totals])
+            self.totals = dict()
+            self.counts = dict()
+        return stages
+
+    def pop_batch_bytes(self):
+        """
+        :return: size of the oldest generated batch that was not popped yet, None if there is none
+        """
+        with self.lock:
+            if self.batch_bytes:
+                return self.batch_bytes.popleft()
+        return None
+
+
+stage_timer = StageTimer()
+
+
+def time_stage(name):
+    """
+    Context manager timing a stage of the data generators, e.g. with time_stage("read"): ...
+    """
+    return stage_timer.stage(name)
+
+
+def get_n_bytes(batch):
+    if isinstance(batch, (list, tuple)):
+        return sum([get_n_bytes(item) for item in batch])
+    return getattr(batch, "nbytes", 0)
+
+
+class TimedGenerator(object):
+    """
+    Wraps a training generator to record the time taken to produce each batch (stage "generate") and its size in
+    bytes. Batches produced in another process (use_multiprocessing=True) are not seen by the timer.
+    """
+
+    def __init__(self, generator, timer=stage_timer):
+        self.generator = generator
+        self.timer = timer
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        batch = next(self.generator)
+        if self.timer.is_enabled:
+            self.timer.add("generate", time.perf_counter() - start)
+            self.timer.add_batch(get_n_bytes(batch))
+        return batch
+
+    next = __next__
+
+
+def get_timing_file(model_file):
+    """
+    :return: jsonl file of the step timings of a model, e.g. model.h5 -> model_timing.jsonl
+    """
+    return os.path.splitext(model_file)[0] + "_timing.jsonl"
@@ -8,7 +8,7 @@ import numpy as np
 from nilearn.image import reorder_img, new_img_like
 
 from .nilearn_custom_utils.nilearn_utils import crop_img_to
-from .sitk_utils import resample_to_spacing, calculate_origin_offset
+from .sitk_utils import resample_to_spacing, resample_to_grid, calculate_origin_offset
 
 
 def pickle_dump(item, out_file):
@@ -25,12 +25,13 @@ def get_affine(in_file):
     return read_image(in_file).affine
 
 
-def read_image_files(image_files, image_shape=None, crop=None, label_indices=None):
+def read_image_files(image_files, image_shape=None, crop=None, label_indices=None, image_cache=None):
     """
 
     :param image_files: 
     :param image_shape: 
     :param crop: 
+    :param image_cache: unet3d.utils.image_cache.ImageCache of the decoded images, or None
     :param use_nearest_for_last_file: If True, will use nearest neighbor interpolation for the last file. This is used
     because the last file may be the labels file. Using linear interpolation here would mess up the labels.
     :return: 
@@ -47,23 +48,39 @@ def read_image_files(image_files, image_shape=None, crop=None, label_indices=Non
         else:
             interpolation = "linear"
         image_list.append(read_image(
-            image_file, image_shape=image_shape, crop=crop, interpolation=interpolation))
+            image_file, image_shape=image_shape, crop=crop, interpolation=interpolation, image_cache=image_cache))
 
     return image_list
 
 
-def read_image(in_file, image_shape=None, interpolation='linear', crop=None):
-    print("Reading: {0}".format(in_file))
-    image = nib.load(os.path.abspath(in_file))
-    image = fix_shape(image)
+def read_image(in_file, image_shape=None, interpolation='linear', crop=None, image_cache=None):
+    """
+    :param image_cache: if set, the decoded (and cropped / resized) image is read from and stored in this
+    unet3d.utils.image_cache.ImageCache. A cropped or resized image missing from the cache is computed from the
+    cached decoded image, so each source file is decompressed once.
+    """
+    if image_cache is not None:
+        image = image_cache.get(in_file, image_shape=image_shape, interpolation=interpolation, crop=crop)
+        if image is not None:
+            return image
+        if crop or image_shape:
+            image = read_image(in_file, image_cache=image_cache)
+        else:
+            print("Reading: {0}".format(in_file))
+            image = fix_shape(nib.load(os.path.abspath(in_file)))
+    else:
+        print("Reading: {0}".format(in_file))
+        image = nib.load(os.path.abspath(in_file))
+        image = fix_shape(image)
     if crop:
         image = crop_img_to(image, crop, copy=True)
         # nib.save(image, crop_path)
     if image_shape:
         # nib.save(resize(image, new_shape=image_shape, interpolation=interpolation), resize_path)
-        return resize(image, new_shape=image_shape, interpolation=interpolation)
-    else:
-        return image
+        image = resize(image, new_shape=image_shape, interpolation=interpolation)
+    if image_cache is not None:
+        image_cache.put(in_file, image, image_shape=image_shape, interpolation=interpolation, crop=crop)
+    return image
 
 
 def fix_shape(image):
@@ -111,7 +128,8 @@ def pad(image, new_shape, mode="constant", interpolation="linear"):
     # pad_z_1 = max(0, int((new_shape[2] - old_shape[2])/2))
     # pad_z_2 = max(0, new_shape[2] - pad_z_1 - old_shape[2])
 
-    new_data = np.copy(image.get_fdata())
+    # np.pad returns a new array, the cached data of the image is not modified
+    new_data = image.get_fdata(dtype=np.float32)
     constant_values = np.min(new_data)
     new_data = np.pad(new_data, ((pad_x_1, pad_x_2),
                                  (pad_y_1, pad_y_2),
@@ -128,6 +146,58 @@ def pad(image, new_shape, mode="constant", interpolation="linear"):
     return new_img_like(image, new_data, affine=new_affine)
 
 
+def get_reordered_grid(affine, shape):
+    """
+    Grid of the image reordered to a positive diagonal affine, as by nilearn.image.reorder_img, without resampling.
+    :return: spacing, origin (world coordinate of the first voxel) and shape of the reordered image, None if the
+    affine is not aligned with the world axes
+    """
+    rotation = np.asarray(affine, dtype=np.float64)[:3, :3]
+    axes = np.argmax(np.abs(rotation), axis=1)
+    if len(set(axes)) != 3 or np.count_nonzero(np.abs(rotation) > 1e-6 * np.abs(rotation).max()) != 3:
+        return None
+    steps = rotation[np.arange(3), axes]
+    reordered_shape = np.asarray(shape)[axes]
+    origin = np.asarray(affine, dtype=np.float64)[:3, 3] + np.minimum(0, steps * (reordered_shape - 1))
+    return np.abs(steps), origin, reordered_shape
+
+
+def resize_and_pad(image, new_shape, pad_shape, interpolation="linear", crop=None):
+    """
+    resize to new_shape then pad to pad_shape in one resampling: the output grid is computed from the affine, and the
+    image is resampled straight into it, without reordering, copying or padding the data in between. The padding is
+    the minimum of the image, as in pad.
+    :param new_shape: shape of the whole (reordered) image once resized.
+    :param crop: (start, stop) of a crop in the voxels of the reordered image, resized with the spacing of new_shape.
+    :return: image of shape max(resized shape, pad_shape), the resized image centered as in pad
+    """
+    grid = get_reordered_grid(image.affine, image.shape[:3])
+    if grid is None:
+        if crop is not None:
+            raise ValueError("crop needs an affine aligned with the world axes")
+        return pad(resize(image, new_shape=new_shape, interpolation=interpolation), new_shape=pad_shape,
+                   interpolation=interpolation)
+    spacing, origin, shape = grid
+    new_spacing = spacing * shape / np.asarray(new_shape, dtype=np.float64)
+    origin = origin + calculate_origin_offset(new_spacing, spacing)
+    resized_shape = np.asarray(new_shape)
+    if crop is not None:
+        origin = origin + np.asarray(crop[0]) * spacing
+        resized_shape = np.round(np.subtract(crop[1], crop[0]) * spacing / new_spacing).astype(int)
+    pad_start = np.maximum(np.trunc((np.asarray(pad_shape) - resized_shape) / 2.), 0)
+    origin = origin - pad_start * new_spacing
+    out_shape = np.maximum(resized_shape, pad_shape)
+
+    data = np.asanyarray(image.dataobj)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3])
+    new_data = resample_to_grid(data, image.affine, out_shape, new_spacing, origin, interpolation=interpolation,
+                                default_value=float(np.min(data)))
+    new_affine = np.diag(new_spacing.tolist() + [1])
+    new_affine[:3, 3] = origin
+    return new_img_like(image, new_data, affine=new_affine)
+
+
 def str2bool(v):
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
         return True
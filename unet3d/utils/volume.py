@@ -10,6 +10,7 @@ import itertools
 from nilearn.image import new_img_like, resample_to_img
 from nilearn.masking import compute_multi_background_mask
 from unet3d.utils.path_utils import get_modality
+from unet3d.utils.foreground import get_projections, get_bbox_from_projections
 from brats.config import config
 
 
@@ -31,17 +32,14 @@ def get_bounding_box_nd(volume):
 
 
 def get_bounding_box(volume):
-    r = np.any(volume, axis=(1, 2))
-    c = np.any(volume, axis=(0, 2))
-    z = np.any(volume, axis=(0, 1))
-    rmin, rmax = np.where(r)[0][[0, -1]]
-    cmin, cmax = np.where(c)[0][[0, -1]]
-    zmin, zmax = np.where(z)[0][[0, -1]]
-    return np.array([rmin.T, rmax.T, cmin.T, cmax.T, zmin.T, zmax.T])
+    start, stop = get_bbox_from_projections(get_projections(volume))
+    return np.array([start[0], stop[0] - 1, start[1], stop[1] - 1, start[2], stop[2] - 1])
 
 
-def get_size_bounding_box(volume):
-    rmin, rmax, cmin, cmax, zmin, zmax = get_bounding_box(volume)
+def get_size_bounding_box(volume, bounding_box=None):
+    if bounding_box is None:
+        bounding_box = get_bounding_box(volume)
+    rmin, rmax, cmin, cmax, zmin, zmax = bounding_box
     return np.array([rmax - rmin, cmax-cmin, zmax-zmin])
 
 